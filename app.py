@@ -1,27 +1,41 @@
 """
 LexiAssist v8.0 — Elite AI Legal Engine for Nigerian Lawyers
-Single-file deployment with SQLite persistence.
+Single-file deployment with PostgreSQL or embedded SQLite persistence.
 Contract Review · Cost Tracking · User Profiles · Analysis Comparison
 Save to Case · Editable References · Custom Templates · Auth Support
 """
 from __future__ import annotations
 
+import atexit
+import copy
 import time
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import hashlib
+import itertools
 import html as html_mod
 import json
 import logging
 import os
+import random
 import re
+import threading
+import sqlite3
 try:
     import psycopg2
+    from psycopg2 import extensions as pg_extensions
 except ImportError:
-    import psycopg2cffi as psycopg2  # type: ignore
+    try:
+        import psycopg2cffi as psycopg2  # type: ignore
+        from psycopg2cffi import extensions as pg_extensions  # type: ignore
+    except ImportError:
+        psycopg2 = None  # SQLite-only install
 import uuid
-from datetime import datetime, date
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
 from io import BytesIO
 from typing import Any, Optional
 
@@ -125,6 +139,12 @@ try:
 except ImportError:
     HAS_XLSX = False
 
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+    HAS_SCRIPT_CTX = True
+except ImportError:
+    HAS_SCRIPT_CTX = False
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("LexiAssist")
 
@@ -152,13 +172,31 @@ def _get_db_url() -> str:
     except Exception:
         url = os.getenv("DATABASE_URL", "")
     if not url or not url.strip():
-        st.error("❌ DATABASE_URL is not set. Add it to your Streamlit secrets.")
+        st.error("❌ DATABASE_URL is not set. Add it to your Streamlit secrets "
+                 "(`postgresql://…`, or `sqlite:///lexiassist.db` for a single-office install).")
         st.stop()
     # Streamlit Cloud / psycopg2 requires postgresql:// not postgres://
     if url.startswith("postgres://"):
         url = url.replace("postgres://", "postgresql://", 1)
     return url.strip()
 
+
+def _get_db_pool_bounds() -> tuple[int, int]:
+    """(min, max) pooled connections per server process. Override with
+    DB_POOL_MIN / DB_POOL_MAX in secrets or env."""
+    bounds = []
+    for name, default in (("DB_POOL_MIN", 1), ("DB_POOL_MAX", 10)):
+        raw = ""
+        try:
+            raw = str(st.secrets[name])
+        except Exception:
+            raw = os.getenv(name, "")
+        try:
+            bounds.append(int(raw) if raw.strip() else default)
+        except ValueError:
+            bounds.append(default)
+    return bounds[0], bounds[1]
+
 # ═══════════════════════════════════════════════════════
 # GEMINI MODELS (Best Free Tier – April 2026)
 # ═══════════════════════════════════════════════════════
@@ -202,10 +240,91 @@ RESPONSE_MODES = {
 
 UPLOAD_TYPES = ["pdf", "docx", "doc", "txt", "xlsx", "xls", "csv", "json", "rtf"]
 
-# Cost per 1M tokens (approx Gemini 2.5 Flash pricing)
+CASES_PAGE_SIZE = 25      # matters rendered per page in the Case Manager
+ANALYSES_PAGE_SIZE = 5    # saved analyses fetched per page for an opened case
+
+# Fallback cost per 1M tokens for models missing from MODEL_PRICES
 COST_PER_1M_INPUT = 0.15
 COST_PER_1M_OUTPUT = 0.60
 
+
+def _parse_price_config() -> dict:
+    """USD per 1M tokens by model: input (uncached prompt), cached (prompt tokens
+    served from a context cache), output (candidates + thinking) and storage
+    (context cache storage, per hour). Override or extend via GEMINI_PRICES, a
+    JSON object in the same shape."""
+    prices = {
+        "gemini-2.5-pro":        {"input": 1.25, "cached": 0.31,  "output": 10.00, "storage": 4.50},
+        "gemini-2.5-flash":      {"input": 0.30, "cached": 0.075, "output": 2.50,  "storage": 1.00},
+        "gemini-2.5-flash-lite": {"input": 0.10, "cached": 0.025, "output": 0.40,  "storage": 1.00},
+    }
+    raw = ""
+    try:
+        raw = str(st.secrets["GEMINI_PRICES"])
+    except Exception:
+        raw = os.getenv("GEMINI_PRICES", "")
+    if raw.strip():
+        try:
+            for model, row in json.loads(raw).items():
+                prices[model] = {**prices.get(model, {}), **row}
+        except Exception as e:
+            logger.warning(f"Ignoring malformed GEMINI_PRICES: {e}")
+    return prices
+
+
+MODEL_PRICES = _parse_price_config()
+
+
+def _parse_rate_limits() -> dict:
+    """Requests and input tokens per minute budgeted per API key and model
+    (Gemini free-tier quotas by default; 0 means unlimited). Paid projects
+    should raise these via GEMINI_RATE_LIMITS, a JSON object in the same shape."""
+    limits = {
+        "gemini-2.5-pro":        {"rpm": 5,  "tpm": 250_000},
+        "gemini-2.5-flash":      {"rpm": 10, "tpm": 250_000},
+        "gemini-2.5-flash-lite": {"rpm": 15, "tpm": 250_000},
+    }
+    raw = ""
+    try:
+        raw = str(st.secrets["GEMINI_RATE_LIMITS"])
+    except Exception:
+        raw = os.getenv("GEMINI_RATE_LIMITS", "")
+    if raw.strip():
+        try:
+            for model, row in json.loads(raw).items():
+                limits[model] = {**limits.get(model, {}), **row}
+        except Exception as e:
+            logger.warning(f"Ignoring malformed GEMINI_RATE_LIMITS: {e}")
+    return limits
+
+
+MODEL_RATE_LIMITS = _parse_rate_limits()
+DEFAULT_RATE_LIMIT = {"rpm": 10, "tpm": 250_000}  # models missing from MODEL_RATE_LIMITS
+
+
+def _context_cache_enabled() -> bool:
+    """GEMINI_CONTEXT_CACHE=0 turns off explicit caching of system prompts."""
+    try:
+        raw = str(st.secrets["GEMINI_CONTEXT_CACHE"])
+    except Exception:
+        raw = os.getenv("GEMINI_CONTEXT_CACHE", "1")
+    return raw.strip().lower() not in ("0", "false", "no", "off")
+
+
+CONTEXT_CACHE_ENABLED = _context_cache_enabled()
+
+# How long (seconds) an identical generate() call may be answered from the
+# response cache, per task. 0 disables caching for that task.
+LLM_CACHE_TTLS = {
+    "research": 24 * 3600,
+    "analysis": 7 * 24 * 3600,
+    "advisory": 7 * 24 * 3600,
+    "drafting": 3 * 24 * 3600,
+    "general": 24 * 3600,
+    "contract_clause": 30 * 24 * 3600,  # per-clause reviews, reused across contract drafts
+}
+LLM_CACHE_MEMORY_SIZE = 256  # responses kept in process memory in front of llm_cache
+
 # ═══════════════════════════════════════════════════════
 # SYSTEM PROMPTS
 # ═══════════════════════════════════════════════════════
@@ -2209,6 +2328,9 @@ div[data-testid="stTabs"] [data-testid="stFileUploader"] section button{{
 .response-box::before{{content:'';position:absolute;top:0;left:0;right:0;height:2px;
   background:linear-gradient(90deg,var(--la-acc),var(--la-acc2));
   border-radius:var(--r-lg) var(--r-lg) 0 0;}}
+.stream-seg{{line-height:1.78!important;font-size:{input_font}px!important;
+  font-family:var(--font)!important;white-space:pre-wrap;color:var(--la-text)!important;
+  padding:0 2rem;border-left:2px solid var(--la-acc);}}
 
 /* ── Disclaimer ── */
 .disclaimer{{background:{disc_bg};border-left:3px solid {warn};
@@ -2786,134 +2908,716 @@ def safe_docx_download(text: str, title: str, fname: str, key: str,
 
 
 # ═══════════════════════════════════════════════════════
-# DATABASE LAYER
+# STORAGE ENGINES (connection pool + SQL dialect)
 # ═══════════════════════════════════════════════════════
-class Database:
-    """PostgreSQL persistence for all LexiAssist data."""
+class StoragePoolExhausted(RuntimeError):
+    """Raised when no pooled connection frees up within the checkout timeout."""
 
-    def __init__(self):
-        self.url = _get_db_url()
-        self.conn = self._connect()
-        self._init_tables()
 
+class StorageEngine:
+    """Bounded, thread-safe connection pool shared by every Streamlit session,
+    plus the few dialect hooks Database needs. Subclasses supply the driver.
+
+    Connections are checked out for a single unit of work and returned
+    immediately, so concurrent sessions never share a socket or a transaction.
+    Idle connections are health-checked on checkout and replaced if dead.
+    """
+    dialect = ""
+    Error: tuple = (Exception,)          # driver's base error class(es)
+    disconnect_errors: tuple = ()        # errors that mean "this connection is dead"
+
+    def __init__(self, minconn: int = 1, maxconn: int = 10,
+                 checkout_timeout: float = 30.0, ping_after: float = 30.0):
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.checkout_timeout = checkout_timeout
+        self.ping_after = ping_after          # only ping connections idle longer than this
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._idle: list = []                 # [(conn, released_at_monotonic)]
+        self._in_use = 0
+        self._stats = {
+            "checkouts": 0, "waits": 0, "wait_seconds": 0.0, "timeouts": 0,
+            "created": 0, "replaced": 0, "peak_in_use": 0,
+        }
+        for _ in range(self.minconn):
+            self._idle.append((self._new_conn(), time.monotonic()))
+
+    # ── Driver hooks ──
     def _connect(self):
-        conn = psycopg2.connect(self.url)
-        conn.autocommit = False
+        raise NotImplementedError
+
+    def _is_closed(self, conn) -> bool:
+        raise NotImplementedError
+
+    def _in_transaction(self, conn) -> bool:
+        raise NotImplementedError
+
+    def cursor(self, conn, write: bool = True):
+        """Cursor for one transaction; `write=False` declares it read-only."""
+        return conn.cursor()
+
+    # ── Dialect hooks ──
+    def advisory_xact_lock(self, cur, key: int):
+        """Block until this transaction holds the cross-process lock `key`."""
+        raise NotImplementedError
+
+    def try_advisory_xact_lock(self, cur, key: int) -> bool:
+        """Take the cross-process lock `key` for this transaction if it is free."""
+        raise NotImplementedError
+
+    def add_column(self, cur, table: str, column: str, ddl: str):
+        """Add `column` (typed by `ddl`) to `table` unless it already exists."""
+        raise NotImplementedError
+
+    # ── Pool ──
+    def _new_conn(self):
+        conn = self._connect()
+        with self._lock:
+            self._stats["created"] += 1
         return conn
 
-    def _execute(self, sql: str, params=None):
-        """Execute with auto-reconnect and transaction-error recovery."""
+    def _is_healthy(self, conn, idle_for: float) -> bool:
+        if self._is_closed(conn):
+            return False
+        if idle_for < self.ping_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def checkout(self):
+        """Borrow a healthy connection. Blocks while the pool is saturated."""
+        started = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["waits"] += 1
+            if not self._slots.acquire(timeout=self.checkout_timeout):
+                with self._lock:
+                    self._stats["timeouts"] += 1
+                raise StoragePoolExhausted(
+                    f"connection pool exhausted ({self.maxconn} in use for {self.checkout_timeout:.0f}s)"
+                )
         try:
-            cur = self.conn.cursor()
-            cur.execute(sql, params or ())
-            return cur
-        except (psycopg2.OperationalError, psycopg2.InterfaceError):
-            # Stale connection — reconnect and retry
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    conn = self._new_conn()
+                    break
+                conn, released_at = item
+                if self._is_healthy(conn, time.monotonic() - released_at):
+                    break
+                # Dead or stale socket — drop it and try the next idle one
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                with self._lock:
+                    self._stats["replaced"] += 1
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+            self._stats["checkouts"] += 1
+            self._stats["wait_seconds"] += time.monotonic() - started
+            self._stats["peak_in_use"] = max(self._stats["peak_in_use"], self._in_use)
+        return conn
+
+    def release(self, conn, broken: bool = False):
+        """Return a connection to the pool (closing it if it is unusable)."""
+        if not broken and not self._is_closed(conn):
             try:
-                self.conn.rollback()
+                if self._in_transaction(conn):
+                    conn.rollback()
             except Exception:
-                pass
-            self.conn = self._connect()
-            cur = self.conn.cursor()
-            cur.execute(sql, params or ())
-            return cur
-        except psycopg2.Error:
-            # Transaction aborted — roll back so the connection is usable again
+                broken = True
+        closed = self._is_closed(conn)
+        with self._lock:
+            self._in_use = max(0, self._in_use - 1)
+            if broken or closed:
+                self._stats["replaced"] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+        if broken and not closed:
             try:
-                self.conn.rollback()
+                conn.close()
             except Exception:
                 pass
-            raise
+        self._slots.release()
+
+    def stats(self) -> dict:
+        """Snapshot of pool usage for the admin dashboard / logs."""
+        with self._lock:
+            snap = dict(self._stats)
+            snap.update({
+                "engine": self.dialect, "in_use": self._in_use, "idle": len(self._idle),
+                "max": self.maxconn, "saturation": self._in_use / self.maxconn,
+            })
+        return snap
 
-    def _exec_ddl(self, sql: str):
-        """Run a single DDL statement in its own isolated transaction.
-        If it fails (e.g. object already exists in a different form), roll back
-        cleanly so the connection stays usable for the next statement."""
-        try:
-            cur = self.conn.cursor()
-            cur.execute(sql)
-            self.conn.commit()
-        except psycopg2.Error as e:
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
             try:
-                self.conn.rollback()
+                conn.close()
             except Exception:
                 pass
-            logger.warning(f"DDL skipped (non-fatal): {e!s:.120}")
 
-    def _init_tables(self):
-        # Each statement runs in its own transaction so one failure never
-        # poisons subsequent DDL (PostgreSQL aborts the whole txn on error).
-        ddl_statements = [
-            """CREATE TABLE IF NOT EXISTS kv_store (
-                key TEXT PRIMARY KEY,
-                value TEXT NOT NULL DEFAULT '[]'
-            )""",
-            """CREATE TABLE IF NOT EXISTS users (
-                user_id TEXT PRIMARY KEY,
-                username TEXT UNIQUE NOT NULL,
-                email TEXT DEFAULT '',
-                password_hash TEXT NOT NULL,
-                firm_name TEXT DEFAULT '',
-                lawyer_name TEXT DEFAULT '',
-                phone TEXT DEFAULT '',
-                address TEXT DEFAULT '',
-                role TEXT DEFAULT 'user',
-                created_at TEXT DEFAULT '',
-                last_login TEXT DEFAULT ''
-            )""",
-            """CREATE TABLE IF NOT EXISTS user_profile (
-                id INTEGER PRIMARY KEY CHECK (id = 1),
-                firm_name TEXT DEFAULT '',
-                lawyer_name TEXT DEFAULT '',
-                email TEXT DEFAULT '',
-                phone TEXT DEFAULT '',
-                address TEXT DEFAULT '',
-                password_hash TEXT DEFAULT ''
-            )""",
-            """CREATE TABLE IF NOT EXISTS cost_logs (
-                id TEXT PRIMARY KEY,
-                timestamp TEXT,
-                model TEXT,
-                task TEXT,
-                mode TEXT,
-                input_chars INTEGER DEFAULT 0,
-                output_chars INTEGER DEFAULT 0,
-                estimated_cost REAL DEFAULT 0,
-                query_preview TEXT DEFAULT '',
-                user_id TEXT DEFAULT 'legacy'
-            )""",
-            """CREATE TABLE IF NOT EXISTS case_analyses (
-                id TEXT PRIMARY KEY,
-                case_id TEXT NOT NULL,
-                query TEXT,
-                response TEXT,
-                task TEXT,
-                mode TEXT,
-                timestamp TEXT,
-                user_id TEXT DEFAULT 'legacy'
-            )""",
-            """CREATE TABLE IF NOT EXISTS user_sessions (
-                token TEXT PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                expires_at TEXT NOT NULL,
-                last_used TEXT DEFAULT '',
-                device_hint TEXT DEFAULT ''
-            )""",
-        ]
-        for stmt in ddl_statements:
-            self._exec_ddl(stmt)
 
-        # Safely add columns to existing tables — each in its own transaction
-        for tbl in ("cost_logs", "case_analyses"):
-            self._exec_ddl(
-                f"ALTER TABLE {tbl} ADD COLUMN IF NOT EXISTS user_id TEXT DEFAULT 'legacy'"
-            )
+class PostgresEngine(StorageEngine):
+    """psycopg2 connections to a (usually hosted) PostgreSQL server."""
+    dialect = "postgresql"
+
+    def __init__(self, url: str, **pool_kw):
+        if psycopg2 is None:
+            raise RuntimeError("PostgreSQL URL configured but psycopg2 is not installed")
+        self.url = url
+        self.Error = (psycopg2.Error,)
+        self.disconnect_errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+        super().__init__(**pool_kw)
+
+    def _connect(self):
+        conn = psycopg2.connect(self.url)
+        conn.autocommit = False
+        return conn
+
+    def _is_closed(self, conn) -> bool:
+        return bool(conn.closed)
+
+    def _in_transaction(self, conn) -> bool:
+        return conn.get_transaction_status() != pg_extensions.TRANSACTION_STATUS_IDLE
+
+    def advisory_xact_lock(self, cur, key: int):
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (key,))
+
+    def try_advisory_xact_lock(self, cur, key: int) -> bool:
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (key,))
+        return bool(cur.fetchone()[0])
+
+    def add_column(self, cur, table: str, column: str, ddl: str):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {ddl}")
+
+
+class _SQLiteCursor:
+    """DB-API cursor adapter that accepts the psycopg2-style SQL Database emits:
+    `%s` placeholders, `%%` escapes and `= ANY(%s)` list membership. It also
+    opens the transaction itself — IMMEDIATE for a write transaction or when
+    the first statement writes, so concurrent writers queue on busy_timeout.
+    A deferred transaction that reads first and writes later would instead
+    fail at once with SQLITE_BUSY, so only read-only ones are deferred."""
+    _TOKEN = re.compile(r"=\s*ANY\(%s\)|%s|%%")
+    _WRITE = re.compile(r"^\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|ALTER|DROP)\b", re.IGNORECASE)
+
+    def __init__(self, conn, write: bool = True):
+        self._conn = conn
+        self._cur = conn.cursor()
+        self._write = write
+
+    def begin(self, write: bool = False):
+        """Open the transaction now if it is not open yet."""
+        if not self._conn.in_transaction:
+            self._cur.execute("BEGIN IMMEDIATE" if write or self._write else "BEGIN")
+
+    @classmethod
+    def translate(cls, sql: str, params) -> tuple:
+        if not params:
+            return sql, ()
+        params = list(params)
+        out: list = []
+        pos = 0
+
+        def _sub(m):
+            nonlocal pos
+            tok = m.group(0)
+            if tok == "%%":
+                return "%"
+            value = params[pos]
+            pos += 1
+            if tok == "%s":
+                out.append(value)
+                return "?"
+            values = list(value)            # = ANY(%s) → IN (?, ?, …)
+            out.extend(values)
+            return f"IN ({', '.join('?' * len(values))})" if values else "IN (NULL)"
+
+        return cls._TOKEN.sub(_sub, sql), tuple(out)
+
+    def execute(self, sql: str, params=None):
+        sql, args = self.translate(sql, params)
+        self.begin(bool(self._WRITE.match(sql)))
+        self._cur.execute(sql, args)
+        return self
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+
+class SQLiteEngine(StorageEngine):
+    """Embedded SQLite in WAL mode for single-office / offline installs and for
+    hermetic tests and benchmarks (`sqlite:///:memory:`). WAL lets readers run
+    alongside the single writer; an in-memory database uses one shared connection."""
+    dialect = "sqlite"
+    Error = (sqlite3.Error,)
+    disconnect_errors = ()
+
+    def __init__(self, path: str, busy_timeout: float = 10.0, **pool_kw):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.memory = path in ("", ":memory:")
+        if self.memory:
+            pool_kw.update(minconn=1, maxconn=1)   # one connection == one database
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        super().__init__(**pool_kw)
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            ":memory:" if self.memory else self.path,
+            timeout=self.busy_timeout, isolation_level=None, check_same_thread=False,
+        )
+        if not self.memory:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _is_closed(self, conn) -> bool:
+        try:
+            conn.total_changes
+            return False
+        except sqlite3.ProgrammingError:
+            return True
+
+    def _in_transaction(self, conn) -> bool:
+        return conn.in_transaction
+
+    def cursor(self, conn, write: bool = True):
+        return _SQLiteCursor(conn, write)
 
-        # Ensure legacy profile row exists
-        self._exec_ddl(
-            "INSERT INTO user_profile (id) VALUES (1) ON CONFLICT DO NOTHING"
+    def advisory_xact_lock(self, cur, key: int):
+        cur.begin(write=True)  # an IMMEDIATE transaction excludes every other writer
+
+    def try_advisory_xact_lock(self, cur, key: int) -> bool:
+        try:
+            cur.begin(write=True)
+        except sqlite3.OperationalError:
+            return False  # another writer held the database past busy_timeout
+        return True
+
+    def add_column(self, cur, table: str, column: str, ddl: str):
+        cur.execute(f"PRAGMA table_info({table})")
+        if column not in {r[1] for r in cur.fetchall()}:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def open_storage_engine(url: str) -> StorageEngine:
+    """Pick the storage engine from the URL scheme:
+    postgresql://… → PostgresEngine · sqlite:///path.db (or sqlite:///:memory:) → SQLiteEngine."""
+    minconn, maxconn = _get_db_pool_bounds()
+    if url.startswith("sqlite:"):
+        return SQLiteEngine(url.split(":///", 1)[-1] if ":///" in url else ":memory:",
+                            minconn=minconn, maxconn=maxconn)
+    if url.startswith(("postgresql://", "postgres://")):
+        return PostgresEngine(url, minconn=minconn, maxconn=maxconn)
+    raise ValueError(f"Unsupported DATABASE_URL scheme: {url.split(':', 1)[0]}")
+
+
+class _Rows:
+    """Materialised statement result. The connection that produced it is already
+    back in the pool, so rows are fetched eagerly and served from memory."""
+    __slots__ = ("rows", "rowcount")
+
+    def __init__(self, rows: list, rowcount: int):
+        self.rows = rows
+        self.rowcount = rowcount
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self) -> list:
+        return list(self.rows)
+
+
+class TTLCache:
+    """Bounded, thread-safe LRU cache whose entries also expire after `ttl`
+    seconds. Values are deep-copied in and out so callers can mutate what
+    they get back without corrupting the cached copy."""
+
+    def __init__(self, maxsize: int = 512, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(item[1])
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, copy.deepcopy(value))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """Drop every entry for which predicate(key, value) is true."""
+        with self._lock:
+            for key in [k for k, (_, v) in self._data.items() if predicate(k, v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+# ═══════════════════════════════════════════════════════
+# DATABASE LAYER
+# ═══════════════════════════════════════════════════════
+# Collections stored one row per record rather than as a single kv blob
+RECORD_KINDS = ("cases", "clients", "time_entries", "invoices", "chat_history")
+# Small per-user lists still kept as one kv_store row each
+USER_LIST_KEYS = ("custom_templates", "custom_limitation_periods", "custom_maxims")
+
+# Ordered schema migrations: (version, description, steps). A step is a SQL
+# string or a callable(db, cursor). Steps run once and are recorded in
+# schema_version — never edit a shipped step, append a new one instead.
+SCHEMA_LOCK_ID = 724_110_001  # advisory lock key shared by all replicas
+MAINTENANCE_LOCK_ID = 724_110_002  # guards claiming a maintenance job run
+
+# Read-through caches in front of the hot auth lookups. Writes made through
+# this process invalidate immediately; the TTL bounds staleness from writes
+# made by other replicas (e.g. a session revoked elsewhere).
+USER_CACHE_TTL = 120.0
+SESSION_CACHE_TTL = 60.0
+# A session's last_used is written at most this often (seconds), off the request path
+SESSION_TOUCH_INTERVAL = 300.0
+SCHEMA_MIGRATIONS = [
+    (1, "baseline tables", [
+        """CREATE TABLE IF NOT EXISTS kv_store (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL DEFAULT '[]'
+        )""",
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT DEFAULT '',
+            password_hash TEXT NOT NULL,
+            firm_name TEXT DEFAULT '',
+            lawyer_name TEXT DEFAULT '',
+            phone TEXT DEFAULT '',
+            address TEXT DEFAULT '',
+            role TEXT DEFAULT 'user',
+            created_at TEXT DEFAULT '',
+            last_login TEXT DEFAULT ''
+        )""",
+        """CREATE TABLE IF NOT EXISTS user_profile (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            firm_name TEXT DEFAULT '',
+            lawyer_name TEXT DEFAULT '',
+            email TEXT DEFAULT '',
+            phone TEXT DEFAULT '',
+            address TEXT DEFAULT '',
+            password_hash TEXT DEFAULT ''
+        )""",
+        """CREATE TABLE IF NOT EXISTS cost_logs (
+            id TEXT PRIMARY KEY,
+            timestamp TEXT,
+            model TEXT,
+            task TEXT,
+            mode TEXT,
+            input_chars INTEGER DEFAULT 0,
+            output_chars INTEGER DEFAULT 0,
+            estimated_cost REAL DEFAULT 0,
+            query_preview TEXT DEFAULT '',
+            user_id TEXT DEFAULT 'legacy'
+        )""",
+        """CREATE TABLE IF NOT EXISTS case_analyses (
+            id TEXT PRIMARY KEY,
+            case_id TEXT NOT NULL,
+            query TEXT,
+            response TEXT,
+            task TEXT,
+            mode TEXT,
+            timestamp TEXT,
+            user_id TEXT DEFAULT 'legacy'
+        )""",
+        """CREATE TABLE IF NOT EXISTS user_sessions (
+            token TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL,
+            last_used TEXT DEFAULT '',
+            device_hint TEXT DEFAULT ''
+        )""",
+        # Pre-multi-user databases created these tables without user_id
+        lambda db, cur: db.engine.add_column(cur, "cost_logs", "user_id", "TEXT DEFAULT 'legacy'"),
+        lambda db, cur: db.engine.add_column(cur, "case_analyses", "user_id", "TEXT DEFAULT 'legacy'"),
+        "INSERT INTO user_profile (id) VALUES (1) ON CONFLICT DO NOTHING",
+    ]),
+    # One row per record, keyed by (user_id, id); `seq` preserves list order
+    (2, "per-record tables", [
+        f"""CREATE TABLE IF NOT EXISTS {kind} (
+            user_id TEXT NOT NULL,
+            id TEXT NOT NULL,
+            seq BIGINT NOT NULL DEFAULT 0,
+            data TEXT NOT NULL DEFAULT '{{}}',
+            updated_at TEXT DEFAULT '',
+            PRIMARY KEY (user_id, id)
+        )"""
+        for kind in RECORD_KINDS
+    ]),
+    (3, "move kv list blobs into per-record tables", [
+        lambda db, cur: db._migrate_kv_records(cur),
+    ]),
+    (4, "hot-path indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_cost_logs_user_ts ON cost_logs (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_case_analyses_user_case_ts "
+        "ON case_analyses (user_id, case_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_user_sessions_user_expires "
+        "ON user_sessions (user_id, expires_at)",
+    ]),
+    # Maintained incrementally by Database.add_cost_log; backfilled from cost_logs
+    (5, "daily cost rollup", [
+        """CREATE TABLE IF NOT EXISTS cost_daily_rollup (
+            user_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            model TEXT NOT NULL DEFAULT '',
+            task TEXT NOT NULL DEFAULT '',
+            calls INTEGER NOT NULL DEFAULT 0,
+            cost DOUBLE PRECISION NOT NULL DEFAULT 0,
+            input_chars BIGINT NOT NULL DEFAULT 0,
+            output_chars BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, model, task)
+        )""",
+        """INSERT INTO cost_daily_rollup
+            (user_id, day, model, task, calls, cost, input_chars, output_chars)
+        SELECT COALESCE(user_id, 'legacy'), SUBSTR(timestamp, 1, 10),
+               COALESCE(model, ''), COALESCE(task, ''), COUNT(*),
+               COALESCE(SUM(estimated_cost), 0), COALESCE(SUM(input_chars), 0),
+               COALESCE(SUM(output_chars), 0)
+        FROM cost_logs WHERE timestamp IS NOT NULL
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT (user_id, day, model, task) DO NOTHING""",
+    ]),
+    (6, "maintenance job bookkeeping", [
+        """CREATE TABLE IF NOT EXISTS maintenance_runs (
+            job TEXT PRIMARY KEY,
+            last_run TEXT NOT NULL,
+            last_result TEXT NOT NULL DEFAULT ''
+        )""",
+    ]),
+    (7, "LLM response cache", [
+        """CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL DEFAULT '',
+            task TEXT NOT NULL DEFAULT '',
+            response TEXT NOT NULL,
+            input_chars INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_llm_cache_expires ON llm_cache (expires_at)",
+        lambda db, cur: db.engine.add_column(cur, "cost_logs", "cache_hit",
+                                             "INTEGER NOT NULL DEFAULT 0"),
+        lambda db, cur: db.engine.add_column(cur, "cost_logs", "saved_cost",
+                                             "DOUBLE PRECISION NOT NULL DEFAULT 0"),
+        lambda db, cur: db.engine.add_column(cur, "cost_daily_rollup", "cache_hits",
+                                             "INTEGER NOT NULL DEFAULT 0"),
+        lambda db, cur: db.engine.add_column(cur, "cost_daily_rollup", "saved_cost",
+                                             "DOUBLE PRECISION NOT NULL DEFAULT 0"),
+    ]),
+    (8, "background generation jobs", [
+        """CREATE TABLE IF NOT EXISTS generation_jobs (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            task TEXT NOT NULL DEFAULT '',
+            mode TEXT NOT NULL DEFAULT '',
+            model TEXT NOT NULL DEFAULT '',
+            query TEXT NOT NULL DEFAULT '',
+            output TEXT NOT NULL DEFAULT '',
+            error TEXT NOT NULL DEFAULT '',
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            delivered INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_generation_jobs_user_status "
+        "ON generation_jobs (user_id, status)",
+    ]),
+    (9, "token usage columns", [
+        lambda db, cur: db.engine.add_column(cur, "cost_logs", "prompt_tokens",
+                                             "INTEGER NOT NULL DEFAULT 0"),
+        lambda db, cur: db.engine.add_column(cur, "cost_logs", "output_tokens",
+                                             "INTEGER NOT NULL DEFAULT 0"),
+        lambda db, cur: db.engine.add_column(cur, "cost_logs", "thinking_tokens",
+                                             "INTEGER NOT NULL DEFAULT 0"),
+        lambda db, cur: db.engine.add_column(cur, "cost_logs", "cached_tokens",
+                                             "INTEGER NOT NULL DEFAULT 0"),
+        lambda db, cur: db.engine.add_column(cur, "cost_daily_rollup", "prompt_tokens",
+                                             "BIGINT NOT NULL DEFAULT 0"),
+        lambda db, cur: db.engine.add_column(cur, "cost_daily_rollup", "output_tokens",
+                                             "BIGINT NOT NULL DEFAULT 0"),
+    ]),
+    (10, "continuation segment counts", [
+        lambda db, cur: db.engine.add_column(cur, "cost_logs", "segments",
+                                             "INTEGER NOT NULL DEFAULT 1"),
+    ]),
+]
+
+
+class Database:
+    """Persistence for all LexiAssist data, on PostgreSQL or embedded SQLite.
+
+    SQL is written once in the PostgreSQL dialect; the StorageEngine chosen
+    from the URL scheme supplies connections and adapts it where needed.
+    """
+
+    def __init__(self, url: str = ""):
+        self.url = url or _get_db_url()
+        self.engine = open_storage_engine(self.url)
+        self._user_cache = TTLCache(maxsize=1024, ttl=USER_CACHE_TTL)
+        self._session_cache = TTLCache(maxsize=4096, ttl=SESSION_CACHE_TTL)
+        self._session_touches: dict = {}   # token -> last_used still to be written
+        self._session_touched: dict = {}   # token -> monotonic time of last recorded touch
+        self._touch_lock = threading.Lock()
+        self._touch_timer: Optional[threading.Timer] = None
+        self._init_tables()
+
+    @contextmanager
+    def _transaction(self, write: bool = True):
+        """Check out a pooled connection for one unit of work.
+        Commits on success, rolls back on error, and always hands the
+        connection back — a failure in one session never touches another's.
+        Pass `write=False` only for work that never writes (see _SQLiteCursor)."""
+        conn = self.engine.checkout()
+        broken = False
+        try:
+            yield self.engine.cursor(conn, write)
+            conn.commit()
+        except BaseException as e:
+            broken = isinstance(e, self.engine.disconnect_errors)
+            if not broken:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            raise
+        finally:
+            self.engine.release(conn, broken=broken)
+
+    def _execute(self, sql: str, params=None) -> _Rows:
+        """Run one statement in its own transaction; retry once on a dropped connection."""
+        for attempt in range(2):
+            try:
+                # A single statement's transaction type follows from the statement itself
+                with self._transaction(write=False) as cur:
+                    cur.execute(sql, params or ())
+                    rows = cur.fetchall() if cur.description else []
+                    return _Rows(rows, cur.rowcount)
+            except self.engine.disconnect_errors:
+                if attempt == 1:
+                    raise
+
+    def pool_stats(self) -> dict:
+        return self.engine.stats()
+
+    # ── Schema migrations ──
+    def _schema_version(self) -> int:
+        try:
+            row = self._execute("SELECT MAX(version) FROM schema_version").fetchone()
+            return (row[0] or 0) if row else 0
+        except self.engine.Error:
+            return 0  # schema_version table does not exist yet
+
+    def _init_tables(self):
+        """Bring the schema up to date. Fast path: a single version check."""
+        if self._schema_version() >= SCHEMA_MIGRATIONS[-1][0]:
+            return
+        for version, description, steps in SCHEMA_MIGRATIONS:
+            # Each step is its own transaction, serialised across replicas by an
+            # advisory lock and re-checked under it so it is applied exactly once.
+            with self._transaction() as cur:
+                cur.execute(
+                    "CREATE TABLE IF NOT EXISTS schema_version ("
+                    "version INTEGER PRIMARY KEY, description TEXT, applied_at TEXT)"
+                )
+                self.engine.advisory_xact_lock(cur, SCHEMA_LOCK_ID)
+                cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+                if cur.fetchone()[0] >= version:
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(self, cur)
+                    else:
+                        cur.execute(step)
+                cur.execute(
+                    "INSERT INTO schema_version (version, description, applied_at) "
+                    "VALUES (%s, %s, %s)",
+                    (version, description, datetime.now().isoformat()),
+                )
+            logger.info(f"Schema migrated to v{version}: {description}")
+
+    def _migrate_kv_records(self, cur):
+        """Move whole-list `u:{uid}:{kind}` kv blobs into the per-record tables."""
+        patterns = [f"u:%:{kind}" for kind in RECORD_KINDS]
+        cur.execute(
+            "SELECT key, value FROM kv_store WHERE "
+            + " OR ".join(["key LIKE %s"] * len(patterns)),
+            patterns,
         )
+        blobs = cur.fetchall()
+        for key, value in blobs:
+            _, uid, kind = key.split(":", 2)
+            if kind not in RECORD_KINDS:
+                continue
+            try:
+                records = json.loads(value) or []
+            except Exception:
+                records = []
+            self._write_records(cur, uid, kind, records, on_conflict="NOTHING")
+            cur.execute("DELETE FROM kv_store WHERE key = %s", (key,))
+        if blobs:
+            logger.info(f"Migrated {len(blobs)} kv list(s) to per-record tables")
 
     def _uid(self) -> str:
         """Return current user_id from Streamlit session, fallback to 'legacy'."""
@@ -2930,7 +3634,6 @@ class Database:
             "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
             (key, json.dumps(data, default=str)),
         )
-        self.conn.commit()
 
     def _load_list_raw(self, key: str) -> list:
         cur = self._execute("SELECT value FROM kv_store WHERE key = %s", (key,))
@@ -2953,6 +3656,139 @@ class Database:
         uid = self._uid()
         return self._load_list_raw(f"u:{uid}:{key}")
 
+    def load_many(self, keys, record_kinds=()) -> dict:
+        """Fetch several of the current user's kv lists — and optionally whole
+        per-record collections — in a single round trip. Missing keys map to []."""
+        uid = self._uid()
+        prefix = f"u:{uid}:"
+        selects = ["SELECT 'kv', key, value, 0 FROM kv_store WHERE key = ANY(%s)"]
+        params: list = [[prefix + k for k in keys]]
+        for kind in record_kinds:
+            selects.append(
+                f"SELECT %s, id, data, seq FROM {self._record_table(kind)} WHERE user_id = %s"
+            )
+            params += [kind, uid]
+        rows = self._execute(" UNION ALL ".join(selects) + " ORDER BY 4", params).fetchall()
+        out = {k: [] for k in list(keys) + list(record_kinds)}
+        for source, key, value, _seq in rows:
+            try:
+                parsed = json.loads(value)
+            except Exception:
+                continue
+            if source == "kv":
+                out[key[len(prefix):]] = parsed if isinstance(parsed, list) else []
+            else:
+                out[source].append(parsed)
+        return out
+
+    # ── Per-record tables (cases, clients, time entries, invoices, chat history) ──
+    @staticmethod
+    def _record_table(kind: str) -> str:
+        if kind not in RECORD_KINDS:
+            raise ValueError(f"Unknown record kind: {kind}")
+        return kind
+
+    def _write_records(self, cur, uid: str, kind: str, records: list, on_conflict: str = "UPDATE"):
+        """Upsert `records` for one user inside an open transaction, keeping list order."""
+        table = self._record_table(kind)
+        conflict = (
+            "DO UPDATE SET data = EXCLUDED.data, seq = EXCLUDED.seq, updated_at = EXCLUDED.updated_at"
+            if on_conflict == "UPDATE" else "DO NOTHING"
+        )
+        now = datetime.now().isoformat()
+        base = time.time_ns() // 1000
+        for i, rec in enumerate(records):
+            if not isinstance(rec, dict):
+                continue
+            rec.setdefault("id", new_id())
+            cur.execute(
+                f"INSERT INTO {table} (user_id, id, seq, data, updated_at) "
+                f"VALUES (%s, %s, %s, %s, %s) ON CONFLICT (user_id, id) {conflict}",
+                (uid, str(rec["id"]), base + i, json.dumps(rec, default=str), now),
+            )
+
+    def load_records(self, kind: str) -> list:
+        """All records of `kind` for the current user, in insertion order."""
+        table = self._record_table(kind)
+        cur = self._execute(
+            f"SELECT data FROM {table} WHERE user_id = %s ORDER BY seq", (self._uid(),)
+        )
+        out = []
+        for (data,) in cur.fetchall():
+            try:
+                out.append(json.loads(data))
+            except Exception:
+                pass
+        return out
+
+    def _update_record(self, cur, uid: str, kind: str, record: dict):
+        table = self._record_table(kind)
+        cur.execute(
+            f"UPDATE {table} SET data = %s, updated_at = %s WHERE user_id = %s AND id = %s",
+            (json.dumps(record, default=str), datetime.now().isoformat(),
+             uid, str(record.get("id", ""))),
+        )
+        if cur.rowcount == 0:
+            self._write_records(cur, uid, kind, [record])
+
+    def _delete_records(self, cur, uid: str, kind: str, record_ids: list):
+        table = self._record_table(kind)
+        for rid in record_ids:
+            cur.execute(f"DELETE FROM {table} WHERE user_id = %s AND id = %s", (uid, str(rid)))
+
+    def insert_record(self, kind: str, record: dict):
+        """Append one record (appends to the end of the user's list)."""
+        with self._transaction() as cur:
+            self._write_records(cur, self._uid(), kind, [record])
+
+    def update_record(self, kind: str, record: dict):
+        """Rewrite a single record in place; its list position is unchanged."""
+        with self._transaction() as cur:
+            self._update_record(cur, self._uid(), kind, record)
+
+    def delete_record(self, kind: str, record_id: str):
+        self.delete_records(kind, [record_id])
+
+    def delete_records(self, kind: str, record_ids: list):
+        if not record_ids:
+            return
+        with self._transaction() as cur:
+            self._delete_records(cur, self._uid(), kind, record_ids)
+
+    def replace_records(self, kind: str, records: list):
+        """Replace the user's whole collection (import / restore / reset)."""
+        table = self._record_table(kind)
+        uid = self._uid()
+        with self._transaction() as cur:
+            cur.execute(f"DELETE FROM {table} WHERE user_id = %s", (uid,))
+            self._write_records(cur, uid, kind, records)
+
+    def apply_writes(self, uid: str, ops: list):
+        """Apply a batch of queued writes for one user in a single transaction.
+
+        ops: ("list", key, data) · ("replace", kind, records)
+             ("upsert", kind, record, is_new) · ("delete", kind, record_id)
+        """
+        with self._transaction() as cur:
+            for op in ops:
+                action, kind = op[0], op[1]
+                if action == "list":
+                    cur.execute(
+                        "INSERT INTO kv_store (key, value) VALUES (%s, %s) "
+                        "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+                        (f"u:{uid}:{kind}", json.dumps(op[2], default=str)),
+                    )
+                elif action == "replace":
+                    cur.execute(f"DELETE FROM {self._record_table(kind)} WHERE user_id = %s", (uid,))
+                    self._write_records(cur, uid, kind, op[2])
+                elif action == "upsert":
+                    if op[3]:
+                        self._write_records(cur, uid, kind, [op[2]])
+                    else:
+                        self._update_record(cur, uid, kind, op[2])
+                elif action == "delete":
+                    self._delete_records(cur, uid, kind, [op[2]])
+
     # ── User Profile ──
     def get_profile(self) -> dict:
         """Load current user's profile from users table + extended kv fields."""
@@ -2988,7 +3824,6 @@ class Database:
                     profile.get("address", ""), profile.get("password_hash", ""),
                 ),
             )
-            self.conn.commit()
 
     # ── Users table CRUD ──
     def has_any_users(self) -> bool:
@@ -3014,21 +3849,16 @@ class Database:
                     datetime.now().isoformat(),
                 ),
             )
-            self.conn.commit()
             return True
         except Exception as e:
             logger.error(f"create_user failed: {e}")
-            try:
-                self.conn.rollback()
-            except Exception:
-                pass
             return False
 
-    def get_user_by_username(self, username: str) -> Optional[dict]:
+    def _fetch_user(self, column: str, value: str) -> Optional[dict]:
         cur = self._execute(
             "SELECT user_id, username, email, password_hash, firm_name, lawyer_name, "
-            "phone, address, role, created_at, last_login FROM users WHERE username = %s",
-            (username.lower().strip(),),
+            f"phone, address, role, created_at, last_login FROM users WHERE {column} = %s",
+            (value,),
         )
         row = cur.fetchone()
         if row:
@@ -3040,21 +3870,28 @@ class Database:
             }
         return None
 
+    def _cached_user(self, key: tuple, column: str, value: str) -> Optional[dict]:
+        user = self._user_cache.get(key)
+        if user is None:
+            # Misses are not cached, so a freshly created user is visible at once
+            user = self._fetch_user(column, value)
+            if user:
+                self._user_cache.set(("id", user["user_id"]), user)
+                self._user_cache.set(("name", user["username"]), user)
+        return user
+
+    def get_user_by_username(self, username: str) -> Optional[dict]:
+        username = username.lower().strip()
+        return self._cached_user(("name", username), "username", username)
+
     def get_user_by_id(self, user_id: str) -> Optional[dict]:
-        cur = self._execute(
-            "SELECT user_id, username, email, password_hash, firm_name, lawyer_name, "
-            "phone, address, role, created_at, last_login FROM users WHERE user_id = %s",
-            (user_id,),
+        return self._cached_user(("id", user_id), "user_id", user_id)
+
+    def _invalidate_user(self, user_id: str):
+        """Drop every cached user/profile entry belonging to user_id."""
+        self._user_cache.invalidate_where(
+            lambda k, v: k[1] == user_id or (isinstance(v, dict) and v.get("user_id") == user_id)
         )
-        row = cur.fetchone()
-        if row:
-            return {
-                "user_id": row[0], "username": row[1], "email": row[2],
-                "password_hash": row[3], "firm_name": row[4], "lawyer_name": row[5],
-                "phone": row[6], "address": row[7], "role": row[8],
-                "created_at": row[9], "last_login": row[10],
-            }
-        return None
 
     def list_users(self) -> list:
         cur = self._execute(
@@ -3079,38 +3916,61 @@ class Database:
         if not fields:
             return
         values.append(user_id)
-        self._execute(f"UPDATE users SET {', '.join(fields)} WHERE user_id = %s", values)
-        self.conn.commit()
+        try:
+            self._execute(f"UPDATE users SET {', '.join(fields)} WHERE user_id = %s", values)
+        finally:
+            self._invalidate_user(user_id)
 
     def delete_user(self, user_id: str):
-        self._execute("DELETE FROM users WHERE user_id = %s", (user_id,))
-        self._execute("DELETE FROM case_analyses WHERE user_id = %s", (user_id,))
-        self._execute("DELETE FROM cost_logs WHERE user_id = %s", (user_id,))
-        self._execute("DELETE FROM kv_store WHERE key LIKE %s", (f"u:{user_id}:%",))
-        self._execute("DELETE FROM user_sessions WHERE user_id = %s", (user_id,))
-        self.conn.commit()
+        with self._transaction() as cur:
+            cur.execute("DELETE FROM users WHERE user_id = %s", (user_id,))
+            cur.execute("DELETE FROM case_analyses WHERE user_id = %s", (user_id,))
+            cur.execute("DELETE FROM cost_logs WHERE user_id = %s", (user_id,))
+            cur.execute("DELETE FROM cost_daily_rollup WHERE user_id = %s", (user_id,))
+            cur.execute("DELETE FROM kv_store WHERE key LIKE %s", (f"u:{user_id}:%",))
+            cur.execute("DELETE FROM user_sessions WHERE user_id = %s", (user_id,))
+            cur.execute("DELETE FROM generation_jobs WHERE user_id = %s", (user_id,))
+            for kind in RECORD_KINDS:
+                cur.execute(f"DELETE FROM {kind} WHERE user_id = %s", (user_id,))
+        self._invalidate_user(user_id)
+        self._session_cache.invalidate_where(lambda k, v: v[0] == user_id)
 
     def update_user_last_login(self, user_id: str):
         self.update_user(user_id, {"last_login": datetime.now().isoformat()})
 
     def get_user_profile(self, user_id: str) -> dict:
-        user = self.get_user_by_id(user_id)
+        """Core user fields + extended kv fields (notification settings etc.) in one query."""
+        cached = self._user_cache.get(("profile", user_id))
+        if cached is not None:
+            return cached
+        profile = self._fetch_user_profile(user_id)
+        self._user_cache.set(("profile", user_id), profile)
+        return profile
+
+    def _fetch_user_profile(self, user_id: str) -> dict:
+        ext_key = f"u:{user_id}:profile_extended"
+        row = self._execute(
+            "SELECT u.firm_name, u.lawyer_name, u.email, u.phone, u.address, u.password_hash, k.value "
+            "FROM users u LEFT JOIN kv_store k ON k.key = %s WHERE u.user_id = %s",
+            (ext_key, user_id),
+        ).fetchone()
         base = {
             "firm_name": "", "lawyer_name": "", "email": "",
             "phone": "", "address": "", "password_hash": "",
         }
-        if user:
+        if row:
             base.update({
-                "firm_name": user.get("firm_name", ""),
-                "lawyer_name": user.get("lawyer_name", ""),
-                "email": user.get("email", ""),
-                "phone": user.get("phone", ""),
-                "address": user.get("address", ""),
-                "password_hash": user.get("password_hash", ""),
+                "firm_name": row[0] or "", "lawyer_name": row[1] or "",
+                "email": row[2] or "", "phone": row[3] or "",
+                "address": row[4] or "", "password_hash": row[5] or "",
             })
-        # Merge extended profile fields (notification settings etc.)
-        ext_data = self._load_list_raw(f"u:{user_id}:profile_extended")
-        if ext_data and isinstance(ext_data, list) and ext_data:
+            try:
+                ext_data = json.loads(row[6]) if row[6] else []
+            except Exception:
+                ext_data = []
+        else:
+            ext_data = self._load_list_raw(ext_key)
+        if ext_data and isinstance(ext_data, list):
             base.update(ext_data[0])
         return base
 
@@ -3121,31 +3981,62 @@ class Database:
         # Save extended fields (notifications etc.) separately
         extended = {k: v for k, v in profile.items() if k not in core_fields}
         if extended:
-            self._save_list_raw(f"u:{user_id}:profile_extended", [extended])
+            try:
+                self._save_list_raw(f"u:{user_id}:profile_extended", [extended])
+            finally:
+                self._invalidate_user(user_id)
 
     # ── Cost Logs (user-scoped) ──
+    # Additive counters of a (user, day, model, task) rollup bucket
+    _ROLLUP_SUMS = ("calls", "cost", "input_chars", "output_chars", "cache_hits",
+                    "saved_cost", "prompt_tokens", "output_tokens")
+    # Adds one call's figures (user, day, model, task, *_ROLLUP_SUMS) to its bucket
+    _ROLLUP_UPSERT = (
+        "INSERT INTO cost_daily_rollup (user_id, day, model, task, "
+        + ", ".join(_ROLLUP_SUMS) + ") VALUES ("
+        + ", ".join(["%s"] * (4 + len(_ROLLUP_SUMS))) + ") "
+        "ON CONFLICT (user_id, day, model, task) DO UPDATE SET "
+        + ", ".join(f"{c} = cost_daily_rollup.{c} + EXCLUDED.{c}" for c in _ROLLUP_SUMS)
+    )
+
     def add_cost_log(self, entry: dict):
-        uid = self._uid()
-        self._execute(
-            "INSERT INTO cost_logs "
-            "(id, timestamp, model, task, mode, input_chars, output_chars, "
-            "estimated_cost, query_preview, user_id) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
-            (
-                entry.get("id", uuid.uuid4().hex[:8]),
-                entry.get("timestamp", datetime.now().isoformat()),
-                entry.get("model", ""), entry.get("task", ""), entry.get("mode", ""),
-                entry.get("input_chars", 0), entry.get("output_chars", 0),
-                entry.get("estimated_cost", 0.0), entry.get("query_preview", ""), uid,
-            ),
-        )
-        self.conn.commit()
+        """Insert a call log and fold it into cost_daily_rollup in the same transaction.
+        Cache hits (`cache_hit` set) cost nothing and count towards saved_cost, not calls.
+        Background workers have no session, so they pass `user_id` in the entry."""
+        uid = entry.get("user_id") or self._uid()
+        ts = entry.get("timestamp", datetime.now().isoformat())
+        model, task = entry.get("model", "") or "", entry.get("task", "") or ""
+        cost = entry.get("estimated_cost", 0.0)
+        in_chars, out_chars = entry.get("input_chars", 0), entry.get("output_chars", 0)
+        hit, saved = int(bool(entry.get("cache_hit"))), entry.get("saved_cost", 0.0)
+        tokens = [int(entry.get(k, 0) or 0) for k in
+                  ("prompt_tokens", "output_tokens", "thinking_tokens", "cached_tokens")]
+        with self._transaction() as cur:
+            cur.execute(
+                "INSERT INTO cost_logs "
+                "(id, timestamp, model, task, mode, input_chars, output_chars, "
+                "estimated_cost, query_preview, user_id, cache_hit, saved_cost, "
+                "prompt_tokens, output_tokens, thinking_tokens, cached_tokens, segments) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) "
+                "ON CONFLICT DO NOTHING",
+                (
+                    entry.get("id", uuid.uuid4().hex[:8]), ts,
+                    model, task, entry.get("mode", ""),
+                    in_chars, out_chars, cost, entry.get("query_preview", ""), uid,
+                    hit, saved, *tokens, int(entry.get("segments", 1) or 1),
+                ),
+            )
+            if cur.rowcount:
+                cur.execute(self._ROLLUP_UPSERT,
+                            (uid, ts[:10], model, task, 1 - hit, cost, in_chars, out_chars,
+                             hit, saved, tokens[0], tokens[1] + tokens[2]))
 
     def get_cost_logs(self, limit: int = 200) -> list:
         uid = self._uid()
         cur = self._execute(
             "SELECT id, timestamp, model, task, mode, input_chars, output_chars, "
-            "estimated_cost, query_preview FROM cost_logs "
+            "estimated_cost, query_preview, cache_hit, saved_cost, prompt_tokens, "
+            "output_tokens, thinking_tokens, cached_tokens, segments FROM cost_logs "
             "WHERE user_id = %s ORDER BY timestamp DESC LIMIT %s",
             (uid, limit),
         )
@@ -3155,32 +4046,198 @@ class Database:
                 "id": r[0], "timestamp": r[1], "model": r[2], "task": r[3],
                 "mode": r[4], "input_chars": r[5], "output_chars": r[6],
                 "estimated_cost": r[7], "query_preview": r[8],
+                "cache_hit": bool(r[9]), "saved_cost": r[10],
+                "prompt_tokens": r[11], "output_tokens": r[12],
+                "thinking_tokens": r[13], "cached_tokens": r[14],
+                "segments": r[15],
             }
             for r in rows
         ]
 
-    def get_cost_summary(self) -> dict:
-        uid = self._uid()
+    def get_cost_summary(self, user_id: str = "") -> dict:
+        """All-time / today / this-month totals in one pass over the daily rollup."""
+        uid = user_id or self._uid()
         today = date.today().isoformat()
         month_start = date.today().replace(day=1).isoformat()
-        total = self._execute(
-            "SELECT COALESCE(SUM(estimated_cost),0), COUNT(*) FROM cost_logs WHERE user_id = %s",
-            (uid,)
-        ).fetchone()
-        daily = self._execute(
-            "SELECT COALESCE(SUM(estimated_cost),0), COUNT(*) FROM cost_logs "
-            "WHERE user_id = %s AND timestamp >= %s", (uid, today)
-        ).fetchone()
-        monthly = self._execute(
-            "SELECT COALESCE(SUM(estimated_cost),0), COUNT(*) FROM cost_logs "
-            "WHERE user_id = %s AND timestamp >= %s", (uid, month_start)
-        ).fetchone()
+        row = self._execute(
+            "SELECT COALESCE(SUM(cost),0), COALESCE(SUM(calls),0), "
+            "COALESCE(SUM(cost) FILTER (WHERE day >= %s),0), "
+            "COALESCE(SUM(calls) FILTER (WHERE day >= %s),0), "
+            "COALESCE(SUM(cost) FILTER (WHERE day >= %s),0), "
+            "COALESCE(SUM(calls) FILTER (WHERE day >= %s),0), "
+            "COALESCE(SUM(saved_cost),0), COALESCE(SUM(cache_hits),0), "
+            "COALESCE(SUM(saved_cost) FILTER (WHERE day >= %s),0), "
+            "COALESCE(SUM(cache_hits) FILTER (WHERE day >= %s),0) "
+            "FROM cost_daily_rollup WHERE user_id = %s",
+            (today, today, month_start, month_start, month_start, month_start, uid),
+        ).fetchone() or (0,) * 10
         return {
-            "total_cost": total[0], "total_calls": total[1],
-            "daily_cost": daily[0], "daily_calls": daily[1],
-            "monthly_cost": monthly[0], "monthly_calls": monthly[1],
+            "total_cost": row[0], "total_calls": row[1],
+            "daily_cost": row[2], "daily_calls": row[3],
+            "monthly_cost": row[4], "monthly_calls": row[5],
+            "total_saved": row[6], "total_cache_hits": row[7],
+            "monthly_saved": row[8], "monthly_cache_hits": row[9],
         }
 
+    def get_cost_rollup(self, since: str = "") -> list:
+        """Per-day, per-model, per-task totals for the current user (billing charts)."""
+        cur = self._execute(
+            "SELECT day, model, task, calls, cost, input_chars, output_chars, "
+            "cache_hits, saved_cost, prompt_tokens, output_tokens "
+            "FROM cost_daily_rollup WHERE user_id = %s AND day >= %s ORDER BY day",
+            (self._uid(), since),
+        )
+        return [
+            {
+                "day": r[0], "model": r[1], "task": r[2], "calls": r[3],
+                "cost": r[4], "input_chars": r[5], "output_chars": r[6],
+                "cache_hits": r[7], "saved_cost": r[8],
+                "prompt_tokens": r[9], "output_tokens": r[10],
+            }
+            for r in cur.fetchall()
+        ]
+
+    # ── LLM response cache (shared, content-addressed) ──
+    def get_llm_cache_entry(self, key: str) -> Optional[dict]:
+        row = self._execute(
+            "SELECT response, input_chars, expires_at FROM llm_cache "
+            "WHERE key = %s AND expires_at > %s",
+            (key, datetime.now().isoformat()),
+        ).fetchone()
+        if row:
+            return {"response": row[0], "input_chars": row[1], "expires_at": row[2]}
+        return None
+
+    def put_llm_cache_entry(self, key: str, model: str, task: str, response: str,
+                            input_chars: int, ttl: float):
+        now = datetime.now()
+        self._execute(
+            "INSERT INTO llm_cache (key, model, task, response, input_chars, created_at, expires_at) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s) "
+            "ON CONFLICT (key) DO UPDATE SET response = EXCLUDED.response, "
+            "created_at = EXCLUDED.created_at, expires_at = EXCLUDED.expires_at",
+            (key, model, task, response, input_chars, now.isoformat(),
+             (now + timedelta(seconds=ttl)).isoformat()),
+        )
+
+    def purge_expired_llm_cache(self) -> int:
+        return self._execute(
+            "DELETE FROM llm_cache WHERE expires_at < %s", (datetime.now().isoformat(),)
+        ).rowcount
+
+    # ── Background generation jobs ──
+    _JOB_COLUMNS = ("id", "user_id", "status", "task", "mode", "model", "query", "output",
+                    "error", "cancel_requested", "delivered", "created_at", "updated_at")
+
+    def create_generation_job(self, job: dict, max_active: int) -> bool:
+        """Insert a queued job unless the user already has `max_active` unfinished ones."""
+        with self._transaction() as cur:
+            cur.execute(
+                "SELECT COUNT(*) FROM generation_jobs "
+                "WHERE user_id = %s AND status IN ('queued', 'running')", (job["user_id"],)
+            )
+            if cur.fetchone()[0] >= max_active:
+                return False
+            cols = [c for c in self._JOB_COLUMNS if c in job]
+            cur.execute(
+                f"INSERT INTO generation_jobs ({', '.join(cols)}) "
+                f"VALUES ({', '.join(['%s'] * len(cols))})",
+                tuple(job[c] for c in cols),
+            )
+            return True
+
+    def claim_generation_job(self, job_id: str) -> bool:
+        """Move a queued job to running. Only the first worker to ask gets True;
+        False means the job was already taken, cancelled or expired."""
+        return self._execute(
+            "UPDATE generation_jobs SET status = 'running', updated_at = %s "
+            "WHERE id = %s AND status = 'queued'",
+            (datetime.now().isoformat(), job_id),
+        ).rowcount > 0
+
+    def update_generation_job_output(self, job_id: str, output: str) -> bool:
+        """Store partial output and mark the job running. Returns True if a
+        cancel has been requested (possibly from another device or replica)."""
+        with self._transaction() as cur:
+            cur.execute(
+                "UPDATE generation_jobs SET output = %s, status = 'running', updated_at = %s "
+                "WHERE id = %s AND status IN ('queued', 'running')",
+                (output, datetime.now().isoformat(), job_id),
+            )
+            cur.execute("SELECT cancel_requested FROM generation_jobs WHERE id = %s", (job_id,))
+            row = cur.fetchone()
+        return bool(row and row[0])
+
+    def finish_generation_job(self, job_id: str, status: str, output: Optional[str] = None,
+                              error: str = ""):
+        """Record a job's final state. A job already finished (e.g. expired as
+        stale) keeps that state."""
+        if output is None:
+            self._execute(
+                "UPDATE generation_jobs SET status = %s, error = %s, updated_at = %s "
+                "WHERE id = %s AND status IN ('queued', 'running')",
+                (status, error[:500], datetime.now().isoformat(), job_id),
+            )
+        else:
+            self._execute(
+                "UPDATE generation_jobs SET status = %s, output = %s, error = %s, updated_at = %s "
+                "WHERE id = %s AND status IN ('queued', 'running')",
+                (status, output, error[:500], datetime.now().isoformat(), job_id),
+            )
+
+    def request_generation_job_cancel(self, job_id: str, user_id: str) -> bool:
+        return self._execute(
+            "UPDATE generation_jobs SET cancel_requested = 1 "
+            "WHERE id = %s AND user_id = %s AND status IN ('queued', 'running')",
+            (job_id, user_id),
+        ).rowcount > 0
+
+    def get_generation_jobs(self, user_id: str) -> list:
+        """Unfinished jobs plus finished ones no session has picked up yet, newest first."""
+        rows = self._execute(
+            f"SELECT {', '.join(self._JOB_COLUMNS)} FROM generation_jobs "
+            "WHERE user_id = %s AND (status IN ('queued', 'running') OR delivered = 0) "
+            "ORDER BY created_at DESC",
+            (user_id,),
+        ).fetchall()
+        return [dict(zip(self._JOB_COLUMNS, r)) for r in rows]
+
+    def mark_generation_job_delivered(self, job_id: str) -> bool:
+        """Claim a finished job's result. Only the first session to ask gets True."""
+        return self._execute(
+            "UPDATE generation_jobs SET delivered = 1 "
+            "WHERE id = %s AND delivered = 0 AND status NOT IN ('queued', 'running')",
+            (job_id,),
+        ).rowcount > 0
+
+    def expire_generation_jobs(self, stale_seconds: float, queued_seconds: float,
+                               keep_days: int) -> tuple:
+        """Fail running jobs whose worker stopped reporting for `stale_seconds`
+        and queued jobs no worker picked up within `queued_seconds` (process
+        restart), and drop delivered jobs older than `keep_days`.
+        Returns (failed, purged)."""
+        now = datetime.now()
+        with self._transaction() as cur:
+            cur.execute(
+                "UPDATE generation_jobs SET status = 'failed', "
+                "error = 'Interrupted — the server restarted while this was running', "
+                "updated_at = %s WHERE status = 'running' AND updated_at < %s",
+                (now.isoformat(), (now - timedelta(seconds=stale_seconds)).isoformat()),
+            )
+            failed = cur.rowcount
+            cur.execute(
+                "UPDATE generation_jobs SET status = 'failed', "
+                "error = 'Interrupted — the server restarted before this started', "
+                "updated_at = %s WHERE status = 'queued' AND updated_at < %s",
+                (now.isoformat(), (now - timedelta(seconds=queued_seconds)).isoformat()),
+            )
+            failed += cur.rowcount
+            cur.execute(
+                "DELETE FROM generation_jobs WHERE delivered = 1 AND updated_at < %s",
+                ((now - timedelta(days=keep_days)).isoformat(),),
+            )
+            return failed, cur.rowcount
+
     # ── Case Analyses (user-scoped) ──
     def add_case_analysis(self, case_id: str, data: dict):
         uid = self._uid()
@@ -3194,15 +4251,28 @@ class Database:
                 data.get("timestamp", datetime.now().isoformat()), uid,
             ),
         )
-        self.conn.commit()
 
-    def get_case_analyses(self, case_id: str) -> list:
-        uid = self._uid()
+    def get_case_analysis_stats(self) -> dict:
+        """{case_id: {"count", "latest"}} for all of the user's cases in one grouped query."""
         cur = self._execute(
+            "SELECT case_id, COUNT(*), MAX(timestamp) FROM case_analyses "
+            "WHERE user_id = %s GROUP BY case_id",
+            (self._uid(),),
+        )
+        return {r[0]: {"count": r[1], "latest": r[2] or ""} for r in cur.fetchall()}
+
+    def get_case_analyses(self, case_id: str, limit: Optional[int] = None, offset: int = 0) -> list:
+        """Saved analyses for one case, newest first. Pass `limit` to page through them."""
+        uid = self._uid()
+        sql = (
             "SELECT id, query, response, task, mode, timestamp FROM case_analyses "
-            "WHERE case_id = %s AND user_id = %s ORDER BY timestamp DESC",
-            (case_id, uid),
+            "WHERE case_id = %s AND user_id = %s ORDER BY timestamp DESC"
         )
+        params: list = [case_id, uid]
+        if limit is not None:
+            sql += " LIMIT %s OFFSET %s"
+            params += [limit, offset]
+        cur = self._execute(sql, params)
         rows = cur.fetchall()
         return [
             {
@@ -3214,7 +4284,6 @@ class Database:
 
     def delete_case_analysis(self, analysis_id: str):
         self._execute("DELETE FROM case_analyses WHERE id = %s", (analysis_id,))
-        self.conn.commit()
 
     def delete_case_analyses_for_case(self, case_id: str):
         uid = self._uid()
@@ -3222,7 +4291,6 @@ class Database:
             "DELETE FROM case_analyses WHERE case_id = %s AND user_id = %s",
             (case_id, uid)
         )
-        self.conn.commit()
 
     # ── Lifecycle (user-scoped via namespaced kv) ──
     def save_lifecycle(self, case_id: str, data: dict):
@@ -3260,39 +4328,52 @@ class Database:
         migrated = 0
         legacy_keys = ["cases", "clients", "time_entries", "invoices", "chat_history",
                        "custom_templates", "custom_limitation_periods", "custom_maxims"]
-        for key in legacy_keys:
-            cur = self._execute("SELECT value FROM kv_store WHERE key = %s", (key,))
-            row = cur.fetchone()
-            if row and row[0] and row[0] != "[]":
-                namespaced = f"u:{user_id}:{key}"
-                self._execute(
-                    "INSERT INTO kv_store (key, value) VALUES (%s, %s) "
-                    "ON CONFLICT (key) DO NOTHING",
-                    (namespaced, row[0]),
+        with self._transaction() as cur:
+            for key in legacy_keys:
+                cur.execute("SELECT value FROM kv_store WHERE key = %s", (key,))
+                row = cur.fetchone()
+                if row and row[0] and row[0] != "[]":
+                    if key in RECORD_KINDS:
+                        try:
+                            records = json.loads(row[0]) or []
+                        except Exception:
+                            records = []
+                        self._write_records(cur, user_id, key, records, on_conflict="NOTHING")
+                        migrated += 1
+                        continue
+                    namespaced = f"u:{user_id}:{key}"
+                    cur.execute(
+                        "INSERT INTO kv_store (key, value) VALUES (%s, %s) "
+                        "ON CONFLICT (key) DO NOTHING",
+                        (namespaced, row[0]),
+                    )
+                    migrated += 1
+            # Migrate lifecycle keys
+            cur.execute("SELECT key, value FROM kv_store WHERE key LIKE 'lifecycle_%'")
+            for lkey, lval in (cur.fetchall() or []):
+                nkey = f"u:{user_id}:{lkey}"
+                cur.execute(
+                    "INSERT INTO kv_store (key, value) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                    (nkey, lval),
                 )
                 migrated += 1
-        # Migrate lifecycle keys
-        cur2 = self._execute(
-            "SELECT key, value FROM kv_store WHERE key LIKE 'lifecycle_%'"
-        )
-        for lkey, lval in (cur2.fetchall() or []):
-            nkey = f"u:{user_id}:{lkey}"
-            self._execute(
-                "INSERT INTO kv_store (key, value) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                (nkey, lval),
+            # Migrate case analyses
+            cur.execute(
+                "UPDATE case_analyses SET user_id = %s WHERE user_id IN ('legacy', '') OR user_id IS NULL",
+                (user_id,)
             )
-            migrated += 1
-        # Migrate case analyses
-        self._execute(
-            "UPDATE case_analyses SET user_id = %s WHERE user_id IN ('legacy', '') OR user_id IS NULL",
-            (user_id,)
-        )
-        # Migrate cost logs
-        self._execute(
-            "UPDATE cost_logs SET user_id = %s WHERE user_id IN ('legacy', '') OR user_id IS NULL",
-            (user_id,)
-        )
-        self.conn.commit()
+            # Migrate cost logs (and their rollup buckets)
+            cur.execute(
+                "UPDATE cost_logs SET user_id = %s WHERE user_id IN ('legacy', '') OR user_id IS NULL",
+                (user_id,)
+            )
+            cur.execute(
+                f"SELECT day, model, task, {', '.join(self._ROLLUP_SUMS)} "
+                "FROM cost_daily_rollup WHERE user_id IN ('legacy', '')"
+            )
+            for row in cur.fetchall():
+                cur.execute(self._ROLLUP_UPSERT, (user_id,) + tuple(row))
+            cur.execute("DELETE FROM cost_daily_rollup WHERE user_id IN ('legacy', '')")
         return migrated
 
     # ── Session Tokens ──
@@ -3310,27 +4391,29 @@ class Database:
                 (token, user_id, now.isoformat(), expires.isoformat(),
                  now.isoformat(), device_hint),
             )
-            self.conn.commit()
         except Exception as e:
-            try:
-                self.conn.rollback()
-            except Exception:
-                pass
             logger.error(f"create_session_token failed: {e}")
+        else:
+            self._session_cache.set(token, (user_id, expires.isoformat()))
         return token
 
     def validate_session_token(self, token: str) -> Optional[dict]:
-        """Validate a session token. Returns the user dict if valid, else None."""
+        """Validate a session token. Returns the user dict if valid, else None.
+        Served from the session cache when warm; last_used is recorded in
+        memory and written back in batches by flush_session_touches()."""
         if not token or len(token) < 32:
             return None
         try:
-            cur = self._execute(
-                "SELECT user_id, expires_at FROM user_sessions WHERE token = %s", (token,)
-            )
-            row = cur.fetchone()
-            if not row:
-                return None
-            user_id, expires_at = row
+            entry = self._session_cache.get(token)
+            if entry is None:
+                row = self._execute(
+                    "SELECT user_id, expires_at FROM user_sessions WHERE token = %s", (token,)
+                ).fetchone()
+                if not row:
+                    return None
+                entry = (row[0], row[1])
+                self._session_cache.set(token, entry)
+            user_id, expires_at = entry
             # Check expiry
             try:
                 exp = datetime.fromisoformat(expires_at)
@@ -3339,43 +4422,68 @@ class Database:
                     return None
             except Exception:
                 pass
-            # Touch last_used
-            try:
-                self._execute(
-                    "UPDATE user_sessions SET last_used = %s WHERE token = %s",
-                    (datetime.now().isoformat(), token),
-                )
-                self.conn.commit()
-            except Exception:
-                try:
-                    self.conn.rollback()
-                except Exception:
-                    pass
+            self._touch_session(token)
             return self.get_user_by_id(user_id)
         except Exception:
             return None
 
+    def _touch_session(self, token: str):
+        """Record a session use; the UPDATE happens later, off the request path,
+        and at most once per SESSION_TOUCH_INTERVAL for any one token."""
+        now = time.monotonic()
+        with self._touch_lock:
+            last = self._session_touched.get(token)
+            if last is not None and now - last < SESSION_TOUCH_INTERVAL:
+                return
+            self._session_touched[token] = now
+            self._session_touches[token] = datetime.now().isoformat()
+            if self._touch_timer is None:
+                self._touch_timer = threading.Timer(
+                    SESSION_TOUCH_INTERVAL / 5, self.flush_session_touches
+                )
+                self._touch_timer.daemon = True
+                self._touch_timer.start()
+
+    def flush_session_touches(self):
+        """Write pending last_used values in a single transaction."""
+        with self._touch_lock:
+            pending, self._session_touches = self._session_touches, {}
+            self._touch_timer = None
+            cutoff = time.monotonic() - SESSION_TOUCH_INTERVAL
+            self._session_touched = {
+                t: ts for t, ts in self._session_touched.items() if ts > cutoff
+            }
+        if not pending:
+            return
+        try:
+            with self._transaction() as cur:
+                for token, used in pending.items():
+                    cur.execute(
+                        "UPDATE user_sessions SET last_used = %s WHERE token = %s",
+                        (used, token),
+                    )
+        except Exception as e:
+            logger.warning(f"Session last_used flush failed ({len(pending)} tokens): {e}")
+
     def revoke_session_token(self, token: str):
         """Delete a single session token."""
+        self._session_cache.invalidate(token)
+        with self._touch_lock:
+            self._session_touches.pop(token, None)
+            self._session_touched.pop(token, None)
         try:
             self._execute("DELETE FROM user_sessions WHERE token = %s", (token,))
-            self.conn.commit()
         except Exception:
-            try:
-                self.conn.rollback()
-            except Exception:
-                pass
+            pass
 
     def revoke_all_user_sessions(self, user_id: str):
         """Delete all session tokens for a user (sign out all devices)."""
+        # Pending touches for these tokens are harmless: they update no rows
+        self._session_cache.invalidate_where(lambda k, v: v[0] == user_id)
         try:
             self._execute("DELETE FROM user_sessions WHERE user_id = %s", (user_id,))
-            self.conn.commit()
         except Exception:
-            try:
-                self.conn.rollback()
-            except Exception:
-                pass
+            pass
 
     def get_user_sessions(self, user_id: str) -> list:
         """List all active (non-expired) sessions for a user."""
@@ -3398,47 +4506,249 @@ class Database:
         except Exception:
             return []
 
-    def cleanup_expired_sessions(self):
-        """Remove expired tokens (call periodically)."""
+    def cleanup_expired_sessions(self) -> int:
+        """Remove expired tokens. Runs as a maintenance job, never on a request."""
         try:
-            self._execute(
+            return self._execute(
                 "DELETE FROM user_sessions WHERE expires_at < %s",
                 (datetime.now().isoformat(),),
-            )
-            self.conn.commit()
+            ).rowcount
         except Exception:
-            try:
-                self.conn.rollback()
-            except Exception:
-                pass
+            return 0
+
+    # ── Maintenance ──
+    def claim_maintenance_run(self, job: str, interval: float) -> bool:
+        """Claim this interval's run of `job` across every replica sharing the
+        database. True means the caller should run the job now; False means
+        another process holds the lock or already ran it within `interval`."""
+        now = datetime.now()
+        due_before = (now - timedelta(seconds=interval * 0.9)).isoformat()
+        with self._transaction() as cur:
+            if not self.engine.try_advisory_xact_lock(cur, MAINTENANCE_LOCK_ID):
+                return False
+            cur.execute(
+                "INSERT INTO maintenance_runs (job, last_run) VALUES (%s, %s) "
+                "ON CONFLICT (job) DO UPDATE SET last_run = EXCLUDED.last_run "
+                "WHERE maintenance_runs.last_run < %s",
+                (job, now.isoformat(), due_before),
+            )
+            return cur.rowcount > 0
+
+    def record_maintenance_result(self, job: str, result: str):
+        self._execute(
+            "UPDATE maintenance_runs SET last_result = %s WHERE job = %s", (result[:500], job)
+        )
+
+    def get_maintenance_runs(self) -> dict:
+        rows = self._execute("SELECT job, last_run, last_result FROM maintenance_runs").fetchall()
+        return {r[0]: {"last_run": r[1], "last_result": r[2]} for r in rows}
+
+    def purge_orphan_case_keys(self) -> int:
+        """Delete lifecycle kv rows whose case no longer exists (delete_case leaves them)."""
+        keys = [r[0] for r in self._execute(
+            "SELECT key FROM kv_store WHERE key LIKE %s", ("u:%:lifecycle%",)
+        ).fetchall()]
+        owners = {}
+        for key in keys:
+            _, uid, name = key.split(":", 2)
+            for prefix in ("lifecycle_progress_", "lifecycle_"):
+                if name.startswith(prefix):
+                    owners[key] = (uid, name[len(prefix):])
+                    break
+        if not owners:
+            return 0
+        uids = sorted({uid for uid, _ in owners.values()})
+        live = {
+            (r[0], r[1]) for r in self._execute(
+                "SELECT user_id, id FROM cases WHERE user_id = ANY(%s)", (uids,)
+            ).fetchall()
+        }
+        orphans = [k for k, owner in owners.items() if owner not in live]
+        if not orphans:
+            return 0
+        return self._execute("DELETE FROM kv_store WHERE key = ANY(%s)", (orphans,)).rowcount
+
+    def compact_cost_rollup(self, keep_days: int) -> int:
+        """Fold daily rollup rows older than `keep_days` into one row per month,
+        dated the 1st. Totals are unchanged; only day-level detail is dropped.
+        Returns the number of rows removed."""
+        # Cut on a month boundary so a month is never half daily, half folded
+        cutoff = (date.today() - timedelta(days=keep_days)).replace(day=1).isoformat()
+        with self._transaction() as cur:
+            cur.execute(
+                "SELECT COUNT(*) FROM cost_daily_rollup "
+                "WHERE day < %s AND SUBSTR(day, 9, 2) <> '01'", (cutoff,)
+            )
+            if not cur.fetchone()[0]:
+                return 0
+            cur.execute(
+                "SELECT user_id, SUBSTR(day, 1, 7) || '-01', model, task, "
+                + ", ".join(f"SUM({c})" for c in self._ROLLUP_SUMS)
+                + " FROM cost_daily_rollup WHERE day < %s GROUP BY 1, 2, 3, 4", (cutoff,)
+            )
+            months = cur.fetchall()
+            cur.execute("DELETE FROM cost_daily_rollup WHERE day < %s", (cutoff,))
+            removed = cur.rowcount
+            for row in months:
+                cur.execute(self._ROLLUP_UPSERT, tuple(row))
+        return removed - len(months)
 
     def close(self):
-        self.conn.close()
+        self.flush_session_touches()
+        self.engine.closeall()
 
-    def ensure_connected(self):
-        """Ping the connection; reconnect + re-init tables if dead."""
-        try:
-            self.conn.cursor().execute("SELECT 1")
-        except Exception:
-            try:
-                self.conn.rollback()
-            except Exception:
-                pass
+
+@st.cache_resource
+def get_db() -> Database:
+    """Singleton Database (and its connection pool) per Streamlit server process."""
+    return Database()
+
+
+# ═══════════════════════════════════════════════════════
+# WRITE-BEHIND PERSISTENCE
+# ═══════════════════════════════════════════════════════
+class WriteBehindQueue:
+    """Coalesces persist() calls and writes them in one transaction per user.
+
+    Writes are snapshotted when queued, so later in-place edits of session
+    data cannot leak into an earlier write. Repeated saves of the same list or
+    record within a rerun collapse to the latest value. Pending writes flush
+    at the end of every script run, on logout, via flush_pending(), and — as
+    a safety net for interrupted runs — on a short timer and at exit.
+    """
+
+    def __init__(self, db: Database, delay: float = 2.0):
+        self.db = db
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._pending: dict = {}        # uid -> {op_key: op}, insertion-ordered
+        self._flush_locks: dict = {}    # uid -> Lock; keeps flushes for a user in order
+        self._timer: Optional[threading.Timer] = None
+
+    @staticmethod
+    def _snapshot(data):
+        return json.loads(json.dumps(data, default=str))
+
+    def _enqueue(self, uid: str, op_key: tuple, op: tuple, supersedes=None):
+        with self._lock:
+            ops = self._pending.setdefault(uid, {})
+            if supersedes is not None:
+                for k in [k for k in ops if supersedes(k)]:
+                    del ops[k]
+            prev = ops.get(op_key)
+            if prev and prev[0] == "upsert" and op[0] == "upsert" and prev[3]:
+                op = op[:3] + (True,)   # still an insert as far as the DB knows
+            ops[op_key] = op
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self._on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def mark_list(self, uid: str, key: str, data: list):
+        self._enqueue(uid, ("list", key), ("list", key, self._snapshot(data)))
+
+    def mark_replace(self, uid: str, kind: str, records: list):
+        for rec in records:
+            if isinstance(rec, dict):
+                rec.setdefault("id", new_id())   # ids must be stable before snapshotting
+        self._enqueue(
+            uid, ("records", kind), ("replace", kind, self._snapshot(records)),
+            supersedes=lambda k: k[0] == "record" and k[1] == kind,
+        )
+
+    def mark_record(self, uid: str, kind: str, record: dict, new: bool = False):
+        record.setdefault("id", new_id())
+        self._enqueue(uid, ("record", kind, str(record["id"])),
+                      ("upsert", kind, self._snapshot(record), new))
+
+    def mark_delete(self, uid: str, kind: str, record_id: str):
+        self._enqueue(uid, ("record", kind, str(record_id)), ("delete", kind, str(record_id)))
+
+    def has_pending(self, uid: str) -> bool:
+        with self._lock:
+            return bool(self._pending.get(uid))
+
+    def discard(self, uid: str):
+        """Drop queued writes for a user (e.g. the account is being deleted)."""
+        with self._lock:
+            self._pending.pop(uid, None)
+
+    def flush(self, uid: str) -> bool:
+        """Write everything queued for `uid` now. Returns False if the write failed
+        (the ops are re-queued behind any newer writes and retried by the timer)."""
+        with self._lock:
+            flock = self._flush_locks.setdefault(uid, threading.Lock())
+        with flock:
+            with self._lock:
+                ops = self._pending.pop(uid, None)
+            if not ops:
+                return True
             try:
-                self.conn = self._connect()
-                self._init_tables()
+                self.db.apply_writes(uid, list(ops.values()))
+                return True
             except Exception as e:
-                logger.error(f"DB reconnect failed: {e}")
+                logger.error(f"Write-behind flush failed for {uid} ({len(ops)} op(s)): {e}")
+                with self._lock:
+                    newer = self._pending.get(uid, {})
+                    ops.update(newer)           # newer writes win
+                    self._pending[uid] = ops
+                    if self._timer is None:
+                        self._timer = threading.Timer(self.delay * 5, self._on_timer)
+                        self._timer.daemon = True
+                        self._timer.start()
+                return False
+
+    def flush_all(self):
+        with self._lock:
+            uids = list(self._pending)
+        for uid in uids:
+            self.flush(uid)
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+        self.flush_all()
 
 
 @st.cache_resource
-def get_db() -> Database:
-    """Singleton DB connection per Streamlit server process."""
-    return Database()
+def get_write_behind() -> WriteBehindQueue:
+    """Process-wide write-behind queue in front of get_db()."""
+    queue = WriteBehindQueue(get_db())
+    atexit.register(queue.flush_all)
+    return queue
+
+
+def _persist_uid() -> str:
+    return st.session_state.get("current_user_id", "") or "legacy"
+
 
 def persist(key: str):
-    """Save a session_state list to DB under the current user's namespace."""
-    get_db().save_list(key, st.session_state.get(key, []))
+    """Queue a whole session_state list for saving under the current user's namespace.
+    For per-record collections prefer persist_record / persist_delete."""
+    data = st.session_state.get(key, [])
+    if key in RECORD_KINDS:
+        get_write_behind().mark_replace(_persist_uid(), key, data)
+    else:
+        get_write_behind().mark_list(_persist_uid(), key, data)
+
+
+def persist_record(key: str, record: dict, new: bool = False):
+    """Queue one added (`new=True`) or changed record of a per-record collection."""
+    get_write_behind().mark_record(_persist_uid(), key, record, new=new)
+
+
+def persist_delete(key: str, *record_ids: str):
+    """Queue deletion of records of a per-record collection by id."""
+    for rid in record_ids:
+        get_write_behind().mark_delete(_persist_uid(), key, rid)
+
+
+def flush_pending(uid: str = "") -> bool:
+    """Flush queued writes now (read-your-writes paths, logout, end of rerun)."""
+    uid = uid or st.session_state.get("current_user_id", "")
+    if not uid:
+        return True
+    return get_write_behind().flush(uid)
 
 
 def persist_profile():
@@ -3450,18 +4760,126 @@ def load_user_data():
     """Load all user-specific data from DB into session state. Called once after login."""
     if not st.session_state.get("current_user_id"):
         return
+    flush_pending()  # another device may still have queued writes for this user
     db = get_db()
-    st.session_state.cases = db.load_list("cases") or []
-    st.session_state.clients = db.load_list("clients") or []
-    st.session_state.time_entries = db.load_list("time_entries") or []
-    st.session_state.invoices = db.load_list("invoices") or []
-    st.session_state.chat_history = db.load_list("chat_history") or []
-    st.session_state.custom_templates = db.load_list("custom_templates") or []
-    st.session_state.custom_limitation_periods = db.load_list("custom_limitation_periods") or []
-    st.session_state.custom_maxims = db.load_list("custom_maxims") or []
+    # Two round trips total: every list/collection, then the joined profile
+    for key, data in db.load_many(USER_LIST_KEYS, record_kinds=RECORD_KINDS).items():
+        st.session_state[key] = data or []
     st.session_state.profile = db.get_profile()
 
 
+# ═══════════════════════════════════════════════════════
+# BACKGROUND MAINTENANCE
+# ═══════════════════════════════════════════════════════
+MAINTENANCE_TICK = 30.0  # seconds between checks for due jobs
+ROLLUP_DAILY_RETENTION_DAYS = 400  # older cost rollup rows are folded into months
+
+
+class MaintenanceScheduler:
+    """Runs registered housekeeping jobs on one daemon thread per process.
+
+    Each job has an interval and a jitter fraction so replicas started together
+    drift apart. Before running, a job claims its slot through
+    Database.claim_maintenance_run, so however many Streamlit replicas share
+    the database, each job runs once per interval. A failing job is logged and
+    retried at its next slot; it never reaches a user request.
+    """
+
+    def __init__(self, db: Database, tick: float = MAINTENANCE_TICK):
+        self.db = db
+        self.tick = tick
+        self.jobs: dict = {}   # name -> {"func", "interval", "jitter", "next_run", "last"}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def register(self, name: str, func, interval: float, jitter: float = 0.1):
+        """Add a job. `func()` returns a short summary (or count) for the run log."""
+        self.jobs[name] = {
+            "func": func, "interval": interval, "jitter": jitter,
+            # First run lands somewhere in the first tick window, not at startup
+            "next_run": time.time() + random.uniform(self.tick, self.tick * 4),
+            "last": None,
+        }
+
+    def _reschedule(self, job: dict):
+        spread = job["interval"] * job["jitter"]
+        job["next_run"] = time.time() + job["interval"] + random.uniform(-spread, spread)
+
+    def run_job(self, name: str, force: bool = False) -> bool:
+        """Run one job if its cross-process slot is free. Returns True if it ran."""
+        job = self.jobs[name]
+        self._reschedule(job)
+        try:
+            if not force and not self.db.claim_maintenance_run(name, job["interval"]):
+                return False
+            started = time.time()
+            result = job["func"]()
+            summary = f"{result} ({time.time() - started:.2f}s)"
+            job["last"] = (datetime.now().isoformat(), summary)
+            self.db.record_maintenance_result(name, summary)
+            logger.info(f"Maintenance job {name}: {summary}")
+            return True
+        except Exception as e:
+            job["last"] = (datetime.now().isoformat(), f"failed: {e}")
+            logger.warning(f"Maintenance job {name} failed: {e}")
+            return False
+
+    def run_due(self):
+        now = time.time()
+        for name, job in list(self.jobs.items()):
+            if job["next_run"] <= now:
+                self.run_job(name)
+
+    def _loop(self):
+        while not self._stop.wait(self.tick):
+            self.run_due()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="lexi-maintenance", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+@st.cache_resource
+def get_maintenance() -> MaintenanceScheduler:
+    """Process-wide maintenance scheduler; started on first use."""
+    db = get_db()
+    queue = get_write_behind()
+
+    def purge_orphans():
+        queue.flush_all()  # a just-created case must be in the table before we look
+        return f"{db.purge_orphan_case_keys()} orphaned kv row(s) removed"
+
+    sched = MaintenanceScheduler(db)
+    sched.register(
+        "expired_sessions",
+        lambda: f"{db.cleanup_expired_sessions()} expired session(s) removed", 3600,
+    )
+    sched.register("orphan_case_keys", purge_orphans, 6 * 3600)
+    sched.register(
+        "llm_cache_expiry",
+        lambda: f"{db.purge_expired_llm_cache()} expired cached response(s) removed", 6 * 3600,
+    )
+    sched.register(
+        "generation_jobs",
+        lambda: "{} stale job(s) failed, {} old job(s) purged".format(
+            *db.expire_generation_jobs(GENERATION_JOB_STALE_SECONDS,
+                                       GENERATION_JOB_QUEUE_STALE_SECONDS, 7)),
+        600,
+    )
+    sched.register(
+        "rollup_compaction",
+        lambda: f"{db.compact_cost_rollup(ROLLUP_DAILY_RETENTION_DAYS)} rollup row(s) folded",
+        24 * 3600,
+    )
+    sched.start()
+    atexit.register(sched.stop)
+    return sched
+
+
 # ═══════════════════════════════════════════════════════
 # MULTI-USER AUTH
 # ═══════════════════════════════════════════════════════
@@ -3527,7 +4945,6 @@ def do_auto_login_from_token(token: str) -> bool:
     if not token:
         return False
     db = get_db()
-    db.cleanup_expired_sessions()
     user = db.validate_session_token(token)
     if not user:
         return False  # Token invalid/expired
@@ -3543,7 +4960,8 @@ def do_auto_login_from_token(token: str) -> bool:
 
 
 def do_logout():
-    """Revoke session token, clear query params, and wipe session state."""
+    """Flush queued writes, revoke session token, clear query params, and wipe session state."""
+    flush_pending()
     db = get_db()
     token = st.session_state.get("_session_token", "")
     if token:
@@ -3556,7 +4974,8 @@ def do_logout():
         "authenticated", "current_user_id", "current_username", "current_user_role",
         "user_data_loaded", "_session_token",
         "cases", "clients", "time_entries", "invoices",
-        "chat_history", "custom_templates", "custom_limitation_periods", "custom_maxims",
+        "chat_history", "session_history_ids",
+        "custom_templates", "custom_limitation_periods", "custom_maxims",
         "profile", "last_response", "original_query", "research_results",
         "loaded_template", "imported_doc",
         "wp_result", "wp_role_label", "wp_facts_saved", "wp_reexam_result",
@@ -3824,6 +5243,27 @@ def render_sidebar():
                 key="sidebar_model_sel", label_visibility="collapsed")
             if ms != st.session_state.gemini_model:
                 st.session_state.gemini_model = ms; st.rerun()
+            st.session_state.model_routing = st.checkbox(
+                "🧭 Auto-route by task", value=st.session_state.get("model_routing", True),
+                key="sidebar_model_routing_chk",
+                help=f"Brief requests use {ROUTE_LITE_MODEL} (except drafting and contract "
+                     f"review), Comprehensive uses {ROUTE_PRO_MODEL}, everything else the model "
+                     "selected above. Rate-limited models are skipped automatically either way.",
+            )
+            for m, h in get_model_router().stats().items():
+                if h["cooldown"] > 0:
+                    st.caption(f"⏸️ `{m}` paused {h['cooldown']:.0f}s — {h['last_error'][:60]}")
+            st.session_state.llm_cache_enabled = st.checkbox(
+                "♻️ Reuse identical answers", value=st.session_state.get("llm_cache_enabled", True),
+                key="sidebar_llm_cache_chk",
+                help="Answer a repeated, identical request from the response cache at no API cost.",
+            )
+            if st.session_state.llm_cache_enabled and st.button(
+                "🔄 Fresh answer next time", use_container_width=True, key="sidebar_llm_refresh_btn",
+                help="Skip the cache for the next request and replace the stored answer.",
+            ):
+                st.session_state["_llm_cache_refresh"] = True
+                st.toast("The next AI request will bypass the cache.", icon="🔄")
             summary = get_db().get_cost_summary()
             if summary["total_calls"] > 0:
                 st.caption(f"💰 Today: ${summary['daily_cost']:.4f} ({summary['daily_calls']} calls)")
@@ -4081,6 +5521,105 @@ Your workspace is empty. Pick any of the three actions below to begin:
 # ═══════════════════════════════════════════════════════
 # PAGE: AI ASSISTANT (FULL-FEATURED)
 # ═══════════════════════════════════════════════════════
+STRENGTH_TASKS = ("analysis", "advisory", "contract_review")
+
+
+def _strength_prompt(response: str) -> str:
+    return f"""
+Based on this legal analysis, extract ALL parties mentioned and estimate each party's
+litigation strength as a percentage.
+Respond ONLY in this exact JSON format, nothing else:
+{{
+  "parties": [
+    {{"name": "Party Name", "role": "Claimant/Defendant/Third Party", "strength": 75, "reason": "One sentence why"}},
+    {{"name": "Party Name", "role": "Defendant", "strength": 35, "reason": "One sentence why"}}
+  ],
+  "overall_complexity": "Low/Medium/High/Extreme",
+  "recommended_action": "One sentence immediate action"
+}}
+ANALYSIS:
+{response[:6000]}
+"""
+
+
+def _response_fingerprint(response: str) -> str:
+    return hashlib.sha256(response.encode("utf-8")).hexdigest()[:16]
+
+
+def _finish_ai_result(query: str, result: str, task: str, mode: str) -> dict:
+    """_apply_ai_result plus, for analysis-type tasks, the Case Strength Meter
+    assessment queued in the background (see prefetch_strength), so it is
+    usually ready by the time the meter is opened without holding up the
+    page. Returns the confidence."""
+    confidence = _apply_ai_result(query, result, task, mode)
+    if task in STRENGTH_TASKS and not result.startswith("⚠️"):
+        prefetch_strength(result)
+    return confidence
+
+
+def _apply_ai_result(query: str, result: str, task: str, mode: str,
+                     replace_history: bool = False) -> dict:
+    """Make `result` the current AI Assistant response: citation audit,
+    confidence score, session state and history. With `replace_history` the
+    current response's history entry is updated instead of adding another
+    (an accepted quality upgrade). Returns the confidence."""
+    audit = verify_response_citations(result)
+    confidence = compute_confidence_score(result, audit)
+
+    st.session_state.last_response = result
+    st.session_state.last_audit = audit
+    st.session_state.last_confidence = confidence
+    st.session_state.original_query = query
+    st.session_state.last_task = task
+    st.session_state.last_mode = mode
+    st.session_state.selected_history_idx = None
+    if not (replace_history
+            and replace_history_entry(st.session_state.get("last_history_id"), result)):
+        st.session_state.last_history_id = add_to_history(query, result, task, mode)["id"]
+    return confidence
+
+
+@st.fragment(run_every=2)
+def _render_generation_jobs():
+    """Live view of the user's background generations. Re-runs itself every
+    two seconds; a finished job is delivered once, then the page reruns."""
+    uid = st.session_state.current_user_id
+    db = get_db()
+    jobs = db.get_generation_jobs(uid)
+    if not jobs:
+        st.rerun()
+    for job in jobs:
+        if job["status"] in ("queued", "running"):
+            started = datetime.fromisoformat(job["created_at"])
+            elapsed = (datetime.now() - started).total_seconds()
+            words = len(job["output"].split())
+            label = "⏳ Queued" if job["status"] == "queued" else f"🧠 Generating · {words:,} words so far"
+            st.markdown(f"### 📋 {label} · {elapsed:.0f}s")
+            st.caption(f"**Query:** {job['query'][:160]}")
+            jc1, jc2 = st.columns([4, 1])
+            with jc2:
+                if job["cancel_requested"]:
+                    st.caption("Cancelling…")
+                elif st.button("⏹️ Cancel", key=f"job_cancel_{job['id']}", use_container_width=True):
+                    get_generation_jobs().cancel(job["id"], uid)
+            if job["output"]:
+                st.markdown(
+                    f'<div class="response-box">{esc(job["output"])}<span style="opacity:0.5;">▌</span></div>',
+                    unsafe_allow_html=True,
+                )
+            continue
+        if not db.mark_generation_job_delivered(job["id"]):
+            continue  # another session picked it up
+        if job["status"] == "done":
+            _apply_ai_result(job["query"], job["output"], job["task"], job["mode"])
+            st.toast("✅ Comprehensive analysis ready", icon="🧠")
+        elif job["status"] == "cancelled":
+            st.toast("⏹️ Generation cancelled", icon="⏹️")
+        else:
+            st.session_state["_job_error"] = job["error"] or "Generation failed."
+        st.rerun()
+
+
 def render_ai():
     st.markdown("""<div class="page-header">
         <h2>🧠 AI Legal Assistant</h2>
@@ -4288,37 +5827,73 @@ def render_ai():
         st.markdown("### 🔍 Issue Decomposition")
         st.markdown(f'<div class="response-box">{esc(result)}</div>', unsafe_allow_html=True)
 
+    # ── Background jobs (Comprehensive runs survive refreshes and device switches) ──
+    job_error = st.session_state.pop("_job_error", "")
+    if job_error:
+        st.error(f"⚠️ Generation error: {job_error[:200]}")
+    if get_db().get_generation_jobs(st.session_state.current_user_id):
+        _render_generation_jobs()
+
     # ── Main Generation (with streaming + audit + confidence) ──
     if generate_btn and query.strip():
-        st.markdown("### 📋 Analysis (streaming…)")
-        stream_container = st.container()
-        start_t = time.time()
-
         # Build prompt with optional document context
         system = build_system_prompt(task, mode)
-        full_prompt = query.strip()
-        if doc_context:
-            full_prompt = f"DOCUMENT CONTEXT:\n{doc_context[:8000]}\n\nQUERY:\n{query.strip()}"
-
-        with st.spinner(f"🧠 Streaming {mode_info['label']} analysis…"):
-            result = generate(full_prompt, system, mode, task, stream_to=stream_container)
-        elapsed = time.time() - start_t
-
-        # Citation audit + confidence scoring
-        audit = verify_response_citations(result)
-        confidence = compute_confidence_score(result, audit)
-
-        st.session_state.last_response = result
-        st.session_state.last_audit = audit
-        st.session_state.last_confidence = confidence
-        st.session_state.original_query = query.strip()
-        st.session_state.last_task = task
-        st.session_state.last_mode = mode
-        st.session_state.selected_history_idx = None
-        add_to_history(query.strip(), result, task, mode)
+        full_prompt, ctx_report = assemble_context(query.strip(), mode, system, document=doc_context,
+                                                   history=session_history())
+        ctx_caption = context_report_caption(ctx_report)
+        contract_text = doc_context or query.strip()
+        if ctx_caption and not (task == "contract_review"
+                                and len(contract_text) >= CONTRACT_MAP_REDUCE_MIN_CHARS):
+            st.caption(ctx_caption)
+
+        if task == "contract_review" and len(contract_text) >= CONTRACT_MAP_REDUCE_MIN_CHARS:
+            # Long contracts: clause batches on the cheap model, then one reduce call
+            st.markdown("### 📑 Contract Review (clause by clause…)")
+            bar = st.progress(0.0, text="Splitting the contract into clauses…")
+            start_t = time.time()
+            result, review_report = review_contract(
+                contract_text, query.strip() if doc_context else "", mode,
+                progress=lambda done, total: bar.progress(
+                    done / total, text=f"Reviewed {done}/{total} clause batches"),
+                stream_to=st.container(),
+            )
+            bar.empty()
+            elapsed = time.time() - start_t
+            confidence = _finish_ai_result(query.strip(), result, task, mode)
+            st.caption(f"⏱️ Reviewed {review_report['clauses']} clauses in {elapsed:.1f}s · "
+                       f"{review_report['cached']} unchanged from an earlier review · "
+                       f"{review_report['batches']} batch call(s)"
+                       + (f" · ⚠️ {review_report['failed']} clause(s) failed" if review_report['failed'] else "")
+                       + f" · Confidence: {confidence['overall']}/10")
+        elif mode == "comprehensive":
+            job_id, cached = submit_generation_job(full_prompt, system, mode, task, query.strip())
+            if cached:
+                confidence = _apply_ai_result(query.strip(), cached, task, mode)
+                st.caption(f"♻️ Reused an identical earlier answer · {len(cached.split()):,} words · "
+                           f"Confidence: {confidence['overall']}/10")
+            elif job_id:
+                st.rerun()
+            else:
+                st.warning(f"⏳ You already have {MAX_ACTIVE_JOBS_PER_USER} analyses running. "
+                           "Wait for one to finish or cancel it, then try again.")
+        else:
+            st.markdown("### 📋 Analysis (streaming…)")
+            stream_container = st.container()
+            start_t = time.time()
+            with st.spinner(f"🧠 Streaming {mode_info['label']} analysis…"):
+                result = generate(full_prompt, system, mode, task, stream_to=stream_container,
+                                  enable_quality_gate=True)
+            elapsed = time.time() - start_t
+            with st.spinner("📊 Auditing citations…"):
+                confidence = _finish_ai_result(query.strip(), result, task, mode)
+            st.caption(f"⏱️ Generated in {elapsed:.1f}s · {len(result.split()):,} words · "
+                       f"Confidence: {confidence['overall']}/10")
 
-        st.caption(f"⏱️ Generated in {elapsed:.1f}s · {len(result.split()):,} words · "
-                   f"Confidence: {confidence['overall']}/10")
+    improved = st.session_state.pop("ai_quality_upgrade", "")
+    if improved:
+        _apply_ai_result(st.session_state.original_query, improved,
+                         st.session_state.get("last_task", "general"),
+                         st.session_state.get("last_mode", "standard"), replace_history=True)
 
     # ── Display Response ──
     if st.session_state.last_response and st.session_state.selected_history_idx is None:
@@ -4333,6 +5908,7 @@ def render_ai():
             st.markdown(render_confidence_panel(confidence), unsafe_allow_html=True)
         if audit:
             st.markdown(render_citation_audit(audit), unsafe_allow_html=True)
+        render_quality_upgrade(response, "ai_quality_upgrade")
 
         # Export row
         fname = f"LexiAssist_Analysis_{datetime.now():%Y%m%d_%H%M}"
@@ -4381,30 +5957,25 @@ def render_ai():
         st.html(_copy_html)
 
         # ── CASE STRENGTH METER ──
-        if st.session_state.get("last_task") in ("analysis", "advisory", "contract_review"):
+        if st.session_state.get("last_task") in STRENGTH_TASKS:
             with st.expander("📊 Case Strength Meter", expanded=True):
                 st.caption("AI-assessed win probability per party based on the analysis above.")
-                if st.button("⚡ Generate Strength Assessment", key="strength_meter_btn", type="primary"):
-                    strength_prompt = f"""
-Based on this legal analysis, extract ALL parties mentioned and estimate each party's
-litigation strength as a percentage.
-Respond ONLY in this exact JSON format, nothing else:
-{{
-  "parties": [
-    {{"name": "Party Name", "role": "Claimant/Defendant/Third Party", "strength": 75, "reason": "One sentence why"}},
-    {{"name": "Party Name", "role": "Defendant", "strength": 35, "reason": "One sentence why"}}
-  ],
-  "overall_complexity": "Low/Medium/High/Extreme",
-  "recommended_action": "One sentence immediate action"
-}}
-ANALYSIS:
-{response[:6000]}
-"""
+                fingerprint = _response_fingerprint(response)
+                prefetched = st.session_state.get("strength_prefetch", {})
+                raw = prefetched.get("raw", "") if prefetched.get("for") == fingerprint else ""
+                background = get_strength_prefetcher().get(fingerprint)
+                if not raw and background and background["status"] == "ready":
+                    raw = background["raw"]
+                if not raw and background and background["status"] == "fetching":
+                    _await_strength_prefetch(fingerprint)
+                elif not raw and st.button("⚡ Generate Strength Assessment", key="strength_meter_btn", type="primary"):
                     with st.spinner("Calculating case strength..."):
-                        raw = generate(strength_prompt, IDENTITY_CORE, "brief", "analysis")
+                        raw = generate_json(_strength_prompt(response), IDENTITY_CORE, "brief", "analysis")
+                    if not raw.startswith("⚠️"):  # errors show once; the button stays to retry
+                        st.session_state["strength_prefetch"] = {"for": _response_fingerprint(response), "raw": raw}
+                if raw:
                     try:
-                        clean = raw.strip().replace("```json","").replace("```","").strip()
-                        data = json.loads(clean)
+                        data = parse_json_response(raw)
                         for p in data.get("parties", []):
                             strength = int(p.get("strength", 50))
                             color = "#dc2626" if strength < 40 else ("#f59e0b" if strength < 65 else "#059669")
@@ -4505,10 +6076,9 @@ CASE ANALYSIS CONTEXT:
 PROPOSED ACTION: {sim_action}
 """
                     with st.spinner("🎯 Simulating strategy..."):
-                        sim_raw = generate(sim_prompt, IDENTITY_CORE, "brief", "advisory")
+                        sim_raw = generate_json(sim_prompt, IDENTITY_CORE, "brief", "advisory")
                     try:
-                        sim_clean = sim_raw.strip().replace("```json","").replace("```","").strip()
-                        sim_data = json.loads(sim_clean)
+                        sim_data = parse_json_response(sim_raw)
 
                         prob = int(sim_data.get("probability_of_success", 50))
                         verdict = sim_data.get("verdict", "RISKY")
@@ -4690,10 +6260,9 @@ authoritative Nigerian cases. Respond ONLY in this exact JSON format, nothing el
 LEGAL ISSUE: {prec_query}
 """
             with st.spinner("🔖 Searching Nigerian precedents..."):
-                raw = generate(prec_prompt, IDENTITY_CORE, "brief", "research")
+                raw = generate_json(prec_prompt, IDENTITY_CORE, "brief", "research")
             try:
-                clean = raw.strip().replace("```json", "").replace("```", "").strip()
-                data = json.loads(clean)
+                data = parse_json_response(raw)
                 for i, case in enumerate(data.get("cases", []), 1):
                     court = case.get("court", "")
                     if "Supreme" in court:
@@ -4739,12 +6308,21 @@ LEGAL ISSUE: {prec_query}
             result = run_research(query.strip(), mode)
             elapsed = time.time() - start_t
         st.session_state.research_results = result
-        add_to_history(f"[Research] {query.strip()}", result, "research", mode)
+        st.session_state.research_history_id = add_to_history(
+            f"[Research] {query.strip()}", result, "research", mode)["id"]
         st.caption(f"⏱️ {elapsed:.1f}s · {len(result.split()):,} words")
 
+    improved = st.session_state.pop("research_quality_upgrade", "")
+    if improved:
+        st.session_state.research_results = improved
+        if not replace_history_entry(st.session_state.get("research_history_id"), improved):
+            st.session_state.research_history_id = add_to_history(
+                f"[Research] {query.strip()}", improved, "research", mode)["id"]
+
     result = st.session_state.research_results
     if result:
         st.markdown("---")
+        render_quality_upgrade(result, "research_quality_upgrade")
         fname = f"LexiAssist_Research_{datetime.now():%Y%m%d_%H%M}"
         ex1, ex2, ex3, ex4 = st.columns(4)
         with ex1:
@@ -4852,11 +6430,22 @@ def render_cases():
 
         st.caption(f"Showing {len(filtered)} of {len(cases)} cases")
 
+        # Only render one page of matters — each card carries several widgets
+        n_pages = max(1, -(-len(filtered) // CASES_PAGE_SIZE))
+        if n_pages > 1:
+            page = st.number_input("Page", 1, n_pages, 1, key="case_page_inp") - 1
+            filtered = filtered[page * CASES_PAGE_SIZE:(page + 1) * CASES_PAGE_SIZE]
+
+        analysis_stats = get_db().get_case_analysis_stats()
+
         for c in filtered:
             d = days_until(c.get("next_hearing", ""))
             badge = "badge-err" if d <= 3 else ("badge-warn" if d <= 7 else "badge-ok")
             hearing_txt = fmt_date(c.get("next_hearing", ""))
             cname = get_client_name(c.get("client_id", ""))
+            a_stat = analysis_stats.get(c["id"], {"count": 0, "latest": ""})
+            a_txt = (f" · 📎 {a_stat['count']} saved (latest {esc(fmt_date(a_stat['latest']))})"
+                     if a_stat["count"] else "")
 
             st.markdown(f"""<div class="custom-card">
                 <h4>{esc(c.get('title', 'Untitled'))}</h4>
@@ -4865,11 +6454,11 @@ def render_cases():
                 Court: {esc(c.get('court', '—'))} ·
                 Client: {esc(cname)} ·
                 Hearing: {esc(hearing_txt)}
-                <span class="badge {badge}">{esc(relative_date(c.get('next_hearing', '')))}</span>
+                <span class="badge {badge}">{esc(relative_date(c.get('next_hearing', '')))}</span>{a_txt}
             </div>""", unsafe_allow_html=True)
 
             with st.expander(f"✏️ Manage: {c.get('title', '')[:50]}", expanded=False):
-                manage_tab, analyses_tab = st.tabs(["⚙️ Details", "📎 Saved Analyses"])
+                manage_tab, analyses_tab = st.tabs(["⚙️ Details", f"📎 Saved Analyses ({a_stat['count']})"])
 
                 with manage_tab:
                     mc1, mc2 = st.columns(2)
@@ -4902,9 +6491,20 @@ def render_cases():
 
                 with analyses_tab:
                     db = get_db()
-                    saved = db.get_case_analyses(c["id"])
+                    n_saved = a_stat["count"]
+                    # Bodies are only fetched once the user asks for them, one page at a time
+                    show_saved = n_saved and st.toggle(
+                        f"Load {n_saved} saved analysis(es)", key=f"load_sa_{c['id']}")
+                    saved = []
+                    if show_saved:
+                        sa_pages = max(1, -(-n_saved // ANALYSES_PAGE_SIZE))
+                        sa_page = 0
+                        if sa_pages > 1:
+                            sa_page = st.number_input("Page", 1, sa_pages, 1, key=f"sa_page_{c['id']}") - 1
+                        saved = db.get_case_analyses(c["id"], limit=ANALYSES_PAGE_SIZE,
+                                                     offset=sa_page * ANALYSES_PAGE_SIZE)
                     if saved:
-                        st.caption(f"{len(saved)} saved analysis(es) for this case")
+                        st.caption(f"{n_saved} saved analysis(es) for this case")
                         for sa in saved:
                             task_lbl = TASK_TYPES.get(sa.get("task", ""), {}).get("label", sa.get("task", ""))
                             mode_lbl = RESPONSE_MODES.get(sa.get("mode", ""), {}).get("label", sa.get("mode", ""))
@@ -4929,7 +6529,7 @@ def render_cases():
                                     db.delete_case_analysis(sa["id"])
                                     st.success("Deleted!")
                                     st.rerun()
-                    else:
+                    elif not n_saved:
                         st.info("No analyses saved to this case yet. Use 'Save to Case' in the AI Assistant or Research tab.")
 
 
@@ -5347,13 +6947,16 @@ def render_billing():
         db = get_db()
         summary = db.get_cost_summary()
 
-        kc1, kc2, kc3 = st.columns(3)
+        kc1, kc2, kc3, kc4 = st.columns(4)
         with kc1:
             st.metric("Today", f"${summary['daily_cost']:.4f}", f"{summary['daily_calls']} calls")
         with kc2:
             st.metric("This Month", f"${summary['monthly_cost']:.4f}", f"{summary['monthly_calls']} calls")
         with kc3:
             st.metric("All Time", f"${summary['total_cost']:.4f}", f"{summary['total_calls']} calls")
+        with kc4:
+            st.metric("Saved by Cache", f"${summary['total_saved']:.4f}",
+                      f"{summary['total_cache_hits']} reused answers")
 
         st.markdown("---")
 
@@ -5361,13 +6964,13 @@ def render_billing():
         if logs:
             st.markdown("#### 📋 Recent API Calls")
 
-            if HAS_PLOTLY and len(logs) > 1:
-                log_df = pd.DataFrame(logs)
-                log_df["timestamp"] = pd.to_datetime(log_df["timestamp"], errors="coerce")
-                log_df["date"] = log_df["timestamp"].dt.date
+            # Charts read the daily rollup, so they cover all history at constant cost
+            rollup = db.get_cost_rollup()
+            if HAS_PLOTLY and rollup:
+                roll_df = pd.DataFrame(rollup)
 
                 # Daily cost chart
-                daily_df = log_df.groupby("date")["estimated_cost"].sum().reset_index()
+                daily_df = roll_df.groupby("day")["cost"].sum().reset_index()
                 daily_df.columns = ["Date", "Cost ($)"]
                 if len(daily_df) > 1:
                     fig_cost = px.bar(daily_df, x="Date", y="Cost ($)",
@@ -5376,24 +6979,24 @@ def render_billing():
                     st.plotly_chart(fig_cost, use_container_width=True)
 
                 # Calls by task
-                if "task" in log_df.columns:
-                    task_df = log_df.groupby("task").agg(
-                        calls=("id", "count"),
-                        total_cost=("estimated_cost", "sum")
-                    ).reset_index()
-                    task_df.columns = ["Task", "Calls", "Cost ($)"]
-                    fig_task = px.pie(task_df, values="Calls", names="Task",
-                                     title="API Calls by Task Type")
-                    st.plotly_chart(fig_task, use_container_width=True)
+                task_df = roll_df.groupby("task").agg(
+                    calls=("calls", "sum"),
+                    total_cost=("cost", "sum")
+                ).reset_index()
+                task_df.columns = ["Task", "Calls", "Cost ($)"]
+                fig_task = px.pie(task_df, values="Calls", names="Task",
+                                 title="API Calls by Task Type")
+                st.plotly_chart(fig_task, use_container_width=True)
 
                 # Calls by model
-                if "model" in log_df.columns:
-                    model_df = log_df.groupby("model").agg(
-                        calls=("id", "count"),
-                        total_cost=("estimated_cost", "sum")
-                    ).reset_index()
-                    model_df.columns = ["Model", "Calls", "Cost ($)"]
-                    st.dataframe(model_df, use_container_width=True, hide_index=True)
+                model_df = roll_df.groupby("model").agg(
+                    calls=("calls", "sum"),
+                    prompt_tokens=("prompt_tokens", "sum"),
+                    output_tokens=("output_tokens", "sum"),
+                    total_cost=("cost", "sum")
+                ).reset_index()
+                model_df.columns = ["Model", "Calls", "Input Tokens", "Output Tokens", "Cost ($)"]
+                st.dataframe(model_df, use_container_width=True, hide_index=True)
 
             # Log table
             st.markdown("#### 📜 Call Log")
@@ -5404,8 +7007,12 @@ def render_billing():
                     <small>{esc(fmt_date(log.get('timestamp', '')))} ·
                     {esc(log.get('model', ''))} ·
                     {esc(task_lbl)} · {esc(mode_lbl)} ·
-                    In: {log.get('input_chars', 0):,}c · Out: {log.get('output_chars', 0):,}c ·
-                    <strong>${log.get('estimated_cost', 0):.5f}</strong></small><br>
+                    {f"In: {log['prompt_tokens']:,} tok · Out: {log['output_tokens'] + log['thinking_tokens']:,} tok"
+                     if log.get('prompt_tokens') else
+                     f"In: {log.get('input_chars', 0):,}c · Out: {log.get('output_chars', 0):,}c"} ·
+                    <strong>${log.get('estimated_cost', 0):.5f}</strong>
+                    {f"· ♻️ cached, saved ${log.get('saved_cost', 0):.5f}" if log.get('cache_hit') else ""}
+                    {f"· 🧩 {log['segments']} segments" if (log.get('segments') or 1) > 1 else ""}</small><br>
                     <small>{esc(log.get('query_preview', '')[:100])}</small>
                 </div>""", unsafe_allow_html=True)
 
@@ -5421,7 +7028,10 @@ def render_billing():
         else:
             st.info("No API calls logged yet. Use the AI Assistant to generate your first analysis.")
 
-        st.caption(f"💡 Costs estimated at ${COST_PER_1M_INPUT}/1M input tokens + ${COST_PER_1M_OUTPUT}/1M output tokens (approx Gemini 2.5 Flash pricing).")
+        st.caption("💡 Costs use the token counts Gemini reports for each call (prompt, output, "
+                   "thinking and cached tokens) at per-model rates: " + " · ".join(
+                       f"{m} ${p.get('input', COST_PER_1M_INPUT)}/${p.get('output', COST_PER_1M_OUTPUT)} per 1M in/out"
+                       for m, p in MODEL_PRICES.items()) + ". Set GEMINI_PRICES to override.")
 
 
 # ═══════════════════════════════════════════════════════
@@ -5534,10 +7144,9 @@ Respond ONLY in this exact JSON format, nothing else:
 FACTS: {calc_facts}
 """
             with st.spinner("⏱️ Computing limitation deadlines..."):
-                raw = generate(calc_prompt, IDENTITY_CORE, "brief", "analysis")
+                raw = generate_json(calc_prompt, IDENTITY_CORE, "brief", "analysis")
             try:
-                clean = raw.strip().replace("```json", "").replace("```", "").strip()
-                data = json.loads(clean)
+                data = parse_json_response(raw)
                 causes = data.get("causes_of_action", [])
                 st.markdown("---")
                 for ca in causes:
@@ -5646,17 +7255,11 @@ Respond ONLY in this exact JSON format, nothing else:
 CASE FACTS: {pre_facts}
 """
             with st.spinner("⚠️ Checking pre-action requirements..."):
-                pre_raw = generate(
+                pre_raw = generate_json(
                     pre_prompt, IDENTITY_CORE, "brief", "procedure"
                 )
             try:
-                pre_clean = (
-                    pre_raw.strip()
-                    .replace("```json", "")
-                    .replace("```", "")
-                    .strip()
-                )
-                pre_data = json.loads(pre_clean)
+                pre_data = parse_json_response(pre_raw)
 
                 # ── Overall status banner ──
                 overall = pre_data.get("overall_status", "PRE-ACTION REQUIRED")
@@ -6012,10 +7615,9 @@ Respond ONLY in this exact JSON format, nothing else:
 MATTER FACTS: {aml_facts}
 """
             with st.spinner("🛡️ Checking AML/CFT compliance…"):
-                aml_raw = generate(aml_prompt, IDENTITY_CORE, "brief", "advisory")
+                aml_raw = generate_json(aml_prompt, IDENTITY_CORE, "brief", "advisory")
             try:
-                aml_clean = aml_raw.strip().replace("```json", "").replace("```", "").strip()
-                aml_data = json.loads(aml_clean)
+                aml_data = parse_json_response(aml_raw)
                 risk = aml_data.get("risk_rating", "MEDIUM")
                 risk_colors = {"LOW": ("#f0fdf4","#059669","badge-ok"),
                                "MEDIUM": ("#fef9c3","#d97706","badge-warn"),
@@ -6269,11 +7871,10 @@ arose in January 2024 in Lagos.""",
         )
 
         with st.spinner("🔍 Scanning all clients and cases for conflicts..."):
-            raw = generate(prompt, IDENTITY_CORE, "brief", "advisory")
+            raw = generate_json(prompt, IDENTITY_CORE, "brief", "advisory")
 
         try:
-            clean = raw.strip().replace("```json", "").replace("```", "").strip()
-            data = json.loads(clean)
+            data = parse_json_response(raw)
             st.session_state["conflict_result"] = data
             st.session_state["conflict_matter"] = new_client_name
             st.rerun()
@@ -6943,10 +8544,9 @@ Multiple demand letters sent. No response. Client wants to sue.""",
             facts=facts_input or "Not provided",
         )
         with st.spinner("⚡ Building matter lifecycle workflow..."):
-            raw = generate(prompt, IDENTITY_CORE, "standard", "analysis")
+            raw = generate_json(prompt, IDENTITY_CORE, "standard", "analysis")
         try:
-            clean = raw.strip().replace("```json", "").replace("```", "").strip()
-            lifecycle_data = json.loads(clean)
+            lifecycle_data = parse_json_response(raw)
             db.save_lifecycle(case_id, lifecycle_data)
             # Initialise progress — all stages incomplete
             progress = {
@@ -7604,10 +9204,9 @@ def render_legal_news():
                 today=date.today().strftime("%d %B %Y"),
             )
             with st.spinner(f"📰 Fetching legal developments — {nf_subject}…"):
-                raw = generate(prompt, NEWS_FEED_SYSTEM, "brief", "research")
+                raw = generate_json(prompt, NEWS_FEED_SYSTEM, "brief", "research")
             try:
-                clean = raw.strip().replace("```json", "").replace("```", "").strip()
-                feed_data = json.loads(clean)
+                feed_data = parse_json_response(raw)
                 st.session_state["nf_feed_data"] = feed_data
                 st.session_state["nf_subject_loaded"] = nf_subject
                 # Clear any stale deep-dive results
@@ -7735,7 +9334,8 @@ display:inline-block;font-size:0.9rem;color:var(--la-text);">
                                         takeaway=takeaway, impact=impact,
                                     )
                                     with st.spinner(f"🔬 Analysing: {title[:50]}…"):
-                                        dd_result = generate(dd_prompt, NEWS_DEEPDIVE_SYSTEM, "standard", "analysis")
+                                        dd_result = generate(dd_prompt, NEWS_DEEPDIVE_SYSTEM, "standard", "analysis",
+                                                             priority="background")
                                     st.session_state["nf_deepdive"][item_id] = dd_result
                                     st.rerun()
                             else:
@@ -7923,11 +9523,11 @@ paid. Matter is before the Lagos State Rent Tribunal.""",
                     news_items=news_text,
                 )
                 with st.spinner(f"🎯 Scanning {len(feed_items)} items against your case facts…"):
-                    raw_scan = generate(scan_prompt, NEWS_RELEVANCE_SYSTEM, "brief", "analysis")
+                    raw_scan = generate_json(scan_prompt, NEWS_RELEVANCE_SYSTEM, "brief", "analysis",
+                                             priority="background")
 
                 try:
-                    clean_scan = raw_scan.strip().replace("```json", "").replace("```", "").strip()
-                    scan_data = json.loads(clean_scan)
+                    scan_data = parse_json_response(raw_scan)
                     st.session_state["nf_scan_result"] = scan_data
                 except Exception:
                     st.session_state["nf_scan_result"] = {"_raw": raw_scan}
@@ -9435,6 +11035,7 @@ def render_user_management():
                             st.warning(f"Delete @{user['username']}? ALL their data will be permanently erased.")
                             if st.button(f"⚠️ Confirm Delete @{user['username']}",
                                          key=f"um_del_confirm_{uid}", type="primary"):
+                                get_write_behind().discard(uid)
                                 db.delete_user(uid)
                                 st.success(f"✅ @{user['username']} deleted.")
                                 st.rerun()
@@ -9450,22 +11051,43 @@ def render_user_management():
     # ── Usage Stats ──
     with um_stats:
         st.markdown("##### 📊 Platform Usage by User")
+        ps = db.pool_stats()
+        st.caption(
+            f"🔌 DB pool ({ps['engine']}): {ps['in_use']}/{ps['max']} in use ({ps['saturation']:.0%}) · "
+            f"peak {ps['peak_in_use']} · {ps['idle']} idle · {ps['checkouts']} checkouts · "
+            f"{ps['waits']} waited ({ps['wait_seconds']:.1f}s total) · {ps['timeouts']} timeouts · "
+            f"{ps['replaced']} replaced"
+        )
+        uc, sc = db._user_cache.stats(), db._session_cache.stats()
+        st.caption(
+            f"🗃️ Auth cache: users/profiles {uc['size']} cached, {uc['hits']} hits / {uc['misses']} misses · "
+            f"sessions {sc['size']} cached, {sc['hits']} hits / {sc['misses']} misses"
+        )
+        gc, rl = get_genai_clients().stats(), get_rate_limiter().stats()
+        st.caption(f"🔑 Gemini clients: {gc['clients']} live · {gc['created']} created since start · "
+                   f"limiter: {rl['queued']} queued now, {rl['waited']}/{rl['granted']} calls had to wait")
+        cc = get_context_caches().stats()
+        st.caption(f"📌 Context caches: {cc['live']} live · {cc['created']} created · "
+                   f"{cc['reused']} reuses · {cc['failed']} failed creates")
+        sf = get_single_flight().stats()
+        st.caption(f"🔗 Shared generations: {sf['coalesced']} duplicate requests joined one already "
+                   f"in flight · {sf['in_flight']} running now")
+        runs = db.get_maintenance_runs()
+        if runs:
+            st.caption("🧹 Maintenance: " + " · ".join(
+                f"{job} {r['last_run'][:16].replace('T', ' ')} — {r['last_result'] or 'running'}"
+                for job, r in sorted(runs.items())
+            ))
         users = db.list_users()
         if not users:
             st.info("No users yet.")
         else:
             for user in users:
                 uid = user["user_id"]
-                cur = db._execute(
-                    "SELECT COUNT(*), COALESCE(SUM(estimated_cost),0) FROM cost_logs WHERE user_id = %s",
-                    (uid,)
-                )
-                row = cur.fetchone()
-                calls, cost = (row[0], row[1]) if row else (0, 0)
-                cur2 = db._execute(
-                    "SELECT COUNT(*) FROM kv_store WHERE key LIKE %s", (f"u:{uid}:cases",)
-                )
-                # Get case count from namespaced kv
+                usage = db.get_cost_summary(uid)
+                calls, cost = usage["total_calls"], usage["total_cost"]
+                cur2 = db._execute("SELECT COUNT(*) FROM cases WHERE user_id = %s", (uid,))
+                n_cases = (cur2.fetchone() or (0,))[0]
                 st.markdown(f"""
 <div class="custom-card">
   <div style="display:flex;justify-content:space-between;">
@@ -9474,7 +11096,7 @@ def render_user_management():
       {'Admin' if user['role'] == 'admin' else 'User'}
     </span>
   </div>
-  <small>🤖 {calls} AI calls · 💰 ${cost:.4f} estimated cost · 
+  <small>📁 {n_cases} cases · 🤖 {calls} AI calls · 💰 ${cost:.4f} estimated cost · 
   🕐 Last login: {esc(fmt_date(user.get('last_login','')))}
   </small>
 </div>""", unsafe_allow_html=True)
@@ -9483,15 +11105,68 @@ def render_user_management():
 # ═══════════════════════════════════════════════════════
 # MAIN ENTRY POINT
 # ═══════════════════════════════════════════════════════
+GENAI_CLIENT_IDLE_TTL = 900.0  # drop a key's client after 15 idle minutes
+
+
+class GenaiClientRegistry:
+    """One genai.Client per API key, shared by every session in the process.
+
+    A client owns an HTTP connection pool, so reusing it keeps TLS connections
+    warm between calls instead of handshaking on each one; the SDK's client is
+    safe to use from several threads. Clients unused for `idle_ttl` seconds are
+    dropped on the next lookup — a call still running on one keeps its own
+    reference, so eviction never interrupts it.
+    """
+
+    def __init__(self, idle_ttl: float = GENAI_CLIENT_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self._clients: dict = {}   # sha256(key) -> [client, last_used]
+        self._lock = threading.Lock()
+        self.created = 0
+
+    @staticmethod
+    def _slot(key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key: str):
+        now = time.monotonic()
+        slot = self._slot(key)
+        with self._lock:
+            for s in [s for s, (_, used) in self._clients.items()
+                      if s != slot and now - used > self.idle_ttl]:
+                del self._clients[s]
+            entry = self._clients.get(slot)
+            if entry is None:
+                entry = self._clients[slot] = [genai.Client(api_key=key), now]
+                self.created += 1
+            entry[1] = now
+            return entry[0]
+
+    def discard(self, key: str):
+        """Forget the client for `key` (e.g. the key was rejected)."""
+        with self._lock:
+            self._clients.pop(self._slot(key), None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"clients": len(self._clients), "created": self.created}
+
+
+@st.cache_resource
+def get_genai_clients() -> GenaiClientRegistry:
+    """Process-wide genai client registry."""
+    return GenaiClientRegistry()
+
+
 def _get_genai_client(key: str):
-    return genai.Client(api_key=key)
+    return get_genai_clients().get(key)
 
 
 def add_client(data: dict):
     data["id"] = new_id()
     data["created_at"] = datetime.now().isoformat()
     st.session_state.clients.append(data)
-    persist("clients")
+    persist_record("clients", data, new=True)
 
 
 def add_time_entry(data: dict):
@@ -9499,7 +11174,7 @@ def add_time_entry(data: dict):
     data["created_at"] = datetime.now().isoformat()
     data["amount"] = data.get("hours", 0) * data.get("rate", 0)
     st.session_state.time_entries.append(data)
-    persist("time_entries")
+    persist_record("time_entries", data, new=True)
 
 
 def add_to_history(query: str, response: str, task: str, mode: str):
@@ -9513,12 +11188,33 @@ def add_to_history(query: str, response: str, task: str, mode: str):
         "word_count": len(response.split()),
     }
     st.session_state.chat_history.append(entry)
+    st.session_state.setdefault("session_history_ids", []).append(entry["id"])
+    persist_record("chat_history", entry, new=True)
     # Cap at 200 most recent sessions to prevent unbounded DB growth
     if len(st.session_state.chat_history) > 200:
+        dropped = st.session_state.chat_history[:-200]
         st.session_state.chat_history = st.session_state.chat_history[-200:]
-    persist("chat_history")
+        persist_delete("chat_history", *[e["id"] for e in dropped if e.get("id")])
     return entry
 
+
+def replace_history_entry(entry_id: Optional[str], response: str) -> bool:
+    """Swap the response of history entry `entry_id` in place (an accepted
+    quality upgrade). False if the entry is no longer in the history."""
+    entry = next((e for e in st.session_state.chat_history if e.get("id") == entry_id), None)
+    if entry is None:
+        return False
+    entry.update(response=response, word_count=len(response.split()))
+    persist_record("chat_history", entry)
+    return True
+
+
+def session_history() -> list:
+    """History entries created in this browser session, oldest first — not the
+    persisted history loaded at login, which spans earlier logins and matters."""
+    ids = set(st.session_state.get("session_history_ids", []))
+    return [e for e in st.session_state.get("chat_history", []) if e.get("id") in ids]
+
 # ═══════════════════════════════════════════════════════
 # HEARING REMINDER AUTO-SENDER
 # ═══════════════════════════════════════════════════════
@@ -9619,26 +11315,47 @@ def days_until(d) -> int:
 
 def delete_case(cid: str):
     st.session_state.cases = [c for c in st.session_state.cases if c["id"] != cid]
-    persist("cases")
+    persist_delete("cases", cid)
     get_db().delete_case_analyses_for_case(cid)
 
 
 def delete_client(cid: str):
     st.session_state.clients = [c for c in st.session_state.clients if c["id"] != cid]
-    persist("clients")
+    persist_delete("clients", cid)
 
 
 def delete_time_entry(eid: str):
     st.session_state.time_entries = [e for e in st.session_state.time_entries if e["id"] != eid]
-    persist("time_entries")
+    persist_delete("time_entries", eid)
 
 
-def estimate_cost(input_text: str, output_text: str) -> float:
-    """Estimate API cost from text lengths."""
-    input_tokens = len(input_text) / 4
-    output_tokens = len(output_text) / 4
-    cost = (input_tokens / 1_000_000) * COST_PER_1M_INPUT + (output_tokens / 1_000_000) * COST_PER_1M_OUTPUT
-    return round(cost, 6)
+def estimate_cost(input_text: str, output_text: str, model: str = "") -> float:
+    """Estimate API cost from text lengths (~4 chars/token). Used only when the
+    SDK reports no usage, and for the value of cache hits."""
+    return usage_cost(model, {
+        "prompt_tokens": len(input_text) / 4,
+        "output_tokens": len(output_text) / 4,
+    })
+
+
+def usage_cost(model: str, usage: dict) -> float:
+    """USD cost of one call's token usage at MODEL_PRICES rates."""
+    price = MODEL_PRICES.get(model, {})
+    rate_in = price.get("input", COST_PER_1M_INPUT)
+    rate_out = price.get("output", COST_PER_1M_OUTPUT)
+    rate_cached = price.get("cached", rate_in)
+    cached = usage.get("cached_tokens", 0)
+    cost = ((usage.get("prompt_tokens", 0) - cached) * rate_in
+            + cached * rate_cached
+            + (usage.get("output_tokens", 0) + usage.get("thinking_tokens", 0)) * rate_out)
+    return round(cost / 1_000_000, 6)
+
+
+def context_cache_cost(model: str, tokens: float, ttl: float) -> float:
+    """USD to create a context cache of `tokens` and store it for `ttl` seconds."""
+    price = MODEL_PRICES.get(model, {})
+    rate = price.get("input", COST_PER_1M_INPUT) + price.get("storage", 0.0) * ttl / 3600
+    return round(tokens * rate / 1_000_000, 6)
 
 
 def fmt_currency(amount) -> str:
@@ -9658,133 +11375,1479 @@ def fmt_date(d) -> str:
     except Exception:
         return str(d)
 
-def generate(prompt: str, system: str, mode: str, task: str = "general",
-             stream_to: Optional[Any] = None, enable_quality_gate: bool = True) -> str:
-    """Core generation with streaming, quality gate, retry, and cost logging.
-
-    Args:
-        prompt: User query / content
-        system: System instruction
-        mode: brief / standard / comprehensive
-        task: For cost logging
-        stream_to: Optional Streamlit container for streaming display
-        enable_quality_gate: If True, low-quality responses are auto-regenerated once
 
-    Returns:
-        Final response text
+# ═══════════════════════════════════════════════════════
+# MODEL ROUTING & FAILOVER
+# ═══════════════════════════════════════════════════════
+ROUTE_LITE_MODEL = "gemini-2.5-flash-lite"  # brief, small requests (JSON widgets, checklists)
+ROUTE_PRO_MODEL = "gemini-2.5-pro"          # comprehensive analysis
+ROUTE_LITE_MAX_CHARS = 12_000               # larger brief prompts stay on the default model
+ROUTE_NO_LITE_TASKS = ("drafting", "contract_review")  # full documents; never the lite tier
+ROUTER_MAX_ATTEMPTS = 4
+ROUTER_MAX_WAIT = 30.0  # longest we sleep for a cooling model before giving up
+
+
+def _retry_after_seconds(exc: Exception) -> float:
+    """Server-suggested wait from a Retry-After header or a RetryInfo retryDelay."""
+    if isinstance(getattr(exc, "retry_after", None), (int, float)):
+        return float(exc.retry_after)
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        try:
+            return max(0.0, float(headers.get("retry-after", "")))
+        except (TypeError, ValueError):
+            pass
+    match = re.search(r"retry_?delay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s",
+                      f"{getattr(exc, 'details', '')} {exc}", re.IGNORECASE)
+    return float(match.group(1)) if match else 0.0
+
+
+def _classify_model_error(exc: Exception) -> tuple:
+    """(kind, retry_after) for a failed call. kind is "rate_limit" (429),
+    "unavailable" (model not served to this key), "transient" (5xx, network)
+    or "fatal" (bad request / auth — another model will not help)."""
+    text = str(exc)
+    code = getattr(exc, "code", None)
+    if not isinstance(code, int):
+        match = re.search(r"\b([45]\d\d)\b", text)
+        code = int(match.group(1)) if match else None
+    retry_after = _retry_after_seconds(exc)
+    if code == 429 or "RESOURCE_EXHAUSTED" in text:
+        return "rate_limit", retry_after
+    if code == 404 or "NOT_FOUND" in text:
+        return "unavailable", retry_after
+    if code is None or code >= 500:
+        return "transient", retry_after
+    return "fatal", 0.0
+
+
+class ModelRouter:
+    """Chooses models per call and tracks per-model health for failover.
+
+    route() orders the candidates for a request: a primary chosen from task,
+    mode and prompt size, then every other supported model. A model that
+    returns 429 or 5xx is put on cooldown — for its Retry-After when the
+    server sends one, else for an exponentially growing backoff — and calls
+    fail over to the next healthy candidate instead of sleeping on it.
+    Health is per process and shared by all sessions.
     """
-    k = _resolve_api_key()
-    if not k:
-        return "⚠️ No API key configured. Please set up your key."
 
-    mode_cfg = RESPONSE_MODES.get(mode, RESPONSE_MODES["standard"])
-    gen_config = _genai_types.GenerateContentConfig(
-        system_instruction=system,
-        temperature=mode_cfg["temp"],
-        top_p=0.92,
-        top_k=40,
-        max_output_tokens=mode_cfg["tokens"],
+    def __init__(self, models: list):
+        self.models = list(models)
+        self._health: dict = {}   # model -> {"cooldown_until", "failures", "calls", "errors", "last_error"}
+        self._lock = threading.Lock()
+
+    def _h(self, model: str) -> dict:
+        return self._health.setdefault(model, {
+            "cooldown_until": 0.0, "failures": 0, "calls": 0, "errors": 0, "last_error": "",
+        })
+
+    def route(self, task: str, mode: str, prompt_chars: int, preferred: str,
+              auto: bool = True) -> list:
+        primary = preferred
+        if auto:
+            if mode == "comprehensive" and ROUTE_PRO_MODEL in self.models:
+                primary = ROUTE_PRO_MODEL
+            elif (mode == "brief" and prompt_chars <= ROUTE_LITE_MAX_CHARS
+                  and task not in ROUTE_NO_LITE_TASKS and ROUTE_LITE_MODEL in self.models):
+                primary = ROUTE_LITE_MODEL
+        others = [m for m in self.models if m != primary]
+        if primary in self.models:
+            # Fail over to the nearest tier first, the cheaper one on a tie
+            pos = self.models.index(primary)
+            others.sort(key=lambda m: (abs(self.models.index(m) - pos), -self.models.index(m)))
+        return [primary] + others
+
+    def pick(self, candidates: list) -> Optional[str]:
+        """First candidate not cooling down, or None if all are."""
+        now = time.monotonic()
+        with self._lock:
+            for model in candidates:
+                if self._h(model)["cooldown_until"] <= now:
+                    return model
+        return None
+
+    def wait_time(self, candidates: list) -> float:
+        now = time.monotonic()
+        with self._lock:
+            return max(0.0, min(self._h(m)["cooldown_until"] for m in candidates) - now)
+
+    def record_success(self, model: str):
+        with self._lock:
+            h = self._h(model)
+            h["calls"] += 1
+            h["failures"] = 0
+
+    def record_failure(self, model: str, kind: str, retry_after: float, error: str):
+        with self._lock:
+            h = self._h(model)
+            h["calls"] += 1
+            h["errors"] += 1
+            h["failures"] += 1
+            h["last_error"] = error[:200]
+            if kind == "unavailable":
+                backoff = 3600.0
+            elif kind == "rate_limit":
+                backoff = min(15.0 * 2 ** (h["failures"] - 1), 300.0)
+            else:
+                backoff = min(2.0 * 2 ** (h["failures"] - 1), 60.0)
+            h["cooldown_until"] = time.monotonic() + (retry_after or backoff)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                m: {"cooldown": max(0.0, h["cooldown_until"] - now), "calls": h["calls"],
+                    "errors": h["errors"], "last_error": h["last_error"]}
+                for m, h in self._health.items()
+            }
+
+
+@st.cache_resource
+def get_model_router() -> ModelRouter:
+    """Process-wide model router over SUPPORTED_MODELS."""
+    return ModelRouter(SUPPORTED_MODELS)
+
+
+def route_models(task: str, mode: str, prompt: str, system: str) -> list:
+    """Candidate models for a request from this session, best fit first."""
+    return get_model_router().route(
+        task, mode, len(prompt) + len(system), st.session_state.gemini_model,
+        auto=st.session_state.get("model_routing", True),
     )
-    client = _get_genai_client(k)
 
-    def _do_generate(use_stream: bool) -> str:
-        """Single attempt. Streams to UI if stream_to is set."""
-        if use_stream and stream_to is not None:
-            full_text = ""
-            placeholder = stream_to.empty()
-            try:
-                stream = client.models.generate_content_stream(
-                    model=st.session_state.gemini_model,
-                    contents=prompt,
-                    config=gen_config,
-                )
-                for chunk in stream:
-                    if chunk.text:
-                        full_text += chunk.text
-                        # Update placeholder with cursor
-                        placeholder.markdown(
-                            f'<div class="response-box">{esc(full_text)}<span style="opacity:0.5;">▌</span></div>',
-                            unsafe_allow_html=True,
-                        )
-                # Final render without cursor
-                placeholder.markdown(
-                    f'<div class="response-box">{esc(full_text)}</div>',
-                    unsafe_allow_html=True,
-                )
-                return full_text
-            except Exception as e:
-                logger.warning(f"Streaming failed, falling back to non-stream: {e}")
-                # Fall through to non-streaming
-        # Non-streaming path
-        resp = client.models.generate_content(
-            model=st.session_state.gemini_model,
-            contents=prompt,
-            config=gen_config,
-        )
-        return resp.text if resp and resp.text else ""
 
-    result = ""
-    for attempt in range(3):
-        try:
-            result = _do_generate(use_stream=(stream_to is not None))
-            if result:
-                break
-        except Exception as e:
-            err_str = str(e)
-            if attempt == 2:
-                return f"⚠️ Generation error after 3 attempts: {err_str[:200]}"
-            time.sleep(2 * (attempt + 1))
+# ═══════════════════════════════════════════════════════
+# GEMINI RATE LIMITING
+# ═══════════════════════════════════════════════════════
+LIMITER_BACKGROUND_RESERVE = 0.2  # share of each bucket background calls may not touch
+LIMITER_MAX_WAIT = 90.0           # longest a call queues before failing over as rate-limited
 
-    if not result:
-        return "⚠️ Empty response from AI. Try rephrasing your query."
 
-    # ── Quality Gate (silent self-critique + auto-regenerate once) ──
-    if enable_quality_gate and mode in ("standard", "comprehensive") and len(result.split()) > 100:
-        quality_score = _assess_response_quality(result, prompt)
-        if quality_score < 5:
-            logger.info(f"Quality gate triggered (score {quality_score}/10) — regenerating")
-            try:
-                regen = _do_generate(use_stream=False)
-                if regen:
-                    new_score = _assess_response_quality(regen, prompt)
-                    if new_score > quality_score:
-                        result = regen
-                        # Re-render to streaming target if applicable
-                        if stream_to is not None:
-                            stream_to.markdown(
-                                f'<div class="response-box">{esc(result)}</div>',
-                                unsafe_allow_html=True,
-                            )
-            except Exception as e:
-                logger.warning(f"Quality regeneration failed: {e}")
+class LocalRateLimited(Exception):
+    """The shared limiter could not admit a call in time. Carries code 429 so
+    the router treats it like a server-side rate limit and fails over."""
+    code = 429
 
-    # ── Cost logging ──
+    def __init__(self, model: str, retry_after: float):
+        super().__init__(f"429 local rate limit for {model}: queue wait exceeded")
+        self.retry_after = retry_after
+
+
+class GeminiRateLimiter:
+    """Process-wide RPM/TPM token buckets per (API key, model) with a fair queue.
+
+    Every Gemini call acquires one request and its estimated input tokens
+    first. Waiters for a bucket are served interactive-before-background, then
+    round-robin across users (whoever was served least recently goes next),
+    then first-come. Background calls may not dip into the last
+    LIMITER_BACKGROUND_RESERVE of a bucket, keeping headroom for people who
+    are waiting on screen. Token estimates are settled against the SDK's
+    reported prompt tokens once the call finishes.
+    """
+
+    def __init__(self, limits: dict, reserve: float = LIMITER_BACKGROUND_RESERVE):
+        self.limits = limits
+        self.reserve = reserve
+        self._cond = threading.Condition()
+        self._buckets: dict = {}     # (key slot, model) -> {"rpm": [level, cap], "tpm": [...], "at": t}
+        self._waiters: list = []     # tickets, see acquire()
+        self._last_grant: dict = {}  # user_id -> grant sequence number
+        self._seq = itertools.count()
+        self.granted = 0
+        self.waited = 0
+
+    def _bucket(self, slot: tuple) -> dict:
+        b = self._buckets.get(slot)
+        if b is None:
+            lim = self.limits.get(slot[1], DEFAULT_RATE_LIMIT)
+            b = self._buckets[slot] = {
+                "rpm": [float(lim.get("rpm", 0)), float(lim.get("rpm", 0))],
+                "tpm": [float(lim.get("tpm", 0)), float(lim.get("tpm", 0))],
+                "at": time.monotonic(),
+            }
+        now = time.monotonic()
+        for name in ("rpm", "tpm"):
+            level, cap = b[name]
+            if cap:
+                b[name][0] = min(cap, level + cap * (now - b["at"]) / 60.0)
+        b["at"] = now
+        return b
+
+    def _wait_for(self, b: dict, tokens: float, background: bool) -> float:
+        """Seconds until `b` can admit one request of `tokens` (0 if it can now)."""
+        wait = 0.0
+        for name, need in (("rpm", 1.0), ("tpm", tokens)):
+            level, cap = b[name]
+            if not cap:
+                continue
+            need = min(need, cap * (1 - self.reserve)) + (cap * self.reserve if background else 0)
+            if level < need:
+                wait = max(wait, (need - level) * 60.0 / cap)
+        return wait
+
+    def _order(self, ticket: dict) -> tuple:
+        return (ticket["rank"], self._last_grant.get(ticket["user"], -1), ticket["seq"])
+
+    @staticmethod
+    def _slot(key: str, model: str) -> tuple:
+        return hashlib.sha256(key.encode()).hexdigest()[:16], model
+
+    def acquire(self, key: str, model: str, tokens: float, user_id: str = "",
+                priority: str = "interactive", on_wait=None,
+                timeout: float = LIMITER_MAX_WAIT):
+        """Block until the call may go ahead. `on_wait(position, eta_seconds)` is
+        called (outside the lock) while queued. Raises LocalRateLimited on timeout."""
+        slot = self._slot(key, model)
+        background = priority != "interactive"
+        ticket = {"slot": slot, "user": user_id, "rank": int(background), "seq": next(self._seq)}
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._waiters.append(ticket)
+        queued = False
+        try:
+            while True:
+                with self._cond:
+                    b = self._bucket(slot)
+                    queue = sorted((t for t in self._waiters if t["slot"] == slot), key=self._order)
+                    position = queue.index(ticket)
+                    wait = self._wait_for(b, tokens, background)
+                    if position == 0 and wait <= 0:
+                        b["rpm"][0] -= 1 if b["rpm"][1] else 0
+                        b["tpm"][0] -= tokens if b["tpm"][1] else 0
+                        self._last_grant[user_id] = next(self._seq)
+                        self.granted += 1
+                        self.waited += int(queued)
+                        return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise LocalRateLimited(model, wait)
+                    self._cond.wait(min(max(wait, 0.05), remaining, 1.0))
+                queued = True
+                if on_wait is not None:
+                    on_wait(position + 1, wait)
+        finally:
+            with self._cond:
+                if ticket in self._waiters:
+                    self._waiters.remove(ticket)
+                self._cond.notify_all()
+
+    def settle(self, key: str, model: str, reserved: float, actual: float):
+        """Correct a bucket once the real prompt token count is known."""
+        if not actual:
+            return
+        with self._cond:
+            b = self._bucket(self._slot(key, model))
+            if b["tpm"][1]:
+                b["tpm"][0] = min(b["tpm"][1], b["tpm"][0] + reserved - actual)
+            self._cond.notify_all()
+
+    def wrap(self, client, key: str, user_id: str = "", priority: str = "interactive",
+             on_wait=None) -> "RateLimitedClient":
+        return RateLimitedClient(self, client, key, user_id, priority, on_wait)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"queued": len(self._waiters), "granted": self.granted, "waited": self.waited}
+
+
+class RateLimitedClient:
+    """Drop-in for genai.Client whose models.generate_content(_stream) calls go
+    through a GeminiRateLimiter on behalf of one user at one priority."""
+
+    def __init__(self, limiter: GeminiRateLimiter, client, key: str, user_id: str,
+                 priority: str, on_wait):
+        self.limiter = limiter
+        self.client = client
+        self.key = key
+        self.user_id = user_id
+        self.priority = priority
+        self.on_wait = on_wait
+        self.models = self  # client.models.generate_content(...) call shape
+
+    @property
+    def caches(self):
+        """Context cache management goes straight to the client, unthrottled."""
+        return self.client.caches
+
+    def _admit(self, model: str, contents, config) -> float:
+        system = getattr(config, "system_instruction", "") or ""
+        tokens = (len(str(contents)) + len(str(system))) / 4
+        self.limiter.acquire(self.key, model, tokens, self.user_id, self.priority, self.on_wait)
+        return tokens
+
+    def generate_content(self, model: str, contents, config=None, **kw):
+        tokens = self._admit(model, contents, config)
+        resp = self.client.models.generate_content(model=model, contents=contents,
+                                                   config=config, **kw)
+        meta = getattr(resp, "usage_metadata", None)
+        self.limiter.settle(self.key, model, tokens, getattr(meta, "prompt_token_count", 0) or 0)
+        return resp
+
+    def generate_content_stream(self, model: str, contents, config=None, **kw):
+        # Admitted here, not on first iteration, so LocalRateLimited reaches the
+        # caller before it starts consuming the stream
+        tokens = self._admit(model, contents, config)
+        stream = self.client.models.generate_content_stream(
+            model=model, contents=contents, config=config, **kw)
+        return self._relay(stream, model, tokens)
+
+    def _relay(self, stream, model: str, tokens: float):
+        meta = None
+        try:
+            for chunk in stream:
+                meta = getattr(chunk, "usage_metadata", None) or meta
+                yield chunk
+        finally:
+            self.limiter.settle(self.key, model, tokens,
+                                getattr(meta, "prompt_token_count", 0) or 0)
+
+
+@st.cache_resource
+def get_rate_limiter() -> GeminiRateLimiter:
+    """Process-wide Gemini limiter shared by every session on this replica."""
+    return GeminiRateLimiter(MODEL_RATE_LIMITS)
+
+
+def limited_client(key: str, priority: str = "interactive", on_wait=None) -> RateLimitedClient:
+    """This session's view of the shared client for `key`, behind the limiter."""
+    return get_rate_limiter().wrap(_get_genai_client(key), key,
+                                   st.session_state.get("current_user_id", ""), priority, on_wait)
+
+
+# ═══════════════════════════════════════════════════════
+# GEMINI CONTEXT CACHING
+# ═══════════════════════════════════════════════════════
+CONTEXT_CACHE_TTL = 3600            # lifetime of a cached system prompt on Gemini's side
+CONTEXT_CACHE_REFRESH_MARGIN = 300  # recreate this long before expiry rather than race it
+CONTEXT_CACHE_RETRY_AFTER = 900     # after a failed create, use plain requests this long
+CONTEXT_CACHE_MIN_TOKENS = {"gemini-2.5-pro": 2048}  # smallest cacheable prompt per model
+DEFAULT_CONTEXT_CACHE_MIN_TOKENS = 1024
+
+
+class ContextCacheRegistry:
+    """Explicit Gemini context caches for the static system prompts.
+
+    The prompt blocks (IDENTITY_CORE, STRATEGY_BLOCK, the mode prompt and task
+    modifier) are the same for every user, so a system instruction that is
+    used again within the TTL for the same API key and model is uploaded with
+    client.caches.create and referenced by name afterwards. Cached input
+    tokens are billed at the cached rate and skip prefill; creating a cache
+    bills the prompt plus an hour of storage, which is logged to cost_logs as
+    task "context_cache", so one-off combinations are never cached. If
+    creating a cache fails (unsupported model, tier or quota), that key and
+    model go back to plain requests for CONTEXT_CACHE_RETRY_AFTER.
+    """
+
+    def __init__(self, db: Database, ttl: int = CONTEXT_CACHE_TTL):
+        self.db = db
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: dict = {}      # (key slot, model, system digest) -> (name, expires_at)
+        self._last_used: dict = {}    # same slot -> last time the prompt was sent
+        self._unavailable: dict = {}  # (key slot, model) -> retry_at
+        self._creating: dict = {}     # slot -> Lock, so one session creates while others wait
+        self.created = 0
+        self.reused = 0
+        self.failed = 0
+
+    @staticmethod
+    def _slot(key: str, model: str, system: str) -> tuple:
+        return (hashlib.sha256(key.encode()).hexdigest()[:16], model,
+                hashlib.sha256(system.encode("utf-8")).hexdigest()[:24])
+
+    def cache_name(self, client, key: str, model: str, system: str, user_id: str = "") -> str:
+        """Name of a live cache holding `system` for this key and model, creating
+        one if the prompt was also sent within the TTL; "" when the request
+        should go out uncached."""
+        if len(system) // 4 < CONTEXT_CACHE_MIN_TOKENS.get(model, DEFAULT_CONTEXT_CACHE_MIN_TOKENS):
+            return ""
+        slot = self._slot(key, model, system)
+        now = time.time()
+        with self._lock:
+            last_used = self._last_used.get(slot, 0.0)
+            self._last_used[slot] = now
+            if len(self._last_used) > 4096:
+                self._last_used = {s: t for s, t in self._last_used.items()
+                                   if now - t <= self.ttl}
+            if self._unavailable.get(slot[:2], 0) > now:
+                return ""
+            entry = self._entries.get(slot)
+            if entry and entry[1] - CONTEXT_CACHE_REFRESH_MARGIN > now:
+                self.reused += 1
+                return entry[0]
+            if now - last_used > self.ttl:
+                return ""  # first use in this window: a cache would cost more than it saves
+            creating = self._creating.setdefault(slot, threading.Lock())
+        with creating:
+            with self._lock:
+                entry = self._entries.get(slot)
+                if entry and entry[1] - CONTEXT_CACHE_REFRESH_MARGIN > time.time():
+                    self.reused += 1
+                    return entry[0]  # another session created it while we waited
+            try:
+                cache = client.caches.create(
+                    model=model,
+                    config=_genai_types.CreateCachedContentConfig(
+                        system_instruction=system,
+                        ttl=f"{self.ttl}s",
+                        display_name=f"lexiassist-{slot[2][:12]}",
+                    ),
+                )
+            except Exception as e:
+                logger.warning(f"Context cache unavailable for {model}, sending prompts inline: "
+                               f"{str(e)[:120]}")
+                with self._lock:
+                    self._unavailable[slot[:2]] = time.time() + CONTEXT_CACHE_RETRY_AFTER
+                    self.failed += 1
+                return ""
+            with self._lock:
+                self._entries[slot] = (cache.name, time.time() + self.ttl)
+                self.created += 1
+            self._log_creation(cache, model, system, user_id)
+            return cache.name
+
+    def _log_creation(self, cache, model: str, system: str, user_id: str):
+        meta = getattr(cache, "usage_metadata", None)
+        tokens = getattr(meta, "total_token_count", 0) or estimate_tokens(system)
+        try:
+            self.db.add_cost_log({
+                "id": new_id(),
+                "timestamp": datetime.now().isoformat(),
+                "model": model,
+                "task": "context_cache",
+                "mode": "",
+                "input_chars": len(system),
+                "output_chars": 0,
+                "estimated_cost": context_cache_cost(model, tokens, self.ttl),
+                "query_preview": f"context cache {cache.name}"[:120],
+                "prompt_tokens": tokens,
+                **({"user_id": user_id} if user_id else {}),
+            })
+        except Exception as e:
+            logger.warning(f"Cost logging failed: {e}")
+
+    def invalidate(self, key: str, model: str, system: str):
+        with self._lock:
+            self._entries.pop(self._slot(key, model, system), None)
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            live = sum(1 for _, expires in self._entries.values() if expires > now)
+            return {"live": live, "created": self.created, "reused": self.reused,
+                    "failed": self.failed}
+
+
+@st.cache_resource
+def get_context_caches() -> ContextCacheRegistry:
+    """Process-wide registry of Gemini context caches."""
+    return ContextCacheRegistry(get_db())
+
+
+def _with_context_cache(client, model: str, gen_config, caches: Optional[ContextCacheRegistry]):
+    """`gen_config` pointing at a cached copy of its system instruction, or
+    `gen_config` itself when caching does not apply. Needs a registry and a
+    RateLimitedClient (which knows its API key); otherwise sent uncached."""
+    system = getattr(gen_config, "system_instruction", None)
+    key = getattr(client, "key", "")
+    if not (CONTEXT_CACHE_ENABLED and caches is not None and system and key
+            and isinstance(system, str)):
+        return gen_config
+    name = caches.cache_name(client, key, model, system, getattr(client, "user_id", ""))
+    if not name:
+        return gen_config
+    cached = copy.copy(gen_config)
+    cached.system_instruction = None  # the API rejects both together
+    cached.cached_content = name
+    return cached
+
+
+def _is_context_cache_error(exc: Exception) -> bool:
+    """The request failed because of its cached_content reference (expired,
+    deleted or not visible to this key)."""
+    return bool(re.search(r"cached[_ ]?content", str(exc), re.IGNORECASE))
+
+
+# ═══════════════════════════════════════════════════════
+# LLM RESPONSE CACHE
+# ═══════════════════════════════════════════════════════
+def llm_cache_key(model: str, system: str, prompt: str, temperature: float,
+                  max_tokens: int, **extra) -> str:
+    """Content address of one generation request: any input that can change the
+    output is part of the key, so a hit is byte-for-byte the same request."""
+    payload = json.dumps(
+        {"model": model, "system": system, "prompt": prompt, "temperature": temperature,
+         "max_tokens": max_tokens, **extra},
+        sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """Two-tier response cache: a process-local TTLCache in front of the shared
+    llm_cache table. Entries keep the expiry of the task they were stored under;
+    a database hit is promoted into memory for the remainder of its life."""
+
+    def __init__(self, db: Database, memory_size: int = LLM_CACHE_MEMORY_SIZE):
+        self.db = db
+        self.memory = TTLCache(maxsize=memory_size, ttl=3600)
+
+    def get(self, key: str) -> Optional[str]:
+        hit = self.memory.get(key)
+        if hit is not None:
+            return hit
+        try:
+            entry = self.db.get_llm_cache_entry(key)
+        except Exception as e:
+            logger.warning(f"LLM cache lookup failed: {e}")
+            return None
+        if not entry:
+            return None
+        remaining = (datetime.fromisoformat(entry["expires_at"]) - datetime.now()).total_seconds()
+        if remaining > 0:
+            self.memory.set(key, entry["response"], ttl=remaining)
+        return entry["response"]
+
+    def put(self, key: str, response: str, ttl: float, model: str = "", task: str = "",
+            input_chars: int = 0):
+        self.memory.set(key, response, ttl=ttl)
+        try:
+            self.db.put_llm_cache_entry(key, model, task, response, input_chars, ttl)
+        except Exception as e:
+            logger.warning(f"LLM cache store failed: {e}")
+
+
+@st.cache_resource
+def get_llm_cache() -> LLMResponseCache:
+    """Process-wide response cache in front of get_db()."""
+    return LLMResponseCache(get_db())
+
+
+SINGLE_FLIGHT_MAX_WAIT = 300.0  # a follower gives up on a stuck leader after this long
+
+
+class _Flight:
+    """One in-flight generation: the leader's streamed chunks and final outcome."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.events: list = []   # (delta, restart) in arrival order
+        self.done = False
+        self.result = ""
+        self.error: Optional[Exception] = None
+        self.followers = 0
+
+    def publish(self, delta: str, restart: bool = False):
+        with self.cond:
+            self.events.append((delta, restart))
+            self.cond.notify_all()
+
+    def follow(self, on_text=None, timeout: float = SINGLE_FLIGHT_MAX_WAIT) -> str:
+        """Replay the leader's stream into `on_text` as it arrives and return its
+        result — "" if the leader was stopped without one. Raises the leader's
+        error, or TimeoutError if it never finishes."""
+        deadline = time.monotonic() + timeout
+        seen = 0
+        while True:
+            with self.cond:
+                while seen == len(self.events) and not self.done:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("in-flight generation did not finish in time")
+                    self.cond.wait(min(remaining, 1.0))
+                batch, seen = self.events[seen:], len(self.events)
+                done = self.done
+            if on_text is not None:
+                for delta, restart in batch:
+                    on_text(delta, restart)
+            if done and seen == len(self.events):
+                if self.error is not None:
+                    raise self.error
+                return self.result
+
+
+class SingleFlight:
+    """Coalesces identical concurrent generate() calls across sessions.
+
+    The first caller for a cache key becomes the leader and runs the request;
+    callers arriving while it is in flight attach as followers, see the same
+    stream, and share its result instead of paying for their own generation.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: dict = {}
+        self.led = 0
+        self.coalesced = 0
+
+    def join(self, key: str) -> tuple:
+        """(flight, is_leader) for `key`."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                self.coalesced += 1
+                return flight, False
+            flight = self._flights[key] = _Flight()
+            self.led += 1
+            return flight, True
+
+    def complete(self, key: str, flight: _Flight, result: str = "",
+                 error: Optional[Exception] = None):
+        """Leader only: publish the outcome and retire the flight."""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        with flight.cond:
+            flight.result, flight.error, flight.done = result, error, True
+            flight.cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": len(self._flights), "led": self.led, "coalesced": self.coalesced}
+
+
+@st.cache_resource
+def get_single_flight() -> SingleFlight:
+    """Process-wide registry of in-flight generations."""
+    return SingleFlight()
+
+
+class GenerationCancelled(Exception):
+    """Raised from inside a streaming generation whose job was cancelled."""
+
+
+STREAM_FRAME_SECONDS = 0.08    # at most ~12 UI updates per second while streaming
+STREAM_SEGMENT_CHARS = 6000    # live tail size at which it is frozen into its own element
+
+
+class StreamRenderer:
+    """Incremental on_text sink for streaming a response into a Streamlit container.
+
+    Each chunk is escaped once on arrival and buffered; the browser is only
+    updated once per STREAM_FRAME_SECONDS. Only the live tail is re-sent on an
+    update: once it grows past STREAM_SEGMENT_CHARS, everything up to its last
+    paragraph break is frozen in place and a fresh element takes over, so the
+    per-frame payload stays bounded however long the answer gets. `finish()`
+    swaps the segments for a single response box.
+    """
+
+    def __init__(self, target, frame: float = STREAM_FRAME_SECONDS,
+                 segment_chars: int = STREAM_SEGMENT_CHARS):
+        self.slot = target.empty()
+        self.frame = frame
+        self.segment_chars = segment_chars
+        self._start()
+
+    def _start(self):
+        self.box = self.slot.container()
+        self.tail = self.box.empty()
+        self.tail_html: list = []
+        self.tail_chars = 0
+        self.last_paint = 0.0
+
+    def __call__(self, delta: str, restart: bool = False):
+        if restart:
+            self._start()  # failover: the next model streams from scratch
+        piece = esc(delta)
+        self.tail_html.append(piece)
+        self.tail_chars += len(piece)
+        now = time.monotonic()
+        if now - self.last_paint >= self.frame:
+            self.last_paint = now
+            self._paint()
+
+    def _paint(self):
+        html = "".join(self.tail_html)
+        if self.tail_chars >= self.segment_chars:
+            cut = html.rfind("\n\n", 0, self.tail_chars - 1)
+            if cut < self.segment_chars // 2:
+                cut = html.rfind("\n", 0, self.tail_chars - 1)
+            if cut <= 0:
+                cut = len(html)  # no line breaks at all: freeze the whole tail
+            self.tail.markdown(f'<div class="stream-seg">{html[:cut]}</div>',
+                               unsafe_allow_html=True)
+            self.tail = self.box.empty()
+            html = html[cut:].lstrip("\n")
+            self.tail_html, self.tail_chars = [html], len(html)
+        self.tail.markdown(f'<div class="stream-seg">{html}<span style="opacity:0.5;">▌</span></div>',
+                           unsafe_allow_html=True)
+
+    def finish(self, text: str):
+        """Replace the streamed segments with the final answer in one box."""
+        self.slot.markdown(f'<div class="response-box">{esc(text)}</div>', unsafe_allow_html=True)
+
+
+def _generation_config(system: str, mode_cfg: dict, json_schema: Optional[dict] = None):
+    """Request config; with `json_schema` (use {} for "any JSON") the model is
+    constrained to emit JSON, and to that schema when one is given."""
+    structured = {}
+    if json_schema is not None:
+        structured["response_mime_type"] = "application/json"
+        if json_schema:
+            structured["response_schema"] = json_schema
+    return _genai_types.GenerateContentConfig(
+        system_instruction=system,
+        temperature=mode_cfg["temp"],
+        top_p=0.92,
+        top_k=40,
+        max_output_tokens=mode_cfg["tokens"],
+        **structured,
+    )
+
+
+def _add_usage(usage: Optional[dict], meta) -> None:
+    """Accumulate a response's usage_metadata token counts into `usage`."""
+    if usage is None or meta is None:
+        return
+    for key, attr in (("prompt_tokens", "prompt_token_count"),
+                      ("output_tokens", "candidates_token_count"),
+                      ("thinking_tokens", "thoughts_token_count"),
+                      ("cached_tokens", "cached_content_token_count")):
+        usage[key] = usage.get(key, 0) + (getattr(meta, attr, None) or 0)
+
+
+def _note_finish_reason(usage: Optional[dict], response) -> None:
+    """Record why the model stopped ("STOP", "MAX_TOKENS", ...) in `usage`."""
+    candidates = getattr(response, "candidates", None)
+    reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    if usage is not None and reason is not None:
+        usage["finish_reason"] = getattr(reason, "name", str(reason)).split(".")[-1]
+
+
+def _generate_once(client, model: str, prompt: str, gen_config, on_text=None,
+                   should_stop=None, usage: Optional[dict] = None) -> str:
+    """Single attempt. With `on_text`, streams and calls on_text(delta, restart) per
+    chunk (restart is True for the attempt's first chunk), falling back to one
+    blocking request if the stream itself breaks. Rate limits and unavailable
+    models are raised straight to the router instead. Token counts reported by
+    the SDK are added to `usage` when given, along with the response's
+    "finish_reason"."""
+    if on_text is not None:
+        parts: list = []
+        meta = None
+        try:
+            stream = client.models.generate_content_stream(
+                model=model,
+                contents=prompt,
+                config=gen_config,
+            )
+            for chunk in stream:
+                if should_stop is not None and should_stop():
+                    raise GenerationCancelled()
+                # Each chunk carries running totals; the last one is the call's usage
+                meta = getattr(chunk, "usage_metadata", None) or meta
+                _note_finish_reason(usage, chunk)
+                if chunk.text:
+                    on_text(chunk.text, not parts)
+                    parts.append(chunk.text)
+            _add_usage(usage, meta)
+            return "".join(parts)
+        except GenerationCancelled:
+            _add_usage(usage, meta)
+            raise
+        except Exception as e:
+            if _classify_model_error(e)[0] in ("rate_limit", "unavailable"):
+                raise  # a blocking retry on the same model would fail the same way
+            logger.warning(f"Streaming failed, falling back to non-stream: {e}")
+            # Fall through to non-streaming
+    # Non-streaming path
+    resp = client.models.generate_content(
+        model=model,
+        contents=prompt,
+        config=gen_config,
+    )
+    _add_usage(usage, getattr(resp, "usage_metadata", None))
+    _note_finish_reason(usage, resp)
+    return resp.text if resp and resp.text else ""
+
+
+def _generate_once_cached(client, model: str, prompt: str, gen_config, on_text=None,
+                         should_stop=None, usage: Optional[dict] = None,
+                         caches: Optional[ContextCacheRegistry] = None) -> str:
+    """_generate_once with the system instruction served from a context cache
+    when one applies. If the cached request fails because of the cache (for
+    example it expired early or was deleted), the cache entry is dropped and
+    the request is sent again with the prompt inline. Without `caches` this is
+    plain _generate_once."""
+    config = _with_context_cache(client, model, gen_config, caches)
+    if config is gen_config:
+        return _generate_once(client, model, prompt, gen_config, on_text, should_stop, usage)
+    try:
+        return _generate_once(client, model, prompt, config, on_text, should_stop, usage)
+    except GenerationCancelled:
+        raise
+    except Exception as e:
+        if not _is_context_cache_error(e):
+            raise
+        logger.warning(f"Cached system prompt rejected by {model}, resending inline: {str(e)[:120]}")
+        caches.invalidate(client.key, model, gen_config.system_instruction)
+        return _generate_once(client, model, prompt, gen_config, on_text, should_stop, usage)
+
+
+def _generate_with_failover(client, router: ModelRouter, candidates: list, prompt: str,
+                            gen_config, on_text=None, should_stop=None,
+                            usage: Optional[dict] = None,
+                            caches: Optional[ContextCacheRegistry] = None) -> tuple:
+    """Try `candidates` in order, skipping models the router has cooling down.
+    Rate limits and server errors fail over to the next model; when every
+    candidate is cooling, wait for the soonest (up to ROUTER_MAX_WAIT). With
+    `caches`, the system instruction may be served from a context cache.
+    Returns (text, model_used); raises the last error if nothing succeeded."""
+    last_error: Optional[Exception] = None
+    model = candidates[0]
+    for _ in range(ROUTER_MAX_ATTEMPTS):
+        picked = router.pick(candidates)
+        if picked is None:
+            wait = router.wait_time(candidates)
+            if wait > ROUTER_MAX_WAIT:
+                break
+            time.sleep(wait)
+            picked = router.pick(candidates) or candidates[0]
+        model = picked
+        try:
+            result = _generate_once_cached(client, model, prompt, gen_config, on_text,
+                                           should_stop, usage=usage, caches=caches)
+            router.record_success(model)
+            if result:
+                return result, model
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            kind, retry_after = _classify_model_error(e)
+            if kind == "fatal":
+                raise
+            last_error = e
+            router.record_failure(model, kind, retry_after, str(e))
+            logger.warning(f"{model} failed ({kind}), failing over: {str(e)[:120]}")
+    if last_error is not None:
+        raise last_error
+    return "", model
+
+
+CONTINUABLE_FINISH_REASONS = ("MAX_TOKENS", "RECITATION")
+MAX_CONTINUATIONS = 3          # extra segments requested after a truncated answer
+CONTINUATION_TAIL_CHARS = 2000  # end of the answer so far that a continuation resumes from
+CONTINUATION_OVERLAP_PROBE = 400  # leading characters of a segment checked for repeated text
+
+
+def _stitch_continuation(text: str, addition: str) -> str:
+    """`addition` without any opening that repeats the end of `text` (models
+    often restate the last sentence or two before carrying on)."""
+    for candidate in (addition, addition.lstrip()):
+        limit = min(len(candidate), len(text), CONTINUATION_OVERLAP_PROBE)
+        for k in range(limit, 11, -1):
+            if text.endswith(candidate[:k]):
+                return candidate[k:]
+    return addition
+
+
+def _continuation_prompt(prompt: str, text: str) -> str:
+    return (
+        f"{prompt}\n\n---\nYour answer to the above was cut off. It currently ends with:\n"
+        f"<<<\n{text[-CONTINUATION_TAIL_CHARS:]}\n>>>\n\n"
+        "Continue from exactly where it stops, mid-sentence if need be. Do not repeat any of "
+        "it, do not restart or summarise, and add no preamble."
+    )
+
+
+def _generate_with_continuation(client, router: ModelRouter, candidates: list, prompt: str,
+                                gen_config, on_text=None, should_stop=None,
+                                usage: Optional[dict] = None,
+                                caches: Optional[ContextCacheRegistry] = None) -> tuple:
+    """_generate_with_failover, then resume the answer for as long as it stops on
+    the output-token limit (or a recitation cut), up to MAX_CONTINUATIONS more
+    segments. Each continuation sends the original prompt plus only the tail of
+    the answer; the overlap it repeats is trimmed before stitching and streaming.
+    usage["segments"] counts the requests that built the answer."""
+    usage = usage if usage is not None else {}
+    text, model = _generate_with_failover(client, router, candidates, prompt, gen_config,
+                                          on_text, should_stop, usage, caches)
+    usage["segments"] = 1
+    while (usage.pop("finish_reason", "") in CONTINUABLE_FINISH_REASONS
+           and text and usage["segments"] <= MAX_CONTINUATIONS):
+        base = text
+        held: list = []
+        state = {"open": on_text is None, "shown": False}
+
+        def on_segment(delta: str, restart: bool = False):
+            # Hold the opening back until the overlap with `base` can be judged
+            if restart:
+                held.clear()
+                state["open"] = False
+                if state["shown"]:
+                    on_text(base, True)
+                    state["shown"] = False
+            if state["open"]:
+                on_text(delta)
+                return
+            held.append(delta)
+            pending = "".join(held)
+            if len(pending) >= CONTINUATION_OVERLAP_PROBE:
+                state["open"] = state["shown"] = True
+                on_text(_stitch_continuation(base, pending))
+
+        try:
+            addition, _ = _generate_with_failover(
+                client, router, [model] + [m for m in candidates if m != model],
+                _continuation_prompt(prompt, base), gen_config,
+                on_segment if on_text is not None else None, should_stop, usage, caches,
+            )
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            logger.warning(f"Continuation after truncation failed, keeping partial answer: {e}")
+            break
+        addition = _stitch_continuation(base, addition)
+        if on_text is not None and not state["shown"] and addition:
+            on_text(addition)
+        usage["segments"] += 1
+        if not addition.strip():
+            break
+        text = base + addition
+    usage.pop("finish_reason", None)
+    return text, model
+
+
+QUALITY_LOCAL_PASS = 6  # local confidence at or above which no grader call is made
+
+
+def _needs_quality_check(result: str, mode: str) -> bool:
+    return mode in ("standard", "comprehensive") and len(result.split()) > 100
+
+
+def _local_quality_score(text: str) -> int:
+    """Free 0-10 quality signal: the overall confidence heuristic over the
+    citation audit, both computed locally."""
+    return compute_confidence_score(text, verify_response_citations(text))["overall"]
+
+
+def _apply_quality_gate(result: str, prompt: str, mode: str, regenerate, client=None,
+                        user_id: str = "") -> str:
+    """Silent self-critique: if the response scores below 5/10, regenerate once
+    and keep whichever version scores higher. A confident local score passes
+    without a grader call. Anything lower is scored by the LLM grader — the
+    local heuristic rewards citations, so it cannot tell a weak analysis from
+    a sound demand letter — and only a low grade leads to regeneration.
+    `regenerate` should add its token usage to the caller's tally; the grader
+    calls log their own."""
+    if not _needs_quality_check(result, mode):
+        return result
+    if _local_quality_score(result) >= QUALITY_LOCAL_PASS:
+        return result
+    quality_score = _assess_response_quality(result, prompt, client=client, user_id=user_id)
+    if quality_score < 5:
+        logger.info(f"Quality gate triggered (score {quality_score}/10) — regenerating")
+        try:
+            regen = regenerate()
+            if regen:
+                new_score = _assess_response_quality(regen, prompt, client=client,
+                                                     user_id=user_id)
+                if new_score > quality_score:
+                    return regen
+        except Exception as e:
+            logger.warning(f"Quality regeneration failed: {e}")
+    return result
+
+
+def _log_generation_cost(model: str, task: str, mode: str, prompt: str, system: str,
+                         result: str, user_id: str = "", cache_hit: bool = False,
+                         usage: Optional[dict] = None):
+    """Write one cost_logs row. Cost comes from the SDK-reported token `usage`
+    when there is one, otherwise from a character-based estimate."""
     try:
-        cost = estimate_cost(prompt + system, result)
-        get_db().add_cost_log({
+        usage = usage or {}
+        if cache_hit:
+            cost = 0.0
+        elif usage.get("prompt_tokens") or usage.get("output_tokens"):
+            cost = usage_cost(model, usage)
+        else:
+            cost = estimate_cost(prompt + system, result, model)
+        entry = {
             "id": new_id(),
             "timestamp": datetime.now().isoformat(),
-            "model": st.session_state.gemini_model,
+            "model": model,
             "task": task,
             "mode": mode,
             "input_chars": len(prompt) + len(system),
             "output_chars": len(result),
             "estimated_cost": cost,
             "query_preview": prompt[:120],
-        })
+            **usage,
+        }
+        if cache_hit:
+            entry.update(cache_hit=True, saved_cost=estimate_cost(prompt + system, result, model))
+        if user_id:
+            entry["user_id"] = user_id
+        get_db().add_cost_log(entry)
     except Exception as e:
         logger.warning(f"Cost logging failed: {e}")
 
+
+# ═══════════════════════════════════════════════════════
+# STRUCTURED (JSON) OUTPUT
+# ═══════════════════════════════════════════════════════
+JSON_REPAIR_WINDOW = 300  # characters either side of a syntax error sent for repair
+
+
+def _close_json(text: str, cut_to_last_comma: bool = False) -> str:
+    """One pass over possibly broken model JSON: drops trailing commas, escapes
+    raw newlines inside strings, ignores prose after the top-level value and
+    closes whatever a truncated response left open. With `cut_to_last_comma`,
+    an incomplete final member is dropped first."""
+    out: list = []
+    stack: list = []
+    in_str = escaped = False
+    last_comma = None  # (len(out), open brackets) at the most recent structural comma
+
+    def strip_comma():
+        while out and out[-1].isspace():
+            out.pop()
+        if out and out[-1] == ",":
+            out.pop()
+
+    for ch in text:
+        if in_str:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_str = False
+            elif ch == "\n":
+                ch = "\\n"
+            out.append(ch)
+        elif ch == '"':
+            in_str = True
+            out.append(ch)
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            out.append(ch)
+        elif ch in "}]":
+            strip_comma()
+            if stack and stack[-1] == ch:
+                stack.pop()
+            out.append(ch)
+            if not stack:
+                break
+        else:
+            if ch == ",":
+                last_comma = (len(out), list(stack))
+            out.append(ch)
+    if stack or in_str:
+        if cut_to_last_comma and last_comma is not None:
+            del out[last_comma[0]:]
+            stack = last_comma[1]
+        elif in_str:
+            if escaped:
+                out.pop()
+            out.append('"')
+        strip_comma()
+        if out and out[-1] == ":":
+            out.append("null")
+        out.extend(reversed(stack))
+    return "".join(out)
+
+
+def parse_json_response(text: str):
+    """Parse a model's JSON answer, tolerating code fences, leading/trailing
+    prose, trailing commas and truncation. Raises json.JSONDecodeError (a
+    ValueError) carrying the best attempt and error position if it cannot."""
+    t = re.sub(r"^```[A-Za-z]*\s*|\s*```\s*$", "", (text or "").strip())
+    starts = [i for i in (t.find("{"), t.find("[")) if i >= 0]
+    if starts:
+        t = t[min(starts):]
+    try:
+        return json.loads(t)
+    except ValueError:
+        pass
+    closed = _close_json(t)
+    try:
+        return json.loads(closed)
+    except json.JSONDecodeError as e:
+        first_error = e
+    try:
+        return json.loads(_close_json(t, cut_to_last_comma=True))
+    except ValueError:
+        raise first_error
+
+
+def _repair_json_output(text: str, client, user_id: str = "") -> str:
+    """Normalise a JSON-mode answer to compact valid JSON. When local repair is
+    not enough, only the broken fragment around the syntax error is sent to the
+    cheap model for a fix (logged as task "json_repair"). Returns `text`
+    unchanged if it still cannot be parsed."""
+    try:
+        return json.dumps(parse_json_response(text), ensure_ascii=False)
+    except json.JSONDecodeError as e:
+        doc, pos = e.doc, e.pos
+    except ValueError:
+        return text
+    lo, hi = max(0, pos - JSON_REPAIR_WINDOW), min(len(doc), pos + JSON_REPAIR_WINDOW)
+    repair_prompt = (
+        "Below is a fragment cut from the middle of a larger JSON document. It has a syntax "
+        "error near the marker <<HERE>>. Return ONLY the corrected fragment: same content, "
+        "valid JSON syntax, marker removed, no code fences, nothing added before or after.\n\n"
+        f"{doc[lo:pos]}<<HERE>>{doc[pos:hi]}"
+    )
+    usage: dict = {}
+    try:
+        resp = client.models.generate_content(
+            model=QUALITY_GATE_MODEL,
+            contents=repair_prompt,
+            config=_genai_types.GenerateContentConfig(temperature=0.0,
+                                                      max_output_tokens=2 * JSON_REPAIR_WINDOW),
+        )
+        _add_usage(usage, getattr(resp, "usage_metadata", None))
+        fixed = re.sub(r"^```[A-Za-z]*\s*|\s*```\s*$", "", (resp.text or "").strip())
+        _log_generation_cost(QUALITY_GATE_MODEL, "json_repair", "brief", repair_prompt, "",
+                             fixed, user_id=user_id, usage=usage)
+        return json.dumps(parse_json_response(doc[:lo] + fixed + doc[hi:]), ensure_ascii=False)
+    except Exception as e:
+        logger.warning(f"JSON repair failed: {str(e)[:120]}")
+        return text
+
+
+def _llm_cache_lookup(prompt: str, system: str, mode: str, task: str, model: str,
+                      json_schema: Optional[dict] = None, background: bool = False) -> tuple:
+    """(cache_key, ttl, cached_text) for a request routed to `model`, under the
+    session's cache settings. ttl is 0 when this request must not be cached;
+    cached_text is "" on a miss. A pending "Fresh answer next time" is used up
+    only by an interactive request that it actually keeps from a cache hit."""
+    mode_cfg = RESPONSE_MODES.get(mode, RESPONSE_MODES["standard"])
+    cache_ttl = LLM_CACHE_TTLS.get(task, 0) if st.session_state.get("llm_cache_enabled", True) else 0
+    structured = {"json_schema": json_schema} if json_schema is not None else {}
+    cache_key = llm_cache_key(model, system, prompt, mode_cfg["temp"],
+                              mode_cfg["tokens"], top_p=0.92, top_k=40, **structured)
+    cached = get_llm_cache().get(cache_key) if cache_ttl else None
+    if cached and not background and st.session_state.pop("_llm_cache_refresh", False):
+        cached = None
+    return cache_key, cache_ttl, cached or ""
+
+
+def generate(prompt: str, system: str, mode: str, task: str = "general",
+             stream_to: Optional[Any] = None, enable_quality_gate: bool = False,
+             priority: str = "interactive", json_schema: Optional[dict] = None) -> str:
+    """Core generation with streaming, quality gate, retry, and cost logging.
+
+    Args:
+        prompt: User query / content
+        system: System instruction
+        mode: brief / standard / comprehensive
+        task: For cost logging
+        stream_to: Optional Streamlit container for streaming display
+        enable_quality_gate: If True, weak answers are re-checked and regenerated once
+            in the background. Only for pages that offer the result through
+            render_quality_upgrade(); elsewhere a better version would be paid
+            for and never shown
+        priority: "interactive" (someone is waiting on it) or "background"; calls
+            queue in the shared rate limiter, background ones behind interactive
+        json_schema: Constrain the answer to JSON (see generate_json)
+
+    The model is chosen per call by the ModelRouter, with failover to other
+    supported models on rate limits and server errors. Identical requests
+    within the task's LLM_CACHE_TTLS window are answered from the response
+    cache unless the user has switched reuse off or asked for a fresh answer.
+
+    Returns:
+        Final response text
+    """
+    k = _resolve_api_key()
+    if not k:
+        return "⚠️ No API key configured. Please set up your key."
+
+    mode_cfg = RESPONSE_MODES.get(mode, RESPONSE_MODES["standard"])
+    candidates = route_models(task, mode, prompt, system)
+    model = candidates[0]
+    cache_key, cache_ttl, cached = _llm_cache_lookup(prompt, system, mode, task, model, json_schema,
+                                                     background=priority != "interactive")
+    if cached:
+        if stream_to is not None:
+            stream_to.markdown(f'<div class="response-box">{esc(cached)}</div>',
+                               unsafe_allow_html=True)
+            stream_to.caption("♻️ Reused an identical earlier answer · no API cost")
+        _log_generation_cost(model, task, mode, prompt, system, cached, cache_hit=True)
+        return cached
+
+    if not cache_ttl:
+        return _generate_uncoalesced(prompt, system, mode, task, stream_to, enable_quality_gate,
+                                     priority, k, mode_cfg, candidates, cache_key, cache_ttl,
+                                     json_schema=json_schema)
+    flights = get_single_flight()
+    flight, leader = flights.join(cache_key)
+    if not leader:
+        renderer = StreamRenderer(stream_to) if stream_to is not None else None
+        try:
+            shared = flight.follow(renderer)
+        except Exception as e:
+            logger.info(f"Shared generation unavailable ({str(e)[:80]}), generating separately")
+            shared = ""
+        if shared and not shared.startswith("⚠️"):
+            if renderer is not None:
+                renderer.finish(shared)
+            _log_generation_cost(model, task, mode, prompt, system, shared, cache_hit=True)
+            return shared
+        return _generate_uncoalesced(prompt, system, mode, task, stream_to, enable_quality_gate,
+                                     priority, k, mode_cfg, candidates, cache_key, cache_ttl,
+                                     json_schema=json_schema, renderer=renderer)
+    result, error = "", None
+    try:
+        result = _generate_uncoalesced(prompt, system, mode, task, stream_to, enable_quality_gate,
+                                       priority, k, mode_cfg, candidates, cache_key, cache_ttl,
+                                       tee=flight.publish, json_schema=json_schema)
+        return result
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        # A stop or rerun of the leader's script (BaseException) ends the flight
+        # with no result, and followers generate for themselves
+        flights.complete(cache_key, flight, result, error)
+
+
+def _generate_uncoalesced(prompt: str, system: str, mode: str, task: str, stream_to,
+                          enable_quality_gate: bool, priority: str, k: str, mode_cfg: dict,
+                          candidates: list, cache_key: str, cache_ttl: int,
+                          tee=None, json_schema: Optional[dict] = None,
+                          renderer: Optional[StreamRenderer] = None) -> str:
+    """generate() after the cache and single-flight checks: run the request,
+    streaming to `stream_to` (through `renderer` if one is already on the page)
+    and forwarding every chunk to `tee`."""
+    model = candidates[0]
+    gen_config = _generation_config(system, mode_cfg, json_schema)
+    if stream_to is not None:
+        queue_note = stream_to.empty()
+    elif not getattr(_fanout_local, "worker", False):
+        queue_note = st.empty()
+    else:
+        queue_note = None  # a run_parallel worker has no place of its own on the page
+
+    def on_wait(position: int, eta: float):
+        if queue_note is not None:
+            queue_note.caption(f"⏳ Busy right now — you are #{position} in the queue "
+                               f"(about {max(1, round(eta))}s)")
+
+    client = limited_client(k, priority, on_wait)
+    grader = limited_client(k, "background")
+
+    on_text = renderer
+    if on_text is None and stream_to is not None:
+        on_text = StreamRenderer(stream_to)
+
+    def tee_text(delta: str, restart: bool = False):
+        tee(delta, restart)
+        if on_text is not None:
+            on_text(delta, restart)
+
+    usage: dict = {}
+    try:
+        result, model = _generate_with_continuation(client, get_model_router(), candidates,
+                                                    prompt, gen_config,
+                                                    on_text=tee_text if tee is not None else on_text,
+                                                    usage=usage, caches=get_context_caches())
+    except Exception as e:
+        return f"⚠️ Generation error: {str(e)[:200]}"
+    finally:
+        if queue_note is not None:
+            queue_note.empty()
+    if on_text is not None and result:
+        on_text.finish(result)
+
+    if not result:
+        return "⚠️ Empty response from AI. Try rephrasing your query."
+    if json_schema is not None:
+        result = _repair_json_output(result, client, st.session_state.get("current_user_id", ""))
+
+    if cache_ttl:
+        get_llm_cache().put(cache_key, result, cache_ttl, model=model, task=task,
+                            input_chars=len(prompt) + len(system))
+
+    # ── Cost logging ──
+    _log_generation_cost(model, task, mode, prompt, system, result, usage=usage)
+
+    # ── Quality Gate (after the answer is shown; may offer a better version) ──
+    if enable_quality_gate and _needs_quality_check(result, mode):
+        get_quality_checker().submit(
+            result, prompt, system, mode, task, model, gen_config, grader, get_model_router(),
+            st.session_state.get("current_user_id", ""), cache_key, cache_ttl,
+        )
     return result
 
 
-def _assess_response_quality(response: str, query: str) -> int:
-    """Silent quality check. Returns 0-10 score using a cheap model call."""
+def generate_json(prompt: str, system: str, mode: str = "brief", task: str = "general",
+                  schema: Optional[dict] = None, priority: str = "interactive") -> str:
+    """generate() in JSON mode for the structured widgets. The model is held to
+    `schema` (or to plain JSON when None); the answer comes back as compact valid
+    JSON text, repaired if needed, ready for parse_json_response(). If it still
+    cannot be parsed, the raw text or error message comes back so the caller
+    can show it."""
+    return generate(prompt, system, mode, task, enable_quality_gate=False,
+                    priority=priority, json_schema=schema if schema is not None else {})
+
+
+# ═══════════════════════════════════════════════════════
+# PARALLEL FAN-OUT
+# ═══════════════════════════════════════════════════════
+FANOUT_MAX_WORKERS = 4
+_fanout_local = threading.local()
+
+
+def run_parallel(tasks: dict, on_done=None) -> dict:
+    """Run independent zero-argument callables concurrently and return
+    {name: result}. Each worker carries this session's script context, so
+    tasks can call generate() and stream into placeholders created beforehand.
+    `on_done(name, result)` runs on the calling thread as each task finishes,
+    so whatever is ready first is shown first. A task that raises yields its
+    exception as the result. Without script-context support the tasks run one
+    after another."""
+    results: dict = {}
+    if not HAS_SCRIPT_CTX or len(tasks) < 2:
+        for name, fn in tasks.items():
+            try:
+                results[name] = fn()
+            except Exception as e:
+                results[name] = e
+            if on_done is not None:
+                on_done(name, results[name])
+        return results
+
+    ctx = get_script_run_ctx()
+
+    def bound(fn):
+        def run():
+            add_script_run_ctx(threading.current_thread(), ctx)
+            _fanout_local.worker = True
+            return fn()
+        return run
+
+    # A pool per call: its threads end with it, so no session's context outlives the run
+    with ThreadPoolExecutor(max_workers=min(len(tasks), FANOUT_MAX_WORKERS),
+                            thread_name_prefix="lexi-fanout") as pool:
+        futures = {pool.submit(bound(fn)): name for name, fn in tasks.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logger.warning(f"Parallel task {name} failed: {e}")
+                results[name] = e
+            if on_done is not None:
+                on_done(name, results[name])
+    return results
+
+
+# ═══════════════════════════════════════════════════════
+# BACKGROUND QUALITY GATE
+# ═══════════════════════════════════════════════════════
+QUALITY_CHECK_WORKERS = 2
+QUALITY_UPGRADE_TTL = 3600  # how long a finished check (and its better version) is kept
+
+
+class QualityChecker:
+    """Runs the quality gate for interactive answers after they have been shown.
+
+    Results are kept per response fingerprint: "checking" while the gate runs,
+    then "ok", or "better" with the regenerated text, which also replaces the
+    cached answer. Pages offer the swap through render_quality_upgrade().
+    """
+
+    def __init__(self, cache: LLMResponseCache, caches: ContextCacheRegistry,
+                 workers: int = QUALITY_CHECK_WORKERS):
+        # Shared resources are captured here because worker threads have no script context
+        self.cache = cache
+        self.caches = caches
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lexi-quality")
+        self._results = TTLCache(maxsize=512, ttl=QUALITY_UPGRADE_TTL)
+
+    def submit(self, result: str, prompt: str, system: str, mode: str, task: str, model: str,
+               gen_config, client, router: ModelRouter, user_id: str,
+               cache_key: str = "", cache_ttl: int = 0) -> str:
+        """Queue a check of `result`; returns its fingerprint."""
+        fingerprint = _response_fingerprint(result)
+        if self._results.get(fingerprint) is None:
+            self._results.set(fingerprint, {"status": "checking", "text": ""})
+            self._pool.submit(self._run, fingerprint, result, prompt, system, mode, task, model,
+                              gen_config, client, router, user_id, cache_key, cache_ttl)
+        return fingerprint
+
+    def _run(self, fingerprint, result, prompt, system, mode, task, model, gen_config,
+             client, router, user_id, cache_key, cache_ttl):
+        usage: dict = {}
+
+        def regenerate() -> str:
+            text, _ = _generate_with_continuation(client, router, [model], prompt, gen_config,
+                                                  usage=usage, caches=self.caches)
+            return text
+
+        try:
+            gated = _apply_quality_gate(result, prompt, mode, regenerate,
+                                        client=client, user_id=user_id)
+        except Exception as e:
+            logger.warning(f"Background quality check failed: {e}")
+            gated = result
+        if usage:
+            _log_generation_cost(model, task, mode, prompt, system, gated, user_id=user_id,
+                                 usage=usage)
+        if gated is result:
+            self._results.set(fingerprint, {"status": "ok", "text": ""})
+            return
+        self._results.set(fingerprint, {"status": "better", "text": gated})
+        if cache_ttl:
+            self.cache.put(cache_key, gated, cache_ttl, model=model, task=task,
+                           input_chars=len(prompt) + len(system))
+
+    def get(self, fingerprint: str) -> Optional[dict]:
+        return self._results.get(fingerprint)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+@st.cache_resource
+def get_quality_checker() -> QualityChecker:
+    checker = QualityChecker(get_llm_cache(), get_context_caches())
+    atexit.register(checker.shutdown)
+    return checker
+
+
+@st.fragment(run_every=3)
+def _render_quality_upgrade(fingerprint: str, accept_key: str):
+    entry = get_quality_checker().get(fingerprint)
+    if not entry or entry["status"] == "ok":
+        return
+    if entry["status"] == "checking":
+        st.caption("🔎 Double-checking this answer's quality in the background…")
+        return
+    st.info("✨ A stronger version of this answer is ready.")
+    if st.button("Use improved version", key=f"{accept_key}_btn", type="primary"):
+        st.session_state[accept_key] = entry["text"]
+        st.rerun()
+
+
+def render_quality_upgrade(response: str, accept_key: str):
+    """Offer the background quality gate's better version of `response`, if it
+    finds one. Accepting puts the new text in st.session_state[accept_key] and
+    reruns the page, which should pick it up from there."""
+    entry = get_quality_checker().get(_response_fingerprint(response))
+    if entry and entry["status"] != "ok":
+        _render_quality_upgrade(_response_fingerprint(response), accept_key)
+
+
+QUALITY_GATE_MODEL = "gemini-2.5-flash-lite"
+
+
+def _assess_response_quality(response: str, query: str, client=None, user_id: str = "") -> int:
+    """Silent quality check. Returns 0-10 score using a cheap model call, which
+    is logged under task "quality_gate". Pass `client` (and `user_id`) when
+    calling from outside a Streamlit session."""
     try:
-        k = _resolve_api_key()
-        if not k:
-            return 7  # Assume okay if can't check
-        client = _get_genai_client(k)
+        if client is None:
+            k = _resolve_api_key()
+            if not k:
+                return 7  # Assume okay if can't check
+            client = limited_client(k, "background")
 
         check_prompt = f"""Rate the following Nigerian legal analysis on a strict 0-10 scale.
 
@@ -9803,12 +12866,16 @@ ANALYSIS:
 
 SCORE:"""
         resp = client.models.generate_content(
-            model="gemini-2.5-flash-lite",
+            model=QUALITY_GATE_MODEL,
             contents=check_prompt,
             config=_genai_types.GenerateContentConfig(
                 temperature=0.0, max_output_tokens=10,
             ),
         )
+        usage: dict = {}
+        _add_usage(usage, getattr(resp, "usage_metadata", None))
+        _log_generation_cost(QUALITY_GATE_MODEL, "quality_gate", "", check_prompt, "",
+                             (resp.text or "") if resp else "", user_id=user_id, usage=usage)
         if resp and resp.text:
             match = re.search(r"\b([0-9]|10)\b", resp.text.strip())
             if match:
@@ -9818,6 +12885,251 @@ SCORE:"""
     return 7  # Default to passing
 
 
+# ═══════════════════════════════════════════════════════
+# BACKGROUND STRENGTH PREFETCH
+# ═══════════════════════════════════════════════════════
+STRENGTH_PREFETCH_WORKERS = 2
+
+
+class StrengthPrefetcher:
+    """Fetches the Case Strength Meter assessment for an analysis after the
+    answer has been shown, on the cheap model at background priority.
+
+    Results are kept per response fingerprint: "fetching", then "ready" with
+    the JSON text (also stored in the response cache under the key the meter's
+    button would use), or "failed", which leaves the button to retry.
+    """
+
+    def __init__(self, cache: LLMResponseCache, caches: ContextCacheRegistry,
+                 workers: int = STRENGTH_PREFETCH_WORKERS):
+        # Shared resources are captured here because worker threads have no script context
+        self.cache = cache
+        self.caches = caches
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lexi-strength")
+        self._results = TTLCache(maxsize=512, ttl=QUALITY_UPGRADE_TTL)
+
+    def submit(self, response: str, prompt: str, candidates: list, client, router: ModelRouter,
+               user_id: str, cache_key: str = "", cache_ttl: int = 0, cached: str = "") -> str:
+        """Queue the assessment of `response` (or record `cached`); returns its fingerprint."""
+        fingerprint = _response_fingerprint(response)
+        if cached:
+            self._results.set(fingerprint, {"status": "ready", "raw": cached})
+        elif self._results.get(fingerprint) is None:
+            self._results.set(fingerprint, {"status": "fetching", "raw": ""})
+            self._pool.submit(self._run, fingerprint, prompt, candidates, client, router,
+                              user_id, cache_key, cache_ttl)
+        return fingerprint
+
+    def _run(self, fingerprint, prompt, candidates, client, router, user_id, cache_key,
+             cache_ttl):
+        usage: dict = {}
+        model, text, status = candidates[0], "", "ready"
+        try:
+            gen_config = _generation_config(IDENTITY_CORE, RESPONSE_MODES["brief"], {})
+            text, model = _generate_with_continuation(client, router, candidates, prompt,
+                                                      gen_config, usage=usage, caches=self.caches)
+            text = _repair_json_output(text, client, user_id)
+            parse_json_response(text)
+        except Exception as e:
+            logger.info(f"Strength prefetch failed: {str(e)[:120]}")
+            status = "failed"
+        if usage:
+            _log_generation_cost(model, "analysis", "brief", prompt, IDENTITY_CORE, text,
+                                 user_id=user_id, usage=usage)
+        if status == "ready" and cache_ttl:
+            self.cache.put(cache_key, text, cache_ttl, model=model, task="analysis",
+                           input_chars=len(prompt) + len(IDENTITY_CORE))
+        self._results.set(fingerprint, {"status": status, "raw": text if status == "ready" else ""})
+
+    def get(self, fingerprint: str) -> Optional[dict]:
+        return self._results.get(fingerprint)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+@st.cache_resource
+def get_strength_prefetcher() -> StrengthPrefetcher:
+    prefetcher = StrengthPrefetcher(get_llm_cache(), get_context_caches())
+    atexit.register(prefetcher.shutdown)
+    return prefetcher
+
+
+def prefetch_strength(response: str):
+    """Queue the Case Strength Meter assessment of `response` in the background."""
+    k = _resolve_api_key()
+    if not k:
+        return
+    prompt = _strength_prompt(response)
+    candidates = route_models("analysis", "brief", prompt, IDENTITY_CORE)
+    cache_key, cache_ttl, cached = _llm_cache_lookup(prompt, IDENTITY_CORE, "brief", "analysis",
+                                                     candidates[0], {}, background=True)
+    if cached:
+        _log_generation_cost(candidates[0], "analysis", "brief", prompt, IDENTITY_CORE, cached,
+                             cache_hit=True)
+    get_strength_prefetcher().submit(
+        response, prompt, candidates, limited_client(k, "background"), get_model_router(),
+        st.session_state.get("current_user_id", ""), cache_key, cache_ttl, cached,
+    )
+
+
+@st.fragment(run_every=2)
+def _await_strength_prefetch(fingerprint: str):
+    """Placeholder while the assessment is fetched; reruns the page once it is done."""
+    entry = get_strength_prefetcher().get(fingerprint)
+    if entry and entry["status"] == "fetching":
+        st.caption("📊 Assessing case strength in the background…")
+        return
+    st.rerun()
+
+
+# ═══════════════════════════════════════════════════════
+# BACKGROUND GENERATION JOBS
+# ═══════════════════════════════════════════════════════
+GENERATION_JOB_WORKERS = 4            # concurrent background generations per process
+MAX_ACTIVE_JOBS_PER_USER = 2
+JOB_OUTPUT_FLUSH_SECONDS = 1.0        # how often streamed text is written to the job row
+GENERATION_JOB_STALE_SECONDS = 15 * 60  # no progress for this long => worker is gone
+GENERATION_JOB_QUEUE_STALE_SECONDS = 2 * 3600  # queued this long => its process is gone
+
+
+class GenerationJobRunner:
+    """Runs long generations on worker threads, off the Streamlit rerun loop.
+
+    A job's streamed text is written to generation_jobs as it arrives, so any
+    session of the same user — after a refresh, on another device, or on
+    another replica — can re-attach to it. Cancellation is an in-process event
+    plus a cancel_requested flag the worker checks on every flush.
+    """
+
+    def __init__(self, db: Database, clients: GenaiClientRegistry, cache: LLMResponseCache,
+                 router: ModelRouter, limiter: GeminiRateLimiter, caches: ContextCacheRegistry,
+                 workers: int = GENERATION_JOB_WORKERS):
+        # Shared resources are captured here because worker threads have no script context
+        self.db = db
+        self.clients = clients
+        self.cache = cache
+        self.router = router
+        self.limiter = limiter
+        self.caches = caches
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lexi-job")
+        self._events: dict = {}   # job_id -> threading.Event set on cancel
+        self._lock = threading.Lock()
+
+    def submit(self, user_id: str, api_key: str, models: list, prompt: str, system: str,
+               mode: str, task: str, query: str, cache_key: str = "", cache_ttl: float = 0) -> str:
+        """Queue a generation over candidate `models` (best first). Returns the
+        job id, or "" if the user is at their limit."""
+        job_id = uuid.uuid4().hex[:12]
+        now = datetime.now().isoformat()
+        job = {
+            "id": job_id, "user_id": user_id, "status": "queued", "task": task, "mode": mode,
+            "model": models[0], "query": query, "created_at": now, "updated_at": now,
+        }
+        if not self.db.create_generation_job(job, MAX_ACTIVE_JOBS_PER_USER):
+            return ""
+        event = threading.Event()
+        with self._lock:
+            self._events[job_id] = event
+        self.pool.submit(self._run, job_id, user_id, api_key, models, prompt, system, mode,
+                         task, cache_key, cache_ttl, event)
+        return job_id
+
+    def cancel(self, job_id: str, user_id: str) -> bool:
+        requested = self.db.request_generation_job_cancel(job_id, user_id)
+        with self._lock:
+            event = self._events.get(job_id)
+        if event is not None:
+            event.set()
+        return requested
+
+    def _run(self, job_id, user_id, api_key, models, prompt, system, mode, task,
+             cache_key, cache_ttl, event):
+        model = models[0]
+        parts: list = []
+        last_flush = [0.0]
+        usage: dict = {}
+
+        def on_text(delta: str, restart: bool = False):
+            if restart:
+                parts.clear()
+            parts.append(delta)
+            now = time.monotonic()
+            if now - last_flush[0] >= JOB_OUTPUT_FLUSH_SECONDS:
+                last_flush[0] = now
+                if self.db.update_generation_job_output(job_id, "".join(parts)):
+                    event.set()
+
+        try:
+            if not self.db.claim_generation_job(job_id):
+                logger.warning(f"Generation job {job_id} is no longer queued, skipping it")
+                return
+            if self.db.update_generation_job_output(job_id, ""):
+                raise GenerationCancelled()
+            raw_client = self.clients.get(api_key)
+            client = self.limiter.wrap(raw_client, api_key, user_id)
+            grader = self.limiter.wrap(raw_client, api_key, user_id, "background")
+            gen_config = _generation_config(system, RESPONSE_MODES.get(mode, RESPONSE_MODES["standard"]))
+            result, model = _generate_with_continuation(
+                client, self.router, models, prompt, gen_config, on_text=on_text,
+                should_stop=event.is_set, usage=usage, caches=self.caches,
+            )
+            if not result:
+                raise RuntimeError("Empty response from AI. Try rephrasing your query.")
+            result = _apply_quality_gate(
+                result, prompt, mode,
+                lambda: _generate_once_cached(client, model, prompt, gen_config, usage=usage,
+                                              caches=self.caches),
+                client=grader, user_id=user_id,
+            )
+            if cache_ttl:
+                self.cache.put(cache_key, result, cache_ttl, model=model, task=task,
+                               input_chars=len(prompt) + len(system))
+            _log_generation_cost(model, task, mode, prompt, system, result, user_id=user_id,
+                                 usage=usage)
+            self.db.finish_generation_job(job_id, "done", output=result)
+        except GenerationCancelled:
+            if usage:  # tokens streamed before the cancel are still billed
+                _log_generation_cost(model, task, mode, prompt, system, "".join(parts),
+                                     user_id=user_id, usage=usage)
+            self.db.finish_generation_job(job_id, "cancelled", output="".join(parts))
+        except Exception as e:
+            logger.error(f"Generation job {job_id} failed: {e}")
+            self.db.finish_generation_job(job_id, "failed", error=str(e))
+        finally:
+            with self._lock:
+                self._events.pop(job_id, None)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+@st.cache_resource
+def get_generation_jobs() -> GenerationJobRunner:
+    """Process-wide background generation runner."""
+    runner = GenerationJobRunner(get_db(), get_genai_clients(), get_llm_cache(),
+                                 get_model_router(), get_rate_limiter(), get_context_caches())
+    atexit.register(runner.shutdown)
+    return runner
+
+
+def submit_generation_job(prompt: str, system: str, mode: str, task: str,
+                          query: str) -> tuple:
+    """Queue a generation for the current user. Returns (job_id, cached_text):
+    cached_text is set (and no job queued) when an identical answer is already
+    cached; job_id is "" if the user has MAX_ACTIVE_JOBS_PER_USER running."""
+    candidates = route_models(task, mode, prompt, system)
+    cache_key, cache_ttl, cached = _llm_cache_lookup(prompt, system, mode, task, candidates[0])
+    if cached:
+        _log_generation_cost(candidates[0], task, mode, prompt, system, cached, cache_hit=True)
+        return "", cached
+    job_id = get_generation_jobs().submit(
+        st.session_state.current_user_id, _resolve_api_key(), candidates,
+        prompt, system, mode, task, query, cache_key=cache_key, cache_ttl=cache_ttl,
+    )
+    return job_id, ""
+
+
 def compute_confidence_score(response: str, audit: dict) -> dict:
     """4-axis confidence scoring on an AI response. Pure heuristics — no extra API call.
 
@@ -10009,13 +13321,13 @@ def make_invoice(client_id: str):
         "status": "Draft",
     }
     st.session_state.invoices.append(inv)
-    persist("invoices")
+    persist_record("invoices", inv, new=True)
     return inv
 
 
 def manual_connect(key: str) -> bool:
     try:
-        client = _get_genai_client(key)
+        client = limited_client(key)
         client.models.generate_content(
             model=st.session_state.gemini_model,
             contents="Test",
@@ -10025,6 +13337,7 @@ def manual_connect(key: str) -> bool:
         st.session_state.api_configured = True
         return True
     except Exception as e:
+        get_genai_clients().discard(key)
         err = str(e)
         if "403" in err:
             st.error("❌ Invalid API key.")
@@ -10054,6 +13367,439 @@ def relative_date(d) -> str:
     return f"{n} days away"
 
 
+# ═══════════════════════════════════════════════════════
+# CONTEXT ASSEMBLY
+# ═══════════════════════════════════════════════════════
+MODEL_INPUT_TOKENS = {  # input windows; models not listed get DEFAULT_INPUT_TOKENS
+    "gemini-2.5-pro": 1_048_576,
+    "gemini-2.5-flash": 1_048_576,
+    "gemini-2.5-flash-lite": 1_048_576,
+}
+DEFAULT_INPUT_TOKENS = 1_048_576
+# Context spend per call by response mode: enough for a long agreement, far short
+# of the window, since every input token is paid for on every call
+CONTEXT_TOKEN_BUDGETS = {"brief": 12_000, "standard": 48_000, "comprehensive": 160_000}
+CONTEXT_CHUNK_CHARS = 1500      # target size of one document section
+HISTORY_CONTEXT_SHARE = 0.2     # most of the budget earlier answers may take
+HISTORY_MIN_OVERLAP = 0.6       # share of query terms an earlier exchange must mention
+HISTORY_MIN_SHARED_TERMS = 3    # and never fewer terms than this
+_CONTEXT_STOPWORDS = frozenset(
+    "the and for with that this from are was were has have had not but any all can may "
+    "shall will would should what which who whom whose where when how why its our your "
+    "their there them they his her him she into upon under over than then also been "
+    "being such other more most some only same each very does did doing about".split()
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough input-token count (~4 characters per token for English prose)."""
+    return (len(text) + 3) // 4
+
+
+def _context_terms(text: str) -> list:
+    return [w for w in re.findall(r"[a-z0-9]{3,}", text.lower()) if w not in _CONTEXT_STOPWORDS]
+
+
+def _split_document(text: str) -> list:
+    """Sections of about CONTEXT_CHUNK_CHARS, cut at paragraph breaks so clauses
+    stay whole; an oversized paragraph is cut at line or sentence ends."""
+    pieces: list = []
+    for para in re.split(r"\n\s*\n", text):
+        while len(para) > 2 * CONTEXT_CHUNK_CHARS:
+            cut = max(para.rfind("\n", 0, CONTEXT_CHUNK_CHARS * 2),
+                      para.rfind(". ", 0, CONTEXT_CHUNK_CHARS * 2) + 1)
+            cut = cut if cut > CONTEXT_CHUNK_CHARS // 2 else CONTEXT_CHUNK_CHARS
+            pieces.append(para[:cut])
+            para = para[cut:]
+        if para.strip():
+            pieces.append(para)
+    chunks: list = []
+    for piece in pieces:
+        if chunks and len(chunks[-1]) + len(piece) < CONTEXT_CHUNK_CHARS:
+            chunks[-1] += "\n\n" + piece
+        else:
+            chunks.append(piece)
+    return chunks
+
+
+def _rank_chunks(query: str, chunks: list) -> list:
+    """Chunk indices, most relevant first: query-term matches weighted by rarity
+    across the document (BM25-style), with the opening section (parties,
+    recitals) and definitions kept near the top."""
+    terms = set(_context_terms(query))
+    chunk_terms = [_context_terms(c) for c in chunks]
+    n = len(chunks)
+    df = {t: sum(1 for ct in chunk_terms if t in ct) for t in terms}
+    scores = []
+    for i, ct in enumerate(chunk_terms):
+        counts: dict = {}
+        for w in ct:
+            if w in terms:
+                counts[w] = counts.get(w, 0) + 1
+        length_norm = 0.25 + 0.75 * len(ct) / max(1, sum(map(len, chunk_terms)) / n)
+        score = sum(
+            (1 + (n - df[t] + 0.5) / (df[t] + 0.5)) * c * 2.2 / (c + 1.2 * length_norm)
+            for t, c in counts.items()
+        )
+        if i == 0:
+            score += 5.0
+        if re.search(r"\b(?:definitions?|interpretation)\b", chunks[i][:200], re.IGNORECASE):
+            score += 3.0
+        scores.append(score)
+    return sorted(range(n), key=lambda i: (-scores[i], i))
+
+
+def assemble_context(query: str, mode: str, system: str = "", document: str = "",
+                     history: Optional[list] = None, model: str = "") -> tuple:
+    """Build the prompt for `query` with as much useful context as the budget allows.
+
+    The budget is the mode's CONTEXT_TOKEN_BUDGETS entry, capped by what the
+    model's input window leaves after the system prompt, the query and the
+    mode's output allowance. A document that fits goes in whole; otherwise its
+    sections are ranked against the query and the best are packed, shown in
+    document order with gaps marked. Earlier exchanges from `history` (pass this
+    session's, see session_history()) that share enough terms with the query
+    fill up to HISTORY_CONTEXT_SHARE of the budget.
+    Returns (prompt, report), where report says what was included.
+    """
+    mode_cfg = RESPONSE_MODES.get(mode, RESPONSE_MODES["standard"])
+    window = MODEL_INPUT_TOKENS.get(model or st.session_state.get("gemini_model", ""),
+                                    DEFAULT_INPUT_TOKENS)
+    fixed = estimate_tokens(system) + estimate_tokens(query) + 50
+    budget = max(0, min(CONTEXT_TOKEN_BUDGETS.get(mode, CONTEXT_TOKEN_BUDGETS["standard"]),
+                        window - mode_cfg["tokens"] - fixed))
+    report = {"budget": budget, "doc_sections": 0, "doc_sections_used": 0,
+              "doc_tokens": 0, "doc_tokens_used": 0, "history_used": 0}
+    parts: list = []
+
+    history_parts: list = []
+    history_budget = int(budget * HISTORY_CONTEXT_SHARE)
+    terms = set(_context_terms(query))
+    for entry in reversed((history or [])[-10:]):
+        if not terms or history_budget <= 0:
+            break
+        text = f"Q: {entry.get('query', '')}\nA: {entry.get('response', '')}"
+        shared = len(terms & set(_context_terms(text)))
+        if (shared < max(HISTORY_MIN_SHARED_TERMS, HISTORY_MIN_OVERLAP * len(terms))
+                or entry.get("query", "").strip() == query.strip()
+                or entry.get("response", "").startswith("⚠️")):
+            continue
+        text = text[:history_budget * 4]
+        history_budget -= estimate_tokens(text)
+        history_parts.append(text)
+        report["history_used"] += 1
+    spent_on_history = sum(estimate_tokens(t) for t in history_parts)
+
+    if document.strip():
+        doc_budget = budget - spent_on_history
+        chunks = _split_document(document)
+        report["doc_sections"] = len(chunks)
+        report["doc_tokens"] = estimate_tokens(document)
+        if report["doc_tokens"] <= doc_budget:
+            doc_text = document
+            report["doc_sections_used"] = len(chunks)
+        else:
+            keep, used = [], 0
+            for i in _rank_chunks(query, chunks):
+                cost = estimate_tokens(chunks[i]) + 2
+                if used + cost <= doc_budget:
+                    keep.append(i)
+                    used += cost
+            keep.sort()
+            body, previous = [], -1
+            for i in keep:
+                if i != previous + 1:
+                    body.append("[…]")
+                body.append(chunks[i])
+                previous = i
+            if keep and keep[-1] != len(chunks) - 1:
+                body.append("[…]")
+            doc_text = "\n\n".join(body)
+            report["doc_sections_used"] = len(keep)
+        report["doc_tokens_used"] = estimate_tokens(doc_text)
+        if doc_text:
+            parts.append(f"DOCUMENT CONTEXT:\n{doc_text}")
+    if history_parts:
+        parts.append("RELATED EARLIER EXCHANGES IN THIS SESSION:\n"
+                     + "\n\n---\n\n".join(reversed(history_parts)))
+    if not parts:
+        return query, report
+    return "\n\n".join(parts) + f"\n\nQUERY:\n{query}", report
+
+
+def context_report_caption(report: dict) -> str:
+    bits = []
+    if report["doc_sections"]:
+        bits.append(f"{report['doc_sections_used']}/{report['doc_sections']} document sections "
+                    f"({report['doc_tokens_used']:,} of {report['doc_tokens']:,} tokens)")
+    if report["history_used"]:
+        bits.append(f"{report['history_used']} related earlier answer(s)")
+    return f"📎 Context: {' · '.join(bits)} · budget {report['budget']:,} tokens" if bits else ""
+
+
+# ═══════════════════════════════════════════════════════
+# CONTRACT REVIEW PIPELINE
+# ═══════════════════════════════════════════════════════
+CONTRACT_MAP_REDUCE_MIN_CHARS = 15_000  # shorter contracts are reviewed in one generation
+CONTRACT_BATCH_CHARS = 7_000            # clause text per map call; with the system prompt and
+                                        # instructions this stays under ROUTE_LITE_MAX_CHARS,
+                                        # i.e. on the lite model
+CONTRACT_CLAUSE_VERSION = "v2"          # bump when the clause prompt changes
+CONTRACT_INSTRUCTIONS_CHARS = 1_000     # client instructions repeated in every map call
+RISK_ICONS = {"High": "🔴", "Medium": "🟡", "Low": "🟢"}
+
+CONTRACT_CLAUSE_SYSTEM = IDENTITY_CORE + """
+TASK: Review contract clauses under Nigerian law for the party seeking advice,
+as identified in the CLIENT INSTRUCTIONS. Rate risk and draft redlines from that
+party's side. If no party is identified, say in "issues" which party each risk
+falls on.
+For EACH clause given, return one JSON object:
+{"clause": "<the clause number exactly as given>",
+ "summary": "What it does in plain English (one sentence)",
+ "risk": "High" | "Medium" | "Low",
+ "issues": "Legal problems, ambiguities, missing protections (or empty)",
+ "recommendation": "Specific redline or amendment language (or empty)"}
+Respond with a JSON array of these objects, one per clause, in the order given."""
+
+CONTRACT_REDUCE_PROMPT = """You have clause-by-clause findings from a review of a {clause_count}-clause contract.
+
+CLAUSE HEADINGS PRESENT:
+{headings}
+
+FLAGGED FINDINGS (High and Medium risk):
+{findings}
+{instructions}
+Write ONLY this block, using the findings above and the headings to spot standard protections that are absent:
+
+═══ OVERALL ASSESSMENT ═══
+▸ Contract Grade: A/B/C/D/F
+▸ Signability: Ready / Needs Amendment / Do Not Sign
+▸ Top 3 Risks
+▸ Missing Clauses (standard protections absent)
+═══════════════════════════"""
+
+_CLAUSE_HEADING = re.compile(
+    r"^[ \t]*(?:(?:ARTICLE|Article|CLAUSE|Clause|SECTION|Section)[ \t]+([0-9IVXLC]+)\b[.:)]?"
+    r"|(\d{1,3})[.)][ \t]+(?=[A-Z])"
+    r"|(\d{1,3})[ \t]+(?=[A-Z][A-Za-z'-]*,?(?:[ \t]+(?:[A-Z][A-Za-z'-]*,?|and|of|the|&|/))*[ \t]*$))",
+    re.MULTILINE,
+)
+_SCHEDULE_BOUNDARY = re.compile(
+    r"^[ \t]*(?:SCHEDULE|Schedule|ANNEX|Annex|APPENDIX|Appendix|EXHIBIT|Exhibit)\b", re.MULTILINE
+)
+
+
+def split_contract_clauses(text: str) -> list:
+    """Top-level clauses of a contract as [{"number", "heading", "text"}], cut at
+    "1." / "12)" / "Clause 4" / "ARTICLE V" style headings at the start of a
+    line (sub-clauses such as 4.2 stay with their parent). A plain number
+    ("3.", "3)" or "3 Confidentiality", Title Case only) only counts when it is
+    the next in sequence, so a numbered list inside a clause or a line like
+    "30 Days Notice" stays with its clause; numbering may restart at 1 after a
+    Schedule, Annex, Appendix or Exhibit heading. Text before the first heading
+    becomes the "Preamble". Falls back to paragraph sections when the document
+    has too few recognisable headings."""
+    numbered, last, since = [], 0, 0
+    for m in _CLAUSE_HEADING.finditer(text):
+        plain = m.group(2) or m.group(3)
+        if plain:
+            n = int(plain)
+            restart = n == 1 and _SCHEDULE_BOUNDARY.search(text, since, m.start())
+            if n != last + 1 and not restart:
+                continue
+        numbered.append(m)
+        since = m.end()
+        number = m.group(1) or plain
+        if number.isdigit():
+            last = int(number)
+    if len(numbered) < 3:
+        return [{"number": str(i), "heading": f"Section {i}", "text": chunk}
+                for i, chunk in enumerate(_split_document(text), 1)]
+    clauses = []
+    preamble = text[:numbered[0].start()].strip()
+    if preamble:
+        clauses.append({"number": "Preamble", "heading": "Preamble", "text": preamble})
+    for i, m in enumerate(numbered):
+        end = numbered[i + 1].start() if i + 1 < len(numbered) else len(text)
+        body = text[m.start():end].strip()
+        first_line = body.split("\n", 1)[0]
+        heading = re.sub(r"^\W*(?:ARTICLE|Article|CLAUSE|Clause|SECTION|Section)?\s*[0-9IVXLC]+[.:)]?\s*",
+                         "", first_line)[:60].strip(" .:-") or "Untitled"
+        number = m.group(1) or m.group(2) or m.group(3)
+        if any(c["number"] == number for c in clauses):
+            number = f"{number}-{i}"  # keep numbers unique when a schedule restarts numbering
+        clauses.append({"number": number, "heading": heading, "text": body})
+    return clauses
+
+
+def _contract_instructions(instructions: str) -> str:
+    """The client's instructions as sent to every map call, whitespace-normalised."""
+    return re.sub(r"\s+", " ", instructions or "").strip()[:CONTRACT_INSTRUCTIONS_CHARS]
+
+
+def _clause_cache_key(clause: dict, instructions: str = "") -> str:
+    """Keyed by clause text and the instructions, since the review is written
+    for the party they name."""
+    normalised = re.sub(r"\s+", " ", clause["text"]).strip()
+    return llm_cache_key(f"contract-clause-{CONTRACT_CLAUSE_VERSION}", CONTRACT_CLAUSE_SYSTEM,
+                         f"{_contract_instructions(instructions)}\n{normalised}", 0.1, 0)
+
+
+def _clause_batches(clauses: list) -> list:
+    batches, current, size = [], [], 0
+    for clause in clauses:
+        if current and size + len(clause["text"]) > CONTRACT_BATCH_CHARS:
+            batches.append(current)
+            current, size = [], 0
+        current.append(clause)
+        size += len(clause["text"])
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _review_clause_batch(batch: list, instructions: str, client, router: ModelRouter,
+                         candidates: list, user_id: str) -> dict:
+    """Map step: one cheap-model call for a batch of clauses, reviewed for the
+    party named in `instructions`. Returns {clause number: review dict};
+    clauses missing from the answer are left out."""
+    prompt = (f"CLIENT INSTRUCTIONS:\n{_contract_instructions(instructions) or 'None given.'}\n\n"
+              + "\n\n".join(f"CLAUSE {c['number']}:\n{c['text'][:CONTRACT_BATCH_CHARS]}"
+                            for c in batch))
+    gen_config = _generation_config(CONTRACT_CLAUSE_SYSTEM, RESPONSE_MODES["brief"], {})
+    usage: dict = {}
+    raw, model = _generate_with_continuation(client, router, candidates, prompt, gen_config,
+                                             usage=usage)
+    raw = _repair_json_output(raw, client, user_id)
+    _log_generation_cost(model, "contract_review", "brief", prompt, CONTRACT_CLAUSE_SYSTEM, raw,
+                         user_id=user_id, usage=usage)
+    data = parse_json_response(raw)
+    if isinstance(data, dict):
+        data = data.get("clauses", [data])
+    reviews = {}
+    for item in data if isinstance(data, list) else []:
+        if isinstance(item, dict) and str(item.get("clause", "")) in {c["number"] for c in batch}:
+            risk = str(item.get("risk", "Medium")).strip().title()
+            item["risk"] = risk if risk in RISK_ICONS else "Medium"
+            reviews[str(item["clause"])] = item
+    return reviews
+
+
+def _format_contract_review(clauses: list, reviews: dict, assessment: str) -> str:
+    lines = ["CLAUSE-BY-CLAUSE ANALYSIS", ""]
+    flagged = []
+    for c in clauses:
+        r = reviews.get(c["number"])
+        if r is None:
+            lines += [f"Clause {c['number']} — {c['heading']}: not reviewed (analysis failed)", ""]
+            continue
+        lines.append(f"Clause {c['number']} — {c['heading']} · {RISK_ICONS[r['risk']]} {r['risk']}")
+        lines.append(f"   • CLAUSE SUMMARY: {r.get('summary', '')}")
+        if r.get("issues"):
+            lines.append(f"   • ISSUES: {r['issues']}")
+        if r.get("recommendation"):
+            lines.append(f"   • RECOMMENDATION: {r['recommendation']}")
+        lines.append("")
+        if r["risk"] != "Low":
+            flagged.append((c, r))
+    flagged.sort(key=lambda cr: cr[1]["risk"] != "High")
+    lines += ["═══ RED FLAG MATRIX ═══",
+              "| # | Clause | Risk | Issue | Recommended Fix |",
+              "|---|--------|------|-------|----------------|"]
+
+    def cell(value) -> str:
+        return str(value or "—").replace("|", "/").replace("\n", " ")
+
+    for i, (c, r) in enumerate(flagged, 1):
+        lines.append(f"| {i} | {cell(c['number'] + ' ' + c['heading'])} | "
+                     f"{RISK_ICONS[r['risk']]} {r['risk']} | {cell(r.get('issues'))} | "
+                     f"{cell(r.get('recommendation'))} |")
+    if not flagged:
+        lines.append("| — | No High or Medium risk clauses found | — | — | — |")
+    return "\n".join(lines) + "\n\n" + assessment.strip()
+
+
+def review_contract(contract: str, instructions: str = "", mode: str = "standard",
+                    progress=None, stream_to=None) -> tuple:
+    """Map-reduce review of a long contract: split into clauses, review uncached
+    clauses in batches concurrently on the cheap model, then reduce the findings
+    into the RED FLAG MATRIX and OVERALL ASSESSMENT. Every step sees the
+    client's `instructions` (who is advised). Each clause review is cached by a
+    hash of its text and the instructions, so a revised draft only pays for
+    the clauses that changed. `progress(done, total)` is called as batches finish.
+    Returns (review_text, report)."""
+    clauses = split_contract_clauses(contract)
+    cache = get_llm_cache()
+    ttl = LLM_CACHE_TTLS["contract_clause"] if st.session_state.get("llm_cache_enabled", True) else 0
+    reviews: dict = {}
+    pending = []
+    for c in clauses:
+        cached = cache.get(_clause_cache_key(c, instructions)) if ttl else None
+        if cached:
+            reviews[c["number"]] = json.loads(cached)
+        else:
+            pending.append(c)
+    report = {"clauses": len(clauses), "cached": len(clauses) - len(pending), "batches": 0,
+              "failed": 0}
+
+    k = _resolve_api_key()
+    if pending and not k:
+        return "⚠️ No API key configured. Please set up your key.", report
+    batches = _clause_batches(pending)
+    report["batches"] = len(batches)
+    if batches:
+        client = limited_client(k)
+        router = get_model_router()
+        user_id = st.session_state.get("current_user_id", "")
+        tasks = {}
+        for i, batch in enumerate(batches):
+            prompt_chars = (sum(len(c["text"]) for c in batch) + len(CONTRACT_CLAUSE_SYSTEM)
+                            + len(_contract_instructions(instructions)))
+            candidates = router.route("contract_clause", "brief", prompt_chars,
+                                      st.session_state.gemini_model,
+                                      auto=st.session_state.get("model_routing", True))
+            tasks[i] = (lambda b=batch, m=candidates:
+                        _review_clause_batch(b, instructions, client, router, m, user_id))
+        finished = [0]
+
+        def on_done(i, result):
+            finished[0] += 1
+            if isinstance(result, Exception):
+                report["failed"] += len(batches[i])
+            else:
+                for c in batches[i]:
+                    r = result.get(c["number"])
+                    if r is None:
+                        report["failed"] += 1
+                        continue
+                    reviews[c["number"]] = r
+                    if ttl:
+                        cache.put(_clause_cache_key(c, instructions),
+                                  json.dumps(r, ensure_ascii=False), ttl,
+                                  model="contract-clause", task="contract_clause",
+                                  input_chars=len(c["text"]))
+            if progress is not None:
+                progress(finished[0], len(batches))
+
+        run_parallel(tasks, on_done=on_done)
+
+    findings = "\n".join(
+        f"- Clause {c['number']} ({c['heading']}): {reviews[c['number']]['risk']} — "
+        f"{reviews[c['number']].get('issues', '')}"
+        for c in clauses
+        if c["number"] in reviews and reviews[c["number"]]["risk"] != "Low"
+    ) or "- None"
+    reduce_prompt = CONTRACT_REDUCE_PROMPT.format(
+        clause_count=len(clauses),
+        headings="\n".join(f"- {c['number']}. {c['heading']}" for c in clauses),
+        findings=findings,
+        instructions=f"\nTHE CLIENT'S INSTRUCTIONS:\n{instructions}\n" if instructions else "",
+    )
+    assessment = generate(reduce_prompt, IDENTITY_CORE, "brief" if mode == "brief" else "standard",
+                          "contract_review", stream_to=stream_to, enable_quality_gate=False)
+    return _format_contract_review(clauses, reviews, assessment), report
+
+
 def run_comparison(entry_a: dict, entry_b: dict) -> str:
     prompt = (
         f"ANALYSIS A (from {entry_a.get('timestamp', '')}):\n"
@@ -10083,7 +13829,7 @@ def run_issue_spot(query: str) -> str:
 
 def run_research(query: str, mode: str) -> str:
     system = build_system_prompt("research", mode)
-    return generate(query, system, mode, "research")
+    return generate(query, system, mode, "research", enable_quality_gate=True)
 
 
 def safe_secret(key: str, default: str = "") -> str:
@@ -10120,7 +13866,7 @@ def update_case(cid: str, updates: dict):
         if c["id"] == cid:
             c.update(updates)
             c["updated_at"] = datetime.now().isoformat()
-    persist("cases")
+            persist_record("cases", c)
 
 def init_session_state():
     """Set non-user-specific session defaults. Called every render cycle."""
@@ -10207,9 +13953,7 @@ def extract_file_text(uploaded_file) -> str:
 
 def run_ai_query(query: str, task: str, mode: str, context: str = "") -> str:
     system = build_system_prompt(task, mode)
-    full_prompt = query
-    if context:
-        full_prompt = f"DOCUMENT CONTEXT:\n{context[:8000]}\n\nQUERY:\n{query}"
+    full_prompt, _ = assemble_context(query, mode, system, document=context)
     return generate(full_prompt, system, mode, task)
 
 
@@ -10217,7 +13961,7 @@ def add_case(data: dict):
     data["id"] = new_id()
     data["created_at"] = datetime.now().isoformat()
     st.session_state.cases.append(data)
-    persist("cases")
+    persist_record("cases", data, new=True)
 
 def _resolve_api_key() -> str:
     for src in [
@@ -10245,8 +13989,8 @@ def main():
         render_setup_screen()
         return
 
-    db = get_db()
-    db.ensure_connected()  # heal stale/aborted connections before any DB work
+    db = get_db()  # pooled — connections are health-checked on checkout
+    get_maintenance()  # housekeeping runs on its own thread, never on a request
 
     # ── Auto-login from persistent session token (survives page refreshes) ──
     if not st.session_state.authenticated:
@@ -10341,4 +14085,12 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        # st.rerun()/st.stop() raise through here too, so every run ends with
+        # one write-behind transaction for this session's user.
+        try:
+            flush_pending()
+        except Exception as e:
+            logger.error(f"End-of-run flush failed: {e}")